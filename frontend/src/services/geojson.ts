@@ -6,19 +6,11 @@
 // - states
 // - lakes
 // - rivers
-// - freeways
-// - oklahomaCounties
-// - oklahomaLakes
-// - oklahomaStreams
 
 type dataType = 'coastline' |
     'states' |
     'lakes' |
-    'rivers' |
-    'freeways' |
-    'oklahomaCounties' |
-    'oklahomaLakes' |
-    'oklahomaStreams';
+    'rivers';
 
 // We'll split this out to different versions if needed in the future,
 // but for now, all the caches are the same version.
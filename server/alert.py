@@ -1,197 +1,27 @@
-import datetime
-import json
+import asyncio
 
-import requests
-from shapely.geometry import shape, Polygon, MultiPolygon, GeometryCollection
-from shapely import to_geojson
 from awips.dataaccess import DataAccessLayer
 
+from .alert_catalog import lookup_event
 from .cache import Cache
+from .metrics import NWS_REQUEST_SECONDS
+from .nws import NWS_API, fetchExecutor, session
+from .zones import ZoneStore, zone_id_from_url
 
 DataAccessLayer.changeEDEXHost("edex-cloud.unidata.ucar.edu")
 
 class WXAlert(dict):
-    # Event codes: https://www.weather.gov/nwr/eventcodes
-    # https://www.weather.gov/help-map
-    def _get_color(self):
-        if self.get('event') == "Blizzard Warning":
-            return "#FF4500"
-        elif self.get('event') == "Coastal Flood Watch":
-            return "#66CDAA"
-        elif self.get('event') == "Coastal Flood Warning":
-            return "#228B22"
-        elif self.get('event') == "Dust Storm Warning":
-            return "#FFE4C4"
-        elif self.get('event') == "Extreme Wind Warning":
-            return "#FF8C00"
-        elif self.get('event') == "Flash Flood Watch":
-            return "#2E8B57"
-        elif self.get('event') == "Flash Flood Warning":
-            return "#8B0000"
-        elif self.get('event') == "Flash Flood Statement":
-            return "#8B0000"
-        elif self.get('event') == "Flood Watch":
-            return "#2E8B57"
-        elif self.get('event') == "Flood Warning":
-            return "#00FF00"
-        elif self.get('event') == "Flood Statement":
-            return "#00FF00"
-        elif self.get('event') == "High Wind Watch":
-            return "#B8860B"
-        elif self.get('event') == "High Wind Warning":
-            return "#DAA520"
-        elif self.get('event') == "Hurricane Watch":
-            return "#FF00FF"
-        elif self.get('event') == "Hurricane Warning":
-            return "#DC143Cs"
-        elif self.get('event') == "Hurricane Statement":
-            return "#FFE4B5"
-        elif self.get('event') == "Severe Thunderstorm Watch":
-            return "#DB7093"
-        elif self.get('event') == "Severe Thunderstorm Warning":
-            return "#FFA500"
-        elif self.get('event') == "Severe Weather Statement":
-            return "#00FFFF"
-        elif self.get('event') == "Snow Squall Warning":
-            return "#C71585"
-        elif self.get('event') == "Special Marine Warning":
-            return "#FFA500"
-        elif self.get('event') == "Special Weather Statement":
-            return "#FFE4B5"
-        elif self.get('event') == "Storm Surge Watch":
-            return "#DB7FF7"
-        elif self.get('event') == "Storm Surge Warning":
-            return "#B524F7"
-        elif self.get('event') == "Tornado Watch":
-            return "#FFFF00"
-        elif self.get('event') == "Tornado Warning":
-            return "#FF0000"
-        elif self.get('event') == "Tropical Storm Watch":
-            return "#F08080"
-        elif self.get('event') == "Tropical Storm Warning":
-            return "#B22222"
-        elif self.get('event') == "Tsunami Watch":
-            return "#FF00FF"
-        elif self.get('event') == "Tsunami Warning":
-            return "#FD6347"
-        elif self.get('event') == "Winter Storm Watch":
-            return "#4682B4"
-        elif self.get('event') == "Winter Storm Warning":
-            return "#FF69B4"
-        elif self.get('event') == "Avalanche Watch":
-            return "#F4A460"
-        elif self.get('event') == "Avalanche Warning":
-            return "#1E90FF"
-        elif self.get('event') == "Blue Alert":
-            return "#B0C4DE"
-        elif self.get('event') == "Child Abduction Emergency":
-            return "#800000"
-        elif self.get('event') == "Civil Danger Warning":
-            return "#FFB6C1"
-        elif self.get('event') == "Civil Emergency Message":
-            return "#FFB6C1"
-        elif self.get('event') == "Earthquake Warning":
-            return "#8B4513"
-        elif self.get('event') == "Evacuation Immediate":
-            return "#7FFF00"
-        elif self.get('event') == "Fire Warning":
-            return "#A0522D"
-        elif self.get('event') == "Hazardous Materials Warning":
-            return "#4B0082"
-        elif self.get('event') == "Law Enforcement Warning":
-            return "#C0C0C0"
-        elif self.get('event') == "Local Area Emergency":
-            return "#C0C0C0"
-        elif self.get('event') == "911 Telephone Outage Emergency":
-            return "#C0C0C0"
-        elif self.get('event') == "Nuclear Power Plant Warning":
-            return "#4B0082"
-        elif self.get('event') == "Radiological Hazard Warning":
-            return "#4B0082"
-        elif self.get('event') == "Shelter in Place Warning":
-            return "#FA8072"
-        elif self.get('event') == "Volcano Warning":
-            return "#2F4F4F"
-        else:
-            return "#FD6347"
-        
-    def is_weather(self):
-        if self.get('event') == "Blizzard Warning":
-            return True
-        elif self.get('event') == "Coastal Flood Watch":
-            return True
-        elif self.get('event') == "Coastal Flood Warning":
-            return True
-        elif self.get('event') == "Dust Storm Warning":
-            return True
-        elif self.get('event') == "Extreme Wind Warning":
-            return True
-        elif self.get('event') == "Flash Flood Watch":
-            return True
-        elif self.get('event') == "Flash Flood Warning":
-            return True
-        elif self.get('event') == "Flash Flood Statement":
-            return True
-        elif self.get('event') == "Flood Advisory":
-            return True
-        elif self.get('event') == "Flood Watch":
-            return True
-        elif self.get('event') == "Flood Warning":
-            return True
-        elif self.get('event') == "Flood Statement":
-            return True
-        elif self.get('event') == "High Wind Watch":
-            return True
-        elif self.get('event') == "High Wind Warning":
-            return True
-        elif self.get('event') == "Hurricane Watch":
-            return True
-        elif self.get('event') == "Hurricane Warning":
-            return True
-        elif self.get('event') == "Hurricane Statement":
-            return True
-        elif self.get('event') == "Severe Thunderstorm Watch":
-            return True
-        elif self.get('event') == "Severe Thunderstorm Warning":
-            return True
-        elif self.get('event') == "Severe Weather Statement":
-            return True
-        elif self.get('event') == "Snow Squall Warning":
-            return True
-        elif self.get('event') == "Special Marine Warning":
-            return True
-        elif self.get('event') == "Special Weather Statement":
-            return True
-        elif self.get('event') == "Storm Surge Watch":
-            return True
-        elif self.get('event') == "Storm Surge Warning":
-            return True
-        elif self.get('event') == "Tornado Watch":
-            return True
-        elif self.get('event') == "Tornado Warning":
-            return True
-        elif self.get('event') == "Tropical Storm Watch":
-            return True
-        elif self.get('event') == "Tropical Storm Warning":
-            return True
-        elif self.get('event') == "Tsunami Watch":
-            return True
-        elif self.get('event') == "Tsunami Warning":
-            return True
-        elif self.get('event') == "Winter Storm Watch":
-            return True
-        elif self.get('event') == "Winter Storm Warning":
-            return True
-        else:
-            return False
-
-    def __init__(self, feature_json, state, cache: Cache):
+    # zones must already hold every affected zone
+    def __init__(self, feature_json, state, zones: ZoneStore):
         if 'type' not in feature_json or feature_json['type'] != 'Feature':
             raise ValueError('Invalid GeoJSON Feature')
+        zoneIds = [zone_id_from_url(zone) for zone in feature_json['properties']['affectedZones']]
         if 'geometry' in feature_json and feature_json['geometry'] is not None:
             polygon = feature_json['geometry']
         else:
-            polygon = self._make_multipolygon(cache, feature_json['properties']['affectedZones'])
+            polygon = zones.union(zoneIds)
+        sameCodes = feature_json['properties'].get('eventCode', {}).get('SAME', [])
+        event = lookup_event(feature_json['properties']['event'], sameCodes[0] if len(sameCodes) > 0 else None)
         dict.__init__(self,
                     id=feature_json['properties']['id'],
                     geometry=polygon,
@@ -210,83 +40,51 @@ class WXAlert(dict):
                     instruction=feature_json['properties']['instruction'] if 'instruction' in feature_json['properties'] else "",
                     area_desc=feature_json['properties']['areaDesc'],
                     state=state,
+                    zones=zoneIds,
                     max_hail_size=feature_json['properties']['parameters']['maxHailSize'] if 'maxHailSize' in feature_json['properties']['parameters'] else None,
                     max_wind_speed=feature_json['properties']['parameters']['maxWindSpeed'] if 'maxWindSpeed' in feature_json['properties']['parameters'] else None,
-                    color=self._get_color(),
-                    is_weather=self.is_weather(),
+                    color=event.color,
+                    is_weather=event.is_weather,
+                    priority=event.priority,
                     )
 
-    def _make_multipolygon(self, cache: Cache, affected_zones):
-        ugcs_polygons = []
-        for zone in affected_zones:
-            poly = self._get_polygon_from_url(cache, zone)
-            if type(poly) == Polygon:
-                ugcs_polygons.append(poly)
-            elif type(poly) == MultiPolygon:
-                for geom in poly.geoms:
-                    ugcs_polygons.append(geom)
-            elif type(poly) == GeometryCollection:
-                for geom in poly.geoms:
-                    if type(geom) == Polygon:
-                        ugcs_polygons.append(geom)
-                    elif type(geom) == MultiPolygon:
-                        for geom2 in geom.geoms:
-                            ugcs_polygons.append(geom2)
-                    else:
-                        print(geom)
-                        raise ValueError('Invalid polygon')
-        return json.loads(to_geojson(MultiPolygon([poly for poly in ugcs_polygons])))
-
-    def _get_polygon_from_url(self, cache: Cache, url):
-        cacheKey = f'alert/polygon/{url}'
-        if cache.has(cacheKey):
-            rawData = cache.get(cacheKey)
-            jsonData = json.loads(rawData)
-            return shape(jsonData['geometry'])
-        response = requests.get(
-            url,
-            headers={
-                'Accept': 'application/geo+json',
-                'User-Agent': 'weather-dashboard',
-            }
-        )
-        if response.status_code != 200:
-            raise ValueError('Failed to get polygon')
-        res = response.json()
-        if 'geometry' not in res or res['geometry'] is None:
-            raise ValueError('Invalid polygon')
-        if ('coordinates' not in res['geometry'] and (res['geometry']['type'] != "Polygon" or res['geometry']['type'] != "MultiPolygon")) \
-                and (res['geometry']['type'] != "GeometryCollection"):
-            print(res)
-            print(url)
-            raise ValueError('Invalid polygon')
-        cache.set(cacheKey, response.content, datetime.timedelta(days=365))
-        return shape(res['geometry'])
-
-def _get_alerts_geojson(state):
-    url = 'https://api.weather.gov/alerts/active?area={}&status=actual'.format(state)
-    response = requests.get(
-        url,
-        headers={
-            'Accept': 'application/geo+json',
-            'User-Agent': 'weather-dashboard',
-        }
-    )
-    return response.json()
-
+def _get_alerts_geojson(state, validators=None):
+    # Conditional request when we have validators from the last response, None if nothing changed
+    headers = {}
+    if validators is not None:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    with NWS_REQUEST_SECONDS.labels('alerts').time():
+        response = session.get(f'{NWS_API}/alerts/active', params={'area': state, 'status': 'actual'}, headers=headers)
+    if response.status_code == 304:
+        return None, validators
+    # Errors come back as problem+json, which mustn't be taken for an empty list of alerts
+    if response.status_code != 200:
+        raise ValueError(f"Alerts request failed with status {response.status_code}")
+    return response.json(), {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
 
-def get_alerts(cache, state):
+# Active alerts for a state, or None if they haven't changed since the response the validators came from.
+# Raises ValueError when the API fails, so the last good alerts are kept.
+async def poll_alerts_async(cache: Cache, state, validators=None, zones: ZoneStore = None):
     state = state.upper()
-    alertsJSON = _get_alerts_geojson(state)
-    if 'type' not in alertsJSON or alertsJSON['type'] != 'FeatureCollection':
-        print('Invalid GeoJSON FeatureCollection')
-        return []
+    loop = asyncio.get_running_loop()
+    alertsJSON, validators = await loop.run_in_executor(fetchExecutor, _get_alerts_geojson, state, validators)
+    if alertsJSON is None:
+        return None, validators
+    if alertsJSON.get('type') != 'FeatureCollection' or 'features' not in alertsJSON:
+        raise ValueError('Invalid GeoJSON FeatureCollection')
 
-    if 'features' not in alertsJSON:
-        print('No alerts found')
-        return []
+    # Zones for every alert without its own geometry, loaded together
+    if zones is None:
+        zones = ZoneStore(cache)
+    await zones.load([zone for feature in alertsJSON['features'] if feature.get('geometry') is None
+                      for zone in feature.get('properties', {}).get('affectedZones', [])])
 
     alerts = []
     for feature in alertsJSON['features']:
-        alerts.append(WXAlert(feature, state, cache))
-    return alerts
+        alerts.append(WXAlert(feature, state, zones))
+    # Most important first, in the API's order otherwise
+    alerts.sort(key=lambda alert: alert['priority'])
+    return alerts, validators
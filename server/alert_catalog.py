@@ -0,0 +1,77 @@
+import collections
+
+# Event codes: https://www.weather.gov/nwr/eventcodes
+# Colors: https://www.weather.gov/help-map
+# Priority follows the hazard map's ordering, 1 is the most important. Rows are in the order
+# events are listed in the legend.
+AlertEvent = collections.namedtuple('AlertEvent', ['name', 'code', 'color', 'is_weather', 'priority'])
+
+CATALOG = (
+    AlertEvent("Blizzard Warning", "BZW", "#FF4500", True, 17),
+    AlertEvent("Coastal Flood Watch", "CFA", "#66CDAA", True, 40),
+    AlertEvent("Coastal Flood Warning", "CFW", "#228B22", True, 26),
+    AlertEvent("Dust Storm Warning", "DSW", "#FFE4C4", True, 28),
+    AlertEvent("Extreme Wind Warning", "EWW", "#FF8C00", True, 3),
+    AlertEvent("Flash Flood Watch", "FFA", "#2E8B57", True, 31),
+    AlertEvent("Flash Flood Warning", "FFW", "#8B0000", True, 5),
+    AlertEvent("Flash Flood Statement", "FFS", "#8B0000", True, 6),
+    AlertEvent("Flood Advisory", None, "#00FF7F", True, 44),
+    AlertEvent("Flood Watch", "FLA", "#2E8B57", True, 39),
+    AlertEvent("Flood Warning", "FLW", "#00FF00", True, 27),
+    AlertEvent("Flood Statement", "FLS", "#00FF00", True, 32),
+    AlertEvent("High Wind Watch", "HWA", "#B8860B", True, 42),
+    AlertEvent("High Wind Warning", "HWW", "#DAA520", True, 20),
+    AlertEvent("Hurricane Watch", "HUA", "#FF00FF", True, 34),
+    AlertEvent("Hurricane Warning", "HUW", "#DC143C", True, 15),
+    AlertEvent("Hurricane Statement", "HLS", "#FFE4B5", True, 35),
+    AlertEvent("Severe Thunderstorm Watch", "SVA", "#DB7093", True, 30),
+    AlertEvent("Severe Thunderstorm Warning", "SVR", "#FFA500", True, 4),
+    AlertEvent("Severe Weather Statement", "SVS", "#00FFFF", True, 7),
+    AlertEvent("Snow Squall Warning", "SQW", "#C71585", True, 18),
+    AlertEvent("Special Marine Warning", "SMW", "#FFA500", True, 16),
+    AlertEvent("Special Weather Statement", "SPS", "#FFE4B5", True, 45),
+    AlertEvent("Storm Surge Watch", "SSA", "#DB7FF7", True, 33),
+    AlertEvent("Storm Surge Warning", "SSW", "#B524F7", True, 14),
+    AlertEvent("Tornado Watch", "TOA", "#FFFF00", True, 29),
+    AlertEvent("Tornado Warning", "TOR", "#FF0000", True, 2),
+    AlertEvent("Tropical Storm Watch", "TRA", "#F08080", True, 36),
+    AlertEvent("Tropical Storm Warning", "TRW", "#B22222", True, 21),
+    AlertEvent("Tsunami Watch", "TSA", "#FF00FF", True, 22),
+    AlertEvent("Tsunami Warning", "TSW", "#FD6347", True, 1),
+    AlertEvent("Winter Storm Watch", "WSA", "#4682B4", True, 41),
+    AlertEvent("Winter Storm Warning", "WSW", "#FF69B4", True, 19),
+    AlertEvent("Avalanche Watch", "AVA", "#F4A460", False, 43),
+    AlertEvent("Avalanche Warning", "AVW", "#1E90FF", False, 23),
+    AlertEvent("Blue Alert", "BLU", "#B0C4DE", False, 46),
+    AlertEvent("Child Abduction Emergency", "CAE", "#800000", False, 37),
+    AlertEvent("Civil Danger Warning", "CDW", "#FFB6C1", False, 9),
+    AlertEvent("Civil Emergency Message", "CEM", "#FFB6C1", False, 13),
+    AlertEvent("Earthquake Warning", "EQW", "#8B4513", False, 24),
+    AlertEvent("Evacuation Immediate", "EVI", "#7FFF00", False, 8),
+    AlertEvent("Fire Warning", "FRW", "#A0522D", False, 12),
+    AlertEvent("Hazardous Materials Warning", "HMW", "#4B0082", False, 11),
+    AlertEvent("Law Enforcement Warning", "LEW", "#C0C0C0", False, 25),
+    AlertEvent("Local Area Emergency", "LAE", "#C0C0C0", False, 38),
+    AlertEvent("911 Telephone Outage Emergency", "TOE", "#C0C0C0", False, 47),
+    AlertEvent("Nuclear Power Plant Warning", "NUW", "#4B0082", False, 10),
+    AlertEvent("Radiological Hazard Warning", "RHW", "#4B0082", False, 10),
+    AlertEvent("Shelter in Place Warning", "SPW", "#FA8072", False, 8),
+    AlertEvent("Volcano Warning", "VOW", "#2F4F4F", False, 24),
+)
+# Anything not in the catalog
+UNKNOWN_EVENT = AlertEvent(None, None, "#FD6347", False, max(event.priority for event in CATALOG) + 1)
+
+EVENTS_BY_NAME = {event.name: event for event in CATALOG}
+EVENTS_BY_CODE = {event.code: event for event in CATALOG if event.code is not None}
+
+def lookup_event(name: str = None, code: str = None):
+    if name in EVENTS_BY_NAME:
+        return EVENTS_BY_NAME[name]
+    return EVENTS_BY_CODE.get(code, UNKNOWN_EVENT)
+
+# The catalog as served to clients, in legend order
+def catalog_json():
+    return {
+        'events': [{**event._asdict(), 'order': order} for order, event in enumerate(CATALOG)],
+        'unknown': UNKNOWN_EVENT._asdict(),
+    }
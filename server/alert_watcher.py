@@ -0,0 +1,131 @@
+import asyncio
+import concurrent.futures
+import datetime
+import json
+import logging
+
+from .alert import poll_alerts_async
+from .cache import Cache
+from .watch_loop import WatchLoop
+from .zones import ZoneStore
+
+# The API refreshes alerts about once a minute
+ALERT_POLL_INTERVAL = 60
+# Outlives a few missed polls, so a stuck poller shows up as a cache miss rather than stale alerts
+ALERT_SNAPSHOT_EXPIRATION = datetime.timedelta(minutes=10)
+# How long a request waits for the first poll of a state
+FIRST_POLL_TIMEOUT = 60
+
+# Polls the active alerts for each watched state, keeps a serialized snapshot of them in
+# the cache for the HTTP route and tells listeners what was added, updated or expired
+class AlertWatcher(WatchLoop):
+    def __init__(self, cache: Cache, zones: ZoneStore):
+        super().__init__()
+        self.cache = cache
+        self.zones = zones
+        self.alerts = dict()
+        self.snapshots = dict()
+        self.validators = dict()
+        self.ready = dict()
+        self.eventListeners = {}
+
+    async def _refresh(self, state: str):
+        alerts, self.validators[state] = await poll_alerts_async(self.cache, state, self.validators.get(state), self.zones)
+        if alerts is None:
+            # Not modified, keep the snapshot from expiring
+            self.cache.set(f"alerts/{state}", self.snapshots[state], ALERT_SNAPSHOT_EXPIRATION)
+            return
+
+        # Alerts are compared by their serialized form, keyed by id
+        current = {alert['id']: json.dumps(alert) for alert in alerts}
+        previous = self.alerts.get(state)
+        self.alerts[state] = current
+        self.snapshots[state] = json.dumps(alerts).encode()
+        self.cache.set(f"alerts/{state}", self.snapshots[state], ALERT_SNAPSHOT_EXPIRATION)
+        if previous is None:
+            return
+
+        byId = {alert['id']: alert for alert in alerts}
+        changes = {
+            'added': [byId[alertId] for alertId in current if alertId not in previous],
+            'updated': [byId[alertId] for alertId in current if alertId in previous and previous[alertId] != current[alertId]],
+            'expired': [alertId for alertId in previous if alertId not in current],
+        }
+        if any(len(change) > 0 for change in changes.values()):
+            self._notify(state, changes)
+
+    async def _watch(self, state: str):
+        while True:
+            try:
+                await self._refresh(state)
+            except Exception as e:
+                logging.info(f"Error polling alerts: {repr(e)}")
+                print(f"Error polling alerts: {repr(e)}")
+            if state in self.snapshots and not self.ready[state].done():
+                self.ready[state].set_result(True)
+            await asyncio.sleep(ALERT_POLL_INTERVAL)
+
+    def is_watching(self, state: str):
+        return state.upper() in self.tasks
+
+    def start(self, state: str):
+        state = state.upper()
+        with self.lock:
+            if self.is_watching(state):
+                raise ValueError(f"Already watching {state}")
+            # Before the task, which resolves it after the first poll
+            self.ready[state] = concurrent.futures.Future()
+            self._schedule(state, self._watch)
+
+    def stop(self, state: str):
+        state = state.upper()
+        self._cancel(state)
+        self.alerts.pop(state, None)
+        self.snapshots.pop(state, None)
+        self.validators.pop(state, None)
+        self.ready.pop(state, None)
+
+    def stop_all(self):
+        for state in self.watching():
+            self.stop(state)
+        self._close()
+
+    # Serialized list of active alerts, polling the state for the first time if needed.
+    # Returns None if the first poll hasn't succeeded in time.
+    def snapshot(self, state: str):
+        state = state.upper()
+        snapshot = self.cache.get(f"alerts/{state}")
+        if snapshot is not None:
+            return snapshot
+        if not self.is_watching(state):
+            try:
+                self.start(state)
+            except ValueError:
+                pass
+        try:
+            self.ready[state].result(FIRST_POLL_TIMEOUT)
+        except (concurrent.futures.TimeoutError, KeyError):
+            return None
+        return self.snapshots.get(state)
+
+    def add_event_listener(self, listener, state: str = '*'):
+        state = state.upper()
+        with self.lock:
+            if listener not in self.eventListeners.setdefault(state, []):
+                self.eventListeners[state].append(listener)
+
+    def remove_event_listener(self, listener, state: str = '*'):
+        state = state.upper()
+        with self.lock:
+            if listener in self.eventListeners.get(state, []):
+                self.eventListeners[state].remove(listener)
+
+    def _notify(self, state: str, changes):
+        with self.lock:
+            listeners = self.eventListeners.get(state, []) + self.eventListeners.get('*', [])
+        for listener in listeners:
+            try:
+                listener(state, changes)
+            except Exception as e:
+                logging.info(f"Error notifying listener: {repr(e)}")
+                print(f"Error notifying listener: {repr(e)}")
@@ -1,110 +1,398 @@
 import calendar
-import datetime
+import itertools
 import json
 import logging
-import os
-import queue
+import threading
 import time
 
-from flask import Flask, send_file, jsonify
+from flask import Flask, g, jsonify, request
+from shapely import to_geojson
+from shapely.geometry import box, shape, Point
 from flask_sock import Sock
 from simple_websocket import ConnectionClosed
-from metpy.io import Level2File
 
 
-from .alert import get_alerts
+from .alert_catalog import catalog_json
+from .basemap import BasemapIndex, negotiate_encoding, BASEMAP_ZOOM_DETAIL
+from .broadcast import StationHub, Subscriber, parse_subscription
 from .cache import Cache
-from .radar import get_radar_scan_time, extract_timestamp, get_specific_radar_scan, process
-from .radar_watcher import RadarWatcher
+from .events import RemoteAlertWatcher, RemoteRadarWatcher
+from .radar import get_radar_scan_time, extract_timestamp, get_sweep, get_sweep_delta, get_sweep_view, ENCODINGS, MOMENTS, PRODUCTS, MAX_SCAN_LIST_SPAN
+from .geometry import detail_for_zoom, get_grid
+from .metrics import render as render_metrics, record_cache_stats, span, start_trace, finish_trace, server_timing, log_trace, HTTP_REQUEST_SECONDS
+from .mosaic import latest_mosaic, mosaic_at, REGIONS
+from .packing import COMPRESSIONS
+from .scan_index import scans_between, ScanIndex
+from .worker import Worker
+from .zones import ZoneStore, zone_url, ZONE_STORE_SIZE, ZONE_TYPES, ZONE_ZOOM_DETAIL
+from .tiles import render_tile, MIN_TILE_ZOOM, MAX_TILE_ZOOM, TILE_FORMATS
 
-dataTypes = ["coastline", "states", "lakes", "rivers", "freeways", "oklahomaCounties", "oklahomaLakes", "oklahomaStreams"]
+PACKED_MIMETYPE = "application/vnd.weather-dashboard.packed+msgpack"
 
 app = Flask(__name__)
 app.config['SOCK_SERVER_OPTIONS'] = {'ping_interval': 25}
 websocket = Sock(app)
 cache = Cache()
-watcher = RadarWatcher(cache)
-
-watcher.start("KTLX")
+basemaps = BasemapIndex().load()
+scanIndex = ScanIndex(cache)
+# Radars and alerts are watched by the leading worker (python -m server.worker), this
+# process only serves what it puts in the cache and the events it publishes
+watcher = RemoteRadarWatcher(cache)
+alertWatcher = RemoteAlertWatcher(cache)
+stationHub = StationHub(cache, watcher)
+zoneStore = ZoneStore(cache, ZONE_STORE_SIZE)
 
 # @app.errorhandler(Exception)
 # def exception_handler(error):
 #     return "!!!!"  + repr(error)
 
+@app.before_request
+def start_request():
+    g.timeStart = time.monotonic()
+    # Requests sent with X-Trace: 1 get a Server-Timing header breaking down where the time went
+    g.trace = start_trace(request.headers.get("X-Trace") == "1")
+
+@app.after_request
+def finish_request(response):
+    duration = time.monotonic() - g.timeStart
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    HTTP_REQUEST_SECONDS.labels(endpoint, request.method, response.status_code).observe(duration)
+    spans = finish_trace(g.trace)
+    if spans is not None:
+        spans = [("total", duration, {})] + spans
+        response.headers['Server-Timing'] = server_timing(spans)
+        log_trace(request.method, request.full_path, spans)
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    record_cache_stats(cache)
+    body, contentType = render_metrics()
+    return body, 200, {'Content-Type': contentType}
+
+# Sends whatever is pushed to the subscriber until the client goes away. Client messages are
+# handled on their own thread so frames go out as soon as they're queued.
+def _serve_subscriber(ws, subscriber, on_message):
+    def receive():
+        try:
+            while True:
+                data = ws.receive()
+                if data is None or data == 'close':
+                    break
+                elif data == 'PING':
+                    subscriber.push(('pong',), 'PONG')
+                    continue
+                try:
+                    on_message(data)
+                except ValueError as e:
+                    subscriber.push(('error',), json.dumps({"error": str(e)}))
+        except ConnectionClosed:
+            pass
+        subscriber.close()
+
+    ws.send('PONG')
+    threading.Thread(target=receive, daemon=True).start()
+    try:
+        while True:
+            frame = subscriber.next()
+            if frame is None:
+                break
+            ws.send(frame)
+    except ConnectionClosed:
+        pass
+
 @websocket.route('/ws/alerts/<state>')
 def watch_alerts(ws, state):
-    pass
+    def snapshotFrame():
+        snapshot = alertWatcher.snapshot(state)
+        if snapshot is None:
+            return None
+        return json.dumps({"type": "snapshot", "state": state.upper(), "alerts": json.loads(snapshot)})
+
+    try:
+        alertWatcher.start(state)
+    except ValueError:
+        ws.close(reason=1008, message="Invalid state")
+        return
+
+    # Every change is kept in order, the client applies them to the snapshot it started from.
+    # A client that falls too far behind starts over from a new snapshot.
+    subscriber = Subscriber(resync=snapshotFrame)
+    updates = itertools.count()
+    eventListener = lambda state, changes: subscriber.push(('update', next(updates)), json.dumps({"type": "update", "state": state, **changes}))
+    alertWatcher.add_event_listener(eventListener, state)
+    snapshot = snapshotFrame()
+    if snapshot is None:
+        # The leader hasn't polled the state yet, the client retries
+        alertWatcher.remove_event_listener(eventListener, state)
+        alertWatcher.stop(state)
+        ws.close(reason=1013, message="Alerts unavailable")
+        return
+    subscriber.push(('snapshot',), snapshot)
+
+    def on_message(data):
+        raise ValueError("Invalid message")
+
+    _serve_subscriber(ws, subscriber, on_message)
+    alertWatcher.remove_event_listener(eventListener, state)
+    alertWatcher.stop(state)
 
 @websocket.route('/ws/watch/station/<station>')
 def watch_station(ws, station):
-    q = queue.Queue()
-    eventListener = lambda station, ts: q.put(json.dumps({"station": station, "timestamp": ts}))
-    watcher.add_event_listener(eventListener, station)
-    if not watcher.is_watching(station):
-        watcher.start(station)
-    ws.send('PONG')
-    while True:
-        try:
-            data = ws.receive(timeout=2)
-            if data == 'close':
-                break
-            elif data == 'PING':
-                ws.send('PONG')
-            try:
-                data = q.get_nowait()
-            except queue.Empty:
-                continue
-            else:
-                ws.send(data)
-        except ConnectionClosed:
-            break
-    watcher.remove_event_listener(eventListener, station)
+    subscriber = Subscriber()
+    try:
+        stationHub.join(station, subscriber)
+    except ValueError:
+        ws.close(reason=1008, message="Invalid station")
+        return
+    _serve_subscriber(ws, subscriber, lambda data: stationHub.subscribe(station, subscriber, parse_subscription(data)))
+    stationHub.leave(station, subscriber)
+
+@app.route("/api/alerts/catalog", methods=["GET"])
+def get_alert_catalog():
+    return jsonify(catalog_json()), 200, {'Cache-Control': 'public, max-age=86400'}
 
 @app.route("/api/alerts/<state>", methods=["GET"])
 def get_state_alerts(state):
-    return jsonify(get_alerts(cache, state))
+    # Served from the snapshot the alert watcher keeps up to date, already sorted by priority
+    try:
+        snapshot = alertWatcher.snapshot(state)
+    except ValueError:
+        return "Invalid state", 404
+    if snapshot is None:
+        return "Alerts unavailable", 503
+    maxPriority = request.args.get("max_priority", type=int)
+    weather = request.args.get("weather")
+    if maxPriority is None and weather is None:
+        return snapshot, 200, {'Content-Type': 'application/json'}
+    weather = None if weather is None else weather.lower() in ("1", "true")
+    return jsonify([
+        alert for alert in json.loads(snapshot)
+        if (maxPriority is None or alert['priority'] <= maxPriority) and (weather is None or alert['is_weather'] == weather)
+    ])
+
+# The last snapshot parsed for each state. Zone alerts carry every vertex of their zones, so
+# a state's snapshot runs to megabytes and parsing it would dominate each query.
+parsedSnapshots = {}
+
+def _parse_snapshot(state: str, snapshot: bytes):
+    parsed = parsedSnapshots.get(state)
+    if parsed is not None and parsed[0] == snapshot:
+        return parsed[1]
+    alerts = json.loads(snapshot)
+    parsedSnapshots[state] = (snapshot, alerts)
+    return alerts
+
+@app.route("/api/alerts/<state>/query", methods=["GET"])
+def query_state_alerts(state):
+    # Alerts affecting a point (lat, lon) or an area (bbox=west,south,east,north)
+    if "bbox" in request.args:
+        try:
+            west, south, east, north = [float(value) for value in request.args["bbox"].split(",")]
+        except ValueError:
+            return "Invalid bbox", 400
+        area = box(west, south, east, north)
+    else:
+        lat = request.args.get("lat", type=float)
+        lon = request.args.get("lon", type=float)
+        if lat is None or lon is None:
+            return "Missing lat and lon or bbox", 400
+        area = Point(lon, lat)
+
+    try:
+        snapshot = alertWatcher.snapshot(state)
+    except ValueError:
+        return "Invalid state", 404
+    if snapshot is None:
+        return "Alerts unavailable", 503
+    alerts = _parse_snapshot(state.upper(), snapshot)
+    # The worker stored the zones when it ingested the alerts
+    zoneStore.load_sync([zone_url(zoneId) for alert in alerts if alert['geometry']['type'] == 'MultiPolygon' for zoneId in alert.get('zones', [])])
+    zoneIds = zoneStore.query(area)
+    matches = []
+    for alert in alerts:
+        # Alerts built from zones are always a multipolygon and are matched through the zone
+        # index, storm based alerts come with their own polygon
+        if alert.get('zones') and alert['geometry']['type'] == 'MultiPolygon':
+            if zoneIds.intersection(alert['zones']):
+                matches.append(alert)
+        elif shape(alert['geometry']).intersects(area):
+            matches.append(alert)
+    return jsonify(matches)
+
+@app.route("/api/zones/<zone_type>/<ugc>", methods=["GET"])
+def get_zone(zone_type, ugc):
+    if zone_type not in ZONE_TYPES or not ugc.isalnum():
+        return "Invalid zone", 404
+    detail = detail_for_zoom(request.args.get("zoom", type=int), ZONE_ZOOM_DETAIL)
+    try:
+        geometry = zoneStore.geometry(f"{zone_type}/{ugc}", detail)
+    except ValueError:
+        return "Invalid zone", 404
+    return jsonify(json.loads(to_geojson(geometry))), 200, {'Cache-Control': 'public, max-age=86400'}
 
 @app.route("/api/geojson/<data>/<version>", methods=["GET"])
 def get_geojson(data, version):
-    if data not in dataTypes:
+    layer = basemaps.get(version, data, detail_for_zoom(request.args.get("zoom", type=int), BASEMAP_ZOOM_DETAIL))
+    if layer is None:
         return "Invalid data type", 404
-    
-    local = os.path.dirname(os.path.realpath(__file__))
 
-    if not os.path.exists(f"{local}/geojson/v{version}"):
-        return "Invalid version", 404
-
-    if not os.path.exists(f"{local}/geojson/v{version}/{data}.json"):
-        print(f"File not found: ./geojson/v{version}/{data}.json")
-        return "Internal server error", 500
-
-    return send_file(f"{local}/geojson/v{version}/{data}.json", mimetype="application/json")
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding"))
+    headers = {
+        'ETag': f'"{layer["etags"][encoding]}"',
+        'Vary': 'Accept-Encoding',
+        # Layers only change with a new version in the path
+        'Cache-Control': 'public, max-age=31536000, immutable',
+    }
+    if layer["etags"][encoding] in request.if_none_match:
+        return "", 304, headers
+    if encoding != "identity":
+        headers['Content-Encoding'] = encoding
+    headers['Content-Type'] = 'application/json'
+    return layer["encodings"][encoding], 200, headers
 
 @app.route("/api/radar/<station>/scan/<int:last>", methods=["GET"])
 def get_radar_station_last_scan(station, last):
+    # Watched stations are served from the scan index, anything else falls back to listing S3
+    if scanIndex.is_indexed(station):
+        return jsonify({"timestamp": scanIndex.latest(station, last)})
     obj = get_radar_scan_time(station, last)
     timestamp = extract_timestamp(obj, station)
     return jsonify({"timestamp": calendar.timegm(timestamp.utctimetuple())})
 
+@app.route("/api/radar/<station>/scans", methods=["GET"])
+def get_radar_station_scans(station):
+    end = request.args.get("end", int(time.time()), type=int)
+    start = request.args.get("start", end - 3600, type=int)
+    # get falls back to the default for values that aren't integers
+    if ("end" in request.args and request.args.get("end", type=int) is None) or \
+            ("start" in request.args and request.args.get("start", type=int) is None):
+        return "Invalid range", 400
+    # Whatever the index doesn't cover is an S3 LIST per hour
+    if start > end or end - start > MAX_SCAN_LIST_SPAN:
+        return "Invalid range", 400
+    return jsonify({"timestamps": scans_between(scanIndex, station, start, end)})
+
+def _radar_encoding():
+    # Existing clients get the original nested list format unless they ask for packed arrays
+    encoding = request.args.get("encoding")
+    if encoding is None:
+        encoding = "packed" if PACKED_MIMETYPE in request.headers.get("Accept", "") else "msgpack"
+    compression = request.args.get("compression")
+    return encoding, compression
+
+@app.route("/api/radar/<station>/grid/<az_hash>/<range_hash>", methods=["GET"])
+def get_radar_grid(station, az_hash, range_hash):
+    compression = request.args.get("compression")
+    if compression not in COMPRESSIONS:
+        return "Invalid compression", 400
+    packed = get_grid(cache, station, az_hash, range_hash, compression)
+    if packed is None:
+        return "Unknown grid", 404
+    # Grids are addressed by their geometry, so they never change
+    return packed, 200, {'Content-Type': 'application/msgpack', 'Cache-Control': 'public, max-age=31536000, immutable'}
+
 @app.route("/api/radar/<station>/<int:sweep>/<int:timestamp>", methods=["GET"])
 def get_radar(station, sweep, timestamp):
-    timeStart = time.monotonic()
-    if cache.has(f"{station}/{sweep}/{timestamp}"):
-        logging.info("Cache hit")
-        packed = cache.get(f"{station}/{sweep}/{timestamp}")
-        downloadCompleteTime = time.monotonic()
+    return get_radar_moment(station, sweep, "REF", timestamp)
+
+@app.route("/api/radar/<station>/<int:sweep>/<moment>/<int:timestamp>", methods=["GET"])
+def get_radar_moment(station, sweep, moment, timestamp):
+    moment = moment.upper()
+    if moment not in MOMENTS and moment not in PRODUCTS:
+        return "Invalid moment", 404
+    # Volume products cover the whole volume, so they only have sweep 0
+    if moment in PRODUCTS and sweep != 0:
+        return "Invalid sweep", 404
+
+    # Zoomed in or out maps ask for only the part of the sweep they show, at the detail they can show
+    bbox = None
+    if "bbox" in request.args:
+        try:
+            west, south, east, north = [float(value) for value in request.args["bbox"].split(",")]
+        except ValueError:
+            return "Invalid bbox", 400
+        if west >= east or south >= north:
+            return "Invalid bbox", 400
+        bbox = (west, south, east, north)
+    maxGates = request.args.get("max_gates", type=int)
+    if maxGates is not None and maxGates < 1:
+        return "Invalid max_gates", 400
+    resolution = request.args.get("resolution", type=float)
+    if resolution is not None and not resolution > 0:
+        return "Invalid resolution", 400
+    view = bbox is not None or maxGates is not None or resolution is not None
+
+    # Animation loops ask for each frame as a delta from the one before it
+    base = request.args.get("base", type=int)
+    if base is not None:
+        if view:
+            return "Deltas are of whole sweeps", 400
+        if base >= timestamp:
+            return "Invalid base", 400
+        packed = get_sweep_delta(cache, station, sweep, moment, timestamp, base)
+        if packed is None:
+            return "Invalid sweep", 404
+        return packed, 200, {'Content-Type': 'application/msgpack'}
+
+    encoding, compression = _radar_encoding()
+    if encoding not in ENCODINGS:
+        return "Invalid encoding", 400
+    if compression not in COMPRESSIONS or (compression is not None and encoding == "msgpack"):
+        return "Invalid compression", 400
+
+    if view:
+        packed = get_sweep_view(cache, station, sweep, moment, timestamp, encoding, compression, bbox, maxGates, resolution)
     else:
-        obj = get_specific_radar_scan(station, timestamp)
-        f = Level2File(obj['Body'])
-        downloadCompleteTime = time.monotonic()
-        packed = process(f, sweep, timestamp)
-        cache.set(f"{station}/{sweep}/{timestamp}", packed)
-    timeEnd = time.monotonic()
-    logging.info(f"get_radar took {datetime.timedelta(seconds=timeEnd - timeStart)}")
-    logging.info(f"get_radar download took {datetime.timedelta(seconds=downloadCompleteTime - timeStart)}")
+        packed = get_sweep(cache, station, sweep, moment, timestamp, encoding, compression)
+    if packed is None:
+        return "Invalid sweep", 404
+    return packed, 200, {'Content-Type': 'application/msgpack', 'Vary': 'Accept'}
+
+@app.route("/api/radar/<station>/<int:sweep>/<int:timestamp>/tiles/<int:z>/<int:x>/<int:y>.<ext>", methods=["GET"])
+def get_radar_tile(station, sweep, timestamp, z, x, y, ext):
+    if ext not in TILE_FORMATS:
+        return "Invalid tile format", 404
+    if z < MIN_TILE_ZOOM or z > MAX_TILE_ZOOM or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return "Invalid tile", 404
+
+    def render():
+        packed = get_sweep(cache, station, sweep, "REF", timestamp, "packed", None)
+        if packed is None:
+            return None
+        with span("render", z=z, x=x, y=y):
+            return render_tile(station, packed, z, x, y, ext)
+
+    # One render per scan and tile, whatever the number of viewers
+    tile = cache.get_or_compute(f"{station}/{sweep}/{timestamp}/tiles/{z}/{x}/{y}.{ext}", render)
+    if tile is None:
+        return "Invalid sweep", 404
+    return tile, 200, {'Content-Type': TILE_FORMATS[ext], 'Cache-Control': 'public, max-age=3600'}
+
+@app.route("/api/mosaic/<region>/latest", methods=["GET"])
+def get_latest_mosaic(region):
+    region = region.upper()
+    if region not in REGIONS:
+        return "Invalid region", 404
+    packed = latest_mosaic(cache, region)
+    if packed is None:
+        return "No mosaic yet", 404
+    return packed, 200, {'Content-Type': 'application/msgpack', 'Cache-Control': 'no-cache'}
 
+@app.route("/api/mosaic/<region>/<int:timestamp>", methods=["GET"])
+def get_mosaic(region, timestamp):
+    region = region.upper()
+    if region not in REGIONS:
+        return "Invalid region", 404
+    # Served from the mosaics the worker made as scans came in, the newest one at or before timestamp
+    packed = mosaic_at(cache, region, timestamp)
+    if packed is None:
+        return "No mosaic for this time", 404
     return packed, 200, {'Content-Type': 'application/msgpack'}
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
+    # For development, a worker runs alongside the app. In production run the app under
+    # gunicorn (gunicorn -c server/gunicorn.conf.py server.app:app) and the worker separately.
+    Worker(cache).start_thread()
     app.run(debug=True, host="0.0.0.0", port=5000)
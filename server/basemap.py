@@ -0,0 +1,154 @@
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from shapely.geometry import mapping, shape
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GEOJSON_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "geojson")
+BUILD_DIR = os.getenv("BASEMAP_BUILD_DIR", os.path.join(tempfile.gettempdir(), "weather-dashboard", "basemap"))
+# Simplification tolerance and coordinate precision in degrees for each level of detail.
+# Full detail is the source file as is.
+DETAIL_LEVELS = {
+    'low': (0.05, 2),
+    'medium': (0.01, 3),
+    'full': None,
+}
+# Basemaps are country wide, so they only need full detail once zoomed in to a region
+BASEMAP_ZOOM_DETAIL = [(3, 'low'), (6, 'medium')]
+# Preferred first when a client accepts several
+ENCODINGS = ('br', 'gzip', 'identity') if brotli is not None else ('gzip', 'identity')
+
+def _round(coordinates, decimals: int):
+    if isinstance(coordinates[0], (int, float)):
+        return [round(value, decimals) for value in coordinates]
+    return [_round(part, decimals) for part in coordinates]
+
+# Simplified copy of a layer with coordinates quantized to the level's precision
+def simplify(source: bytes, tolerance: float, decimals: int):
+    collection = json.loads(source)
+    features = []
+    for feature in collection['features']:
+        if feature.get('geometry') is None:
+            continue
+        geometry = shape(feature['geometry']).simplify(tolerance, preserve_topology=True)
+        if geometry.is_empty:
+            continue
+        geometry = mapping(geometry)
+        features.append({**feature, 'geometry': {'type': geometry['type'], 'coordinates': _round(geometry['coordinates'], decimals)}})
+    return json.dumps({**collection, 'features': features}, separators=(',', ':')).encode()
+
+def compress(data: bytes, encoding: str):
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    if encoding == 'br':
+        return brotli.compress(data, quality=11)
+    return data
+
+# Every level and encoding of a layer, built once per source file and kept in the build
+# directory under the source's hash
+def build_layer(path: str, build_dir: str = BUILD_DIR):
+    with open(path, 'rb') as f:
+        source = f.read()
+    sourceHash = hashlib.sha256(source).hexdigest()[:16]
+    variants = {}
+    for detail, simplification in DETAIL_LEVELS.items():
+        data = source if simplification is None else None
+        for encoding in ENCODINGS:
+            built = os.path.join(build_dir, f"{sourceHash}.{detail}.{encoding}")
+            if os.path.exists(built):
+                with open(built, 'rb') as f:
+                    variants.setdefault(detail, {})[encoding] = f.read()
+                continue
+            if data is None:
+                data = simplify(source, *simplification)
+            variant = compress(data, encoding)
+            os.makedirs(build_dir, exist_ok=True)
+            # Written to a temporary file of its own first, so neither a crashed build nor
+            # another process building the same layer is ever picked up half written
+            fd, tmp = tempfile.mkstemp(dir=build_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(variant)
+                os.replace(tmp, built)
+            except BaseException:
+                os.remove(tmp)
+                raise
+            variants.setdefault(detail, {})[encoding] = variant
+        # Each encoding is a different representation, so each gets its own strong ETag
+        etag = hashlib.sha256(variants[detail]['identity']).hexdigest()[:32]
+        etags = {encoding: etag if encoding == 'identity' else f"{etag}-{encoding}" for encoding in ENCODINGS}
+        variants[detail] = {'etags': etags, 'encodings': variants[detail]}
+    return variants
+
+# Every layer of every version on disk, in memory
+class BasemapIndex:
+    def __init__(self, directory: str = GEOJSON_DIR, build_dir: str = BUILD_DIR):
+        self.directory = directory
+        self.build_dir = build_dir
+        self.layers = {}
+        self.lock = threading.Lock()
+
+    def versions(self):
+        return sorted(name[1:] for name in os.listdir(self.directory) if name.startswith('v') and os.path.isdir(os.path.join(self.directory, name)))
+
+    def data_types(self, version: str):
+        return sorted(name[:-len('.json')] for name in os.listdir(os.path.join(self.directory, f"v{version}")) if name.endswith('.json'))
+
+    def load(self):
+        timeStart = time.monotonic()
+        layers = {}
+        for version in self.versions():
+            for data in self.data_types(version):
+                layers[(version, data)] = build_layer(os.path.join(self.directory, f"v{version}", f"{data}.json"), self.build_dir)
+        with self.lock:
+            self.layers = layers
+        logging.info(f"Loaded {len(layers)} basemap layers in {time.monotonic() - timeStart:.1f}s")
+        return self
+
+    def get(self, version: str, data: str, detail: str = 'full'):
+        with self.lock:
+            layer = self.layers.get((version, data))
+        if layer is None:
+            return None
+        return layer[detail]
+
+# Best encoding in ENCODINGS that the Accept-Encoding header allows
+def negotiate_encoding(accept_encoding: str):
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.
+        if name:
+            accepted[name.strip().lower()] = quality
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get('*', 1. if encoding == 'identity' else 0.)) > 0:
+            return encoding
+    return 'identity'
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the simplified and compressed basemap layers")
+    parser.add_argument("--directory", default=GEOJSON_DIR)
+    parser.add_argument("--build-dir", default=BUILD_DIR)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    index = BasemapIndex(args.directory, args.build_dir).load()
+    for (version, data), layer in sorted(index.layers.items()):
+        sizes = ", ".join(f"{detail} {' '.join(f'{encoding}={len(body)}' for encoding, body in variant['encodings'].items())}" for detail, variant in layer.items())
+        print(f"v{version}/{data}: {sizes}")
@@ -0,0 +1,213 @@
+# Fixture data for the benchmarks: Level2 V06 volumes and NWS API responses, written out
+# in the formats the real sources use so the code under test can't tell the difference.
+#
+# The volumes are synthesized rather than recorded so the suite needs no downloads, but
+# they have the structure of a real VCP: split cuts at the lowest tilts with every moment,
+# reflectivity only above that, 720 rays of 0.5 degrees and message 31 records in bzip2
+# compressed blocks.
+import bz2
+import calendar
+import datetime
+import json
+import os
+import struct
+
+import numpy as np
+
+# (first gate km, gate width km, gates, scale, offset, bits) as KTLX sends them
+V06_MOMENTS = {
+    'REF': (2.125, 0.25, 1832, 2.0, 66.0, 8),
+    'VEL': (2.125, 0.25, 1192, 2.0, 129.0, 8),
+    'SW': (2.125, 0.25, 1192, 2.0, 129.0, 8),
+    'ZDR': (2.125, 0.25, 1192, 16.0, 128.0, 8),
+    'PHI': (2.125, 0.25, 1192, 2.8361, 2.0, 16),
+    'RHO': (2.125, 0.25, 1192, 300.0, -60.5, 8),
+}
+ELEVATIONS = (0.5, 0.9, 1.3, 1.8, 2.4, 3.1, 4.0)
+# Tilts above this many only carry reflectivity
+SPLIT_CUTS = 4
+RAYS = 720
+# Records per bzip2 block, as in the real files
+RECORDS_PER_BLOCK = 120
+STATION_LOCATIONS = {
+    'KTLX': (35.333, -97.278),
+    'KINX': (36.175, -95.564),
+    'KVNX': (36.741, -98.128),
+    'KFDR': (34.362, -98.976),
+    'KAMA': (35.233, -101.709),
+    'KSRX': (35.290, -94.362),
+}
+
+# A storm cell drifting east with scan time, over weak returns everywhere else
+def _field(name, az, rng, elevation, seconds):
+    a = np.deg2rad(az)[:, None]
+    r = rng[None, :]
+    x, y = r * np.sin(a), r * np.cos(a)
+    cellX = 80 + (seconds % 3600) / 60.
+    storm = 60 * np.exp(-(((x - cellX) ** 2 + (y - 40) ** 2) / 400.)) * np.exp(-elevation / 8.)
+    if name == 'REF':
+        return storm - 10 + 5 * np.sin(x / 7.)
+    if name == 'VEL':
+        return 20 * np.sin(a) * np.ones_like(r)
+    if name == 'SW':
+        return 2 + storm / 20.
+    if name == 'ZDR':
+        return 0.5 + storm / 30.
+    if name == 'PHI':
+        return 30 + np.cumsum(np.ones_like(r) * storm / 200., axis=1) % 300
+    return 0.95 + storm / 2000.
+
+def _record(message, date: int, ms: int, sequence: int):
+    # 12 bytes of CTM header, then the message header
+    header = struct.pack('>HBBHHIHH', (16 + len(message)) // 2, 8, 31, sequence, date, ms, 1, 1)
+    return b'\0' * 12 + header + message
+
+def _ray(station, lat, lon, date, ms, number, az, status, cut, elevation, fields):
+    blocks = [
+        struct.pack('>s3sHBBffhHfffffHH', b'R', b'VOL', 44, 1, 0, lat, lon, 370, 20, -44.0, 700., 700., 0.2, 60., 212, 0),
+        struct.pack('>s3sHhf', b'R', b'ELV', 12, -12, -44.0),
+        struct.pack('>s3sHHffHxx', b'R', b'RAD', 20, 4660, -80., -80., 2600),
+    ]
+    for name, (firstGate, gateWidth, gates, scale, offset, bits, codes) in fields.items():
+        blocks.append(struct.pack('>s3sLHHHHhBBff', b'D', name.encode().ljust(3), 0, gates, int(firstGate * 1000), int(gateWidth * 1000),
+                                  50, 16, 0, bits, scale, offset) + codes[number].tobytes())
+    headerSize = struct.calcsize('>4sLHHfBxHBBBBfBBH') + 4 * len(blocks)
+    pointers = []
+    size = headerSize
+    for block in blocks:
+        pointers.append(size)
+        size += len(block)
+    message = struct.pack('>4sLHHfBxHBBBBfBBH', station.encode(), ms + number * 20, date, number + 1, float(az), 0, size, 1, status, cut,
+                          1, elevation, 0, 25, len(blocks))
+    message += struct.pack(f'>{len(blocks)}L', *pointers) + b''.join(blocks)
+    if len(message) % 2:
+        message += b'\0'
+    return message
+
+# Bytes of a V06 volume for the station's scan starting at timestamp
+def synthesize_volume(station: str, timestamp: int, elevations=ELEVATIONS, rays: int = RAYS):
+    station = station.upper()
+    lat, lon = STATION_LOCATIONS.get(station, STATION_LOCATIONS['KTLX'])
+    random = np.random.default_rng(timestamp)
+    time = datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+    date = (time.date() - datetime.date(1970, 1, 1)).days + 1
+    ms = (time.hour * 3600 + time.minute * 60 + time.second) * 1000
+
+    records = []
+    for cut, elevation in enumerate(elevations, start=1):
+        moments = list(V06_MOMENTS) if cut <= SPLIT_CUTS else ['REF']
+        # Like the real radar, each tilt starts wherever the antenna happens to be
+        start = random.uniform(0, 360)
+        az = (start + 360. / rays * (np.arange(rays) + 0.5) + random.normal(0, 0.01, rays)) % 360
+        fields = {}
+        for name in moments:
+            firstGate, gateWidth, gates, scale, offset, bits = V06_MOMENTS[name]
+            gates -= 100 * cut
+            values = _field(name, az, firstGate + gateWidth * np.arange(gates), elevation, timestamp)
+            codes = np.clip(np.rint(values * scale + offset), 2, 2 ** bits - 1)
+            if name == 'REF':
+                codes[values < -5] = 0
+            fields[name] = (firstGate, gateWidth, gates, scale, offset, bits, codes.astype(f'>u{bits // 8}'))
+        for number in range(rays):
+            # Start of volume, start of elevation, intermediate, end of elevation, end of volume
+            if number == 0:
+                status = 3 if cut == 1 else 0
+            elif number == rays - 1:
+                status = 4 if cut == len(elevations) else 2
+            else:
+                status = 1
+            message = _ray(station, lat, lon, date, ms, number, az[number], status, cut, elevation, fields)
+            records.append(_record(message, date, ms, len(records) + 1))
+
+    volume = [struct.pack('>9s3sLL4s', b'AR2V0006.', b'001', date, ms, station.encode())]
+    for i in range(0, len(records), RECORDS_PER_BLOCK):
+        block = bz2.compress(b''.join(records[i:i + RECORDS_PER_BLOCK]))
+        # The last block's size is negative
+        volume.append(struct.pack('>l', -len(block) if i + RECORDS_PER_BLOCK >= len(records) else len(block)))
+        volume.append(block)
+    return b''.join(volume)
+
+def scan_key(station: str, timestamp: int):
+    time = datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+    return f"{time.strftime('%Y/%m/%d')}/{station}/{station}{time.strftime('%Y%m%d_%H%M%S')}_V06"
+
+# Writes volumes into root laid out like the noaa-nexrad-level2 bucket, returns their keys.
+# Volumes already there are kept, so a fixture directory can be reused between runs.
+def write_volumes(root: str, station: str, timestamps):
+    keys = []
+    for timestamp in timestamps:
+        key = scan_key(station.upper(), timestamp)
+        path = os.path.join(root, key)
+        keys.append(key)
+        if os.path.exists(path):
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written to a temporary file first so a listing never sees half a volume
+        with open(f"{path}.tmp", 'wb') as f:
+            f.write(synthesize_volume(station, timestamp))
+        os.replace(f"{path}.tmp", path)
+    return keys
+
+def scan_timestamps(start: datetime.datetime, count: int, interval: int = 300):
+    first = calendar.timegm(start.utctimetuple())
+    return [first + i * interval for i in range(count)]
+
+def zone_ugc(state: str, number: int):
+    return f"{state.upper()}Z{number:03d}"
+
+# A zone's response, a ragged box with plenty of vertices like the real ones
+def zone_geojson(ugc: str, zone_type: str = 'forecast', vertices: int = 400):
+    number = int(ugc[3:])
+    west = -103. + (number % 20) * 0.45
+    south = 33.6 + (number // 20) * 0.35
+    side = vertices // 4
+    edge = np.linspace(0, 0.45, side, endpoint=False)
+    jitter = 0.01 * np.sin(np.arange(side) * 1.7)
+    ring = [[west + x, south + j] for x, j in zip(edge, jitter)] + \
+        [[west + 0.45 + j, south + y] for y, j in zip(edge * 0.35 / 0.45, jitter)] + \
+        [[west + 0.45 - x, south + 0.35 + j] for x, j in zip(edge, jitter)] + \
+        [[west + j, south + 0.35 - y] for y, j in zip(edge * 0.35 / 0.45, jitter)]
+    ring.append(ring[0])
+    return json.dumps({
+        'id': f"https://api.weather.gov/zones/{zone_type}/{ugc}",
+        'type': 'Feature',
+        'geometry': {'type': 'Polygon', 'coordinates': [ring]},
+        'properties': {'id': ugc, 'type': 'public', 'name': ugc, 'state': ugc[:2]},
+    }).encode()
+
+# An /alerts/active response with zone based alerts spread over the state's zones, and a
+# few storm based ones carrying their own polygon
+def alerts_geojson(base_url: str, state: str, alerts: int = 40, zones_per_alert: int = 25, zones: int = 77, storms: int = 5):
+    events = ["Winter Storm Warning", "Flood Watch", "Wind Advisory", "Severe Thunderstorm Watch", "Red Flag Warning"]
+    features = []
+    for i in range(alerts + storms):
+        storm = i >= alerts
+        affected = [f"{base_url}/zones/forecast/{zone_ugc(state, (i * 7 + j) % zones + 1)}" for j in range(1 if storm else zones_per_alert)]
+        lon = -102. + (i % 16) * 0.5
+        features.append({
+            'id': f"urn:oid:2.49.0.1.840.0.{i}",
+            'type': 'Feature',
+            'geometry': {'type': 'Polygon', 'coordinates': [[[lon, 35.], [lon + 0.3, 35.], [lon + 0.3, 35.3], [lon, 35.3], [lon, 35.]]]} if storm else None,
+            'properties': {
+                'id': f"urn:oid:2.49.0.1.840.0.{i}",
+                'areaDesc': ", ".join(url.rsplit('/', 1)[1] for url in affected),
+                'affectedZones': affected,
+                'sent': '2024-05-06T23:00:00-05:00',
+                'effective': '2024-05-06T23:00:00-05:00',
+                'onset': '2024-05-06T23:00:00-05:00',
+                'expires': '2024-05-07T05:00:00-05:00',
+                'ends': '2024-05-07T05:00:00-05:00',
+                'status': 'Actual',
+                'messageType': 'Alert',
+                'severity': 'Severe',
+                'certainty': 'Likely',
+                'urgency': 'Expected',
+                'event': "Tornado Warning" if storm else events[i % len(events)],
+                'headline': f"Alert {i}",
+                'description': "Synthetic alert for benchmarking.",
+                'instruction': None,
+                'eventCode': {'SAME': ['TOR' if storm else 'WSW']},
+                'parameters': {},
+            },
+        })
+    return json.dumps({'type': 'FeatureCollection', 'features': features}).encode()
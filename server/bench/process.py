@@ -0,0 +1,39 @@
+# Compare per-sweep processing against the single pass volume processing on a recorded volume
+#
+#   python -m server.bench.process path/to/KTLX20240506_230000_V06 --repeat 5
+import argparse
+import statistics
+import time
+
+from metpy.io import Level2File
+
+from ..radar import process, process_volume
+
+def _time(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        timeStart = time.monotonic()
+        fn()
+        times.append(time.monotonic() - timeStart)
+    return statistics.median(times)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark radar sweep processing")
+    parser.add_argument("volume", help="Path to a recorded Level2 V06 volume")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--encoding", default="msgpack")
+    parser.add_argument("--compression", default=None)
+    args = parser.parse_args()
+
+    timeStart = time.monotonic()
+    f = Level2File(args.volume)
+    print(f"parse: {time.monotonic() - timeStart:.3f}s, {len(f.sweeps)} sweeps")
+
+    sweeps = list(process_volume(f, 0, args.encoding, args.compression).keys())
+    perSweep = _time(lambda: [process(f, i, 0, args.encoding, args.compression) for i in sweeps], args.repeat)
+    volume = _time(lambda: process_volume(f, 0, args.encoding, args.compression), args.repeat)
+    print(f"process per sweep: {perSweep:.3f}s")
+    print(f"process_volume: {volume:.3f}s ({perSweep / volume:.2f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+# End to end benchmarks of the radar and alert pipelines, run offline against synthetic
+# fixtures, a directory standing in for the noaa-nexrad-level2 bucket, a local NWS API and
+# fakeredis. Results are written as JSON so runs on different commits can be compared.
+#
+#   python -m server.bench.run --output before.json
+#   python -m server.bench.run --output after.json --compare before.json
+#
+# Job workers run as threads in this process since fakeredis can't be shared between
+# processes, so throughput is that of a single process.
+import argparse
+import calendar
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+import fakeredis
+
+from .fixtures import scan_timestamps, write_volumes
+from .standins import LocalBucket, LocalS3Client, NWSServer, fake_cache
+
+PACKED_ACCEPT = {'Accept': 'application/vnd.weather-dashboard.packed+msgpack'}
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'n': len(samples),
+        'min': samples[0],
+        'median': statistics.median(samples),
+        'p95': samples[min(len(samples) - 1, round(0.95 * (len(samples) - 1)))],
+        'max': samples[-1],
+        'mean': statistics.fmean(samples),
+    }
+
+def _timed(fn):
+    timeStart = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - timeStart, result
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.realpath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Parse time, and per sweep extract and encode time for every moment
+def bench_process(path: str, repeat: int):
+    from metpy.io import Level2File
+    from ..radar import extract_products, extract_sweeps, encode, ENCODINGS, MOMENTS
+
+    results = {}
+    parse = [_timed(lambda: Level2File(path))[0] for _ in range(repeat)]
+    results['level2_parse_seconds'] = summarize(parse)
+    f = Level2File(path)
+    for moment in MOMENTS:
+        extract = []
+        for _ in range(repeat):
+            seconds, sweeps = _timed(lambda: extract_sweeps(f, moment=moment))
+            extract.append(seconds / len(sweeps))
+        results[f'extract_seconds_per_sweep/{moment}'] = summarize(extract)
+    reflectivity = extract_sweeps(f)
+    results['products_seconds'] = summarize([_timed(lambda: extract_products(f, reflectivity))[0] for _ in range(repeat)])
+    sweeps = extract_sweeps(f)
+    for encoding in ENCODINGS:
+        results[f'encode_seconds_per_sweep/{encoding}'] = summarize([
+            _timed(lambda: encode(sweep, 0, encoding))[0] for _ in range(repeat) for sweep in sweeps.values()])
+    # Reflectivity for every sweep in both encodings, as the watcher does for each new scan
+    total = [_timed(lambda: [encode(sweep, 0, encoding) for sweep in extract_sweeps(f).values() for encoding in ENCODINGS])[0]
+             for _ in range(repeat)]
+    results['process_sweeps_per_second'] = summarize([len(sweeps) / seconds for seconds in total])
+    return results
+
+# /api/radar latency on a cache miss, an L1 hit and a redis hit
+def bench_radar(app, cache, station: str, timestamps, repeat: int):
+    client = app.test_client()
+    results = {}
+    for moment in ('REF', 'VEL'):
+        cold = []
+        for timestamp in timestamps:
+            seconds, response = _timed(lambda: client.get(f"/api/radar/{station}/0/{moment}/{timestamp}", headers=PACKED_ACCEPT))
+            if response.status_code != 200:
+                raise RuntimeError(f"/api/radar returned {response.status_code}")
+            cold.append(seconds)
+        results[f'radar_cold_seconds/{moment}'] = summarize(cold)
+
+    warm = []
+    redis = []
+    for _ in range(repeat):
+        for timestamp in timestamps:
+            url = f"/api/radar/{station}/1/{timestamp}"
+            warm.append(_timed(lambda: client.get(url, headers=PACKED_ACCEPT))[0])
+            # Like another web worker that hasn't read it yet
+            cache.local.clear()
+            redis.append(_timed(lambda: client.get(url, headers=PACKED_ACCEPT))[0])
+    results['radar_warm_seconds/l1'] = summarize(warm)
+    results['radar_warm_seconds/redis'] = summarize(redis)
+    return results
+
+# Time from a volume landing in the bucket to the watcher's listeners hearing about it,
+# with the poll schedule shortened so it measures the pipeline rather than the wait
+def bench_watcher(cache, root: str, staging: str, station: str, scans: int):
+    from .. import radar_watcher
+    from ..radar_watcher import RadarWatcher
+
+    radar_watcher.DEFAULT_SCAN_INTERVAL = 0
+    radar_watcher.MIN_SCAN_INTERVAL = 0
+    radar_watcher.MAX_SCAN_INTERVAL = 0
+    radar_watcher.POLL_LEAD = 0
+    radar_watcher.MIN_POLL = 0.05
+    radar_watcher.MAX_POLL = 0.05
+
+    # Listings are by today's date, so the scans are from today
+    midnight = calendar.timegm(datetime.datetime.now(datetime.timezone.utc).date().timetuple())
+    timestamps = [midnight + 60 + 300 * i for i in range(scans + 1)]
+    keys = write_volumes(staging, station, timestamps)
+    os.makedirs(os.path.dirname(os.path.join(root, keys[0])), exist_ok=True)
+    shutil.copy(os.path.join(staging, keys[0]), os.path.join(root, keys[0]))
+
+    notified = {}
+    event = threading.Event()
+    def listener(station, timestamp):
+        notified[timestamp] = time.perf_counter()
+        event.set()
+
+    watcher = RadarWatcher(cache)
+    watcher.add_event_listener(listener, station)
+    watcher.start(station)
+    try:
+        deadline = time.monotonic() + 30
+        while watcher.latest(station) is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        lags = []
+        for timestamp, key in zip(timestamps[1:], keys[1:]):
+            event.clear()
+            shutil.copy(os.path.join(staging, key), os.path.join(root, f"{key}.tmp"))
+            landed = time.perf_counter()
+            os.replace(os.path.join(root, f"{key}.tmp"), os.path.join(root, key))
+            if not event.wait(60):
+                raise RuntimeError(f"Watcher never noticed {key}")
+            lags.append(notified[timestamp] - landed)
+    finally:
+        watcher.stop_all()
+        for key in keys[1:]:
+            if os.path.exists(os.path.join(root, key)):
+                os.remove(os.path.join(root, key))
+    return {'watcher_notify_lag_seconds': summarize(lags)}
+
+# Ingesting the state's alerts with every zone fetched, then serving them
+def bench_alerts(app, cache, nws: NWSServer, repeat: int):
+    from ..alert_watcher import AlertWatcher
+    from ..zones import ZoneStore
+
+    def ingest(cache):
+        watcher = AlertWatcher(cache, ZoneStore(cache))
+        try:
+            seconds, snapshot = _timed(lambda: (watcher.start(nws.state), watcher.snapshot(nws.state))[1])
+        finally:
+            watcher.stop_all()
+        if snapshot is None:
+            raise RuntimeError("Alerts were never ingested")
+        return seconds
+
+    requests = nws.requests
+    cold = [ingest(fake_cache()) for _ in range(repeat)]
+    results = {
+        'alerts_ingest_seconds': summarize(cold),
+        'alerts_nws_requests': summarize([(nws.requests - requests) / repeat]),
+    }
+
+    # The app's own cache, from which the requests are served
+    ingest(cache)
+    client = app.test_client()
+    for name, url in (('state', f"/api/alerts/{nws.state}"), ('query', f"/api/alerts/{nws.state}/query?lat=35.1&lon=-97.5")):
+        samples = []
+        for _ in range(repeat):
+            seconds, response = _timed(lambda: client.get(url))
+            if response.status_code != 200:
+                raise RuntimeError(f"{url} returned {response.status_code}")
+            samples.append(seconds)
+        results[f'alerts_request_seconds/{name}'] = summarize(samples)
+    return results
+
+def compare(results, baseline, out=sys.stderr):
+    for name, summary in sorted(results['results'].items()):
+        before = baseline['results'].get(name)
+        if before is None or before['median'] == 0:
+            continue
+        change = summary['median'] / before['median'] - 1
+        print(f"{name}: {before['median']:.6g} -> {summary['median']:.6g} ({change:+.1%})", file=out)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the radar and alert pipelines offline")
+    parser.add_argument("--fixtures", default=os.path.join(tempfile.gettempdir(), "weather-dashboard", "bench"),
+                        help="Directory for the generated fixtures, reused between runs")
+    parser.add_argument("--station", default="KTLX")
+    parser.add_argument("--scans", type=int, default=5, help="Scans requested cold in the /api/radar benchmark")
+    parser.add_argument("--watcher-scans", type=int, default=3)
+    parser.add_argument("--alerts", type=int, default=40)
+    parser.add_argument("--zones-per-alert", type=int, default=25)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=2, help="Job worker threads")
+    parser.add_argument("--only", action="append", choices=["process", "radar", "watcher", "alerts"])
+    parser.add_argument("--output", help="Write the results here instead of stdout")
+    parser.add_argument("--compare", help="Results of an earlier run to compare against")
+    args = parser.parse_args()
+    only = set(args.only or ["process", "radar", "watcher", "alerts"])
+
+    run = tempfile.mkdtemp(prefix="weather-dashboard-bench-")
+    bucket = os.path.join(args.fixtures, "bucket")
+    nws = NWSServer(alerts=args.alerts, zones_per_alert=args.zones_per_alert).start()
+    # Read when the modules are imported
+    os.environ['NWS_API'] = nws.url
+    os.environ['VOLUME_STORE_DIR'] = os.path.join(run, "volumes")
+
+    from .. import radar
+    from ..jobs import get_queue
+    from ..volume_store import S3Source, VolumeStore
+
+    s3Client = LocalS3Client(bucket)
+    radar.s3Client = s3Client
+    radar.bucket = LocalBucket(bucket)
+    radar.volumeStore = VolumeStore(os.environ['VOLUME_STORE_DIR'], S3Source(s3Client, 'noaa-nexrad-level2'))
+
+    redis = fakeredis.FakeServer()
+    with mock.patch('redis.StrictRedis', return_value=fakeredis.FakeStrictRedis(server=redis)):
+        from .. import app as appmodule
+
+    stopping = threading.Event()
+    for _ in range(args.workers):
+        threading.Thread(target=get_queue(fake_cache(redis), radar.SCAN_JOBS).work, args=(radar.process_scan, stopping), daemon=True).start()
+
+    timestamps = scan_timestamps(datetime.datetime(2024, 5, 6, 23, 0, 0), args.scans)
+    keys = write_volumes(bucket, args.station, timestamps)
+
+    results = {}
+    try:
+        if "process" in only:
+            results.update(bench_process(os.path.join(bucket, keys[0]), args.repeat))
+        if "radar" in only:
+            results.update(bench_radar(appmodule.app, appmodule.cache, args.station, timestamps, args.repeat))
+        if "watcher" in only:
+            results.update(bench_watcher(fake_cache(redis), bucket, os.path.join(args.fixtures, "staging"), args.station, args.watcher_scans))
+        if "alerts" in only:
+            results.update(bench_alerts(appmodule.app, appmodule.cache, nws, args.repeat))
+    finally:
+        stopping.set()
+        nws.stop()
+        shutil.rmtree(run, ignore_errors=True)
+
+    output = {
+        'commit': _commit(),
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            compare(output, json.load(f))
+
+if __name__ == "__main__":
+    main()
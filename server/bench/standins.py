@@ -0,0 +1,163 @@
+# Local stand-ins for the services the server talks to, so the benchmarks run offline:
+# the noaa-nexrad-level2 bucket from a directory, the NWS API from a local HTTP server
+# and Redis from fakeredis.
+import email.utils
+import hashlib
+import http.server
+import os
+import shutil
+import threading
+import types
+
+import botocore.exceptions
+import fakeredis
+
+from ..cache import Cache
+from .fixtures import alerts_geojson, zone_geojson
+
+def _not_found(operation: str):
+    return botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'Not Found'}}, operation)
+
+# The directory's files as S3 objects, sorted by key like a listing
+def _list(root: str, prefix: str, start_after: str = None):
+    directory = os.path.join(root, os.path.dirname(prefix))
+    if not os.path.isdir(directory):
+        return []
+    keys = []
+    for current, _, files in os.walk(directory):
+        for name in files:
+            if name.endswith('.tmp'):
+                continue
+            key = os.path.relpath(os.path.join(current, name), root).replace(os.sep, '/')
+            if key.startswith(prefix) and (start_after is None or key > start_after):
+                keys.append(key)
+    return sorted(keys)
+
+class _Paginator:
+    def __init__(self, root: str):
+        self.root = root
+
+    def paginate(self, Bucket: str, Prefix: str = '', StartAfter: str = None):
+        keys = _list(self.root, Prefix, StartAfter)
+        # A thousand keys a page, like S3
+        for i in range(0, max(len(keys), 1), 1000):
+            yield {'Contents': [{'Key': key, 'Size': os.path.getsize(os.path.join(self.root, key))} for key in keys[i:i + 1000]]}
+
+# The parts of the boto3 S3 client the server uses
+class LocalS3Client:
+    def __init__(self, root: str):
+        self.root = root
+
+    def get_paginator(self, operation: str):
+        if operation != 'list_objects_v2':
+            raise ValueError(f"Unsupported operation: {operation}")
+        return _Paginator(self.root)
+
+    def download_fileobj(self, Bucket: str, Key: str, Fileobj):
+        path = os.path.join(self.root, Key)
+        if not os.path.exists(path):
+            raise _not_found('GetObject')
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, Fileobj)
+
+    def get_object(self, Bucket: str, Key: str):
+        path = os.path.join(self.root, Key)
+        if not os.path.exists(path):
+            raise _not_found('GetObject')
+        return {'Body': open(path, 'rb'), 'ContentLength': os.path.getsize(path)}
+
+# The parts of the boto3 Bucket resource the server uses
+class LocalBucket:
+    def __init__(self, root: str):
+        self.root = root
+        self.objects = types.SimpleNamespace(filter=self._filter)
+
+    def _filter(self, Prefix: str = ''):
+        return [types.SimpleNamespace(key=key) for key in _list(self.root, Prefix)]
+
+# Serves /alerts/active and /zones/{type}/{ugc} from the fixtures on a local port.
+# Alerts carry an ETag and Last-Modified and are answered with a 304 when unchanged.
+class NWSServer:
+    def __init__(self, state: str = 'OK', alerts: int = 40, zones_per_alert: int = 25):
+        self.state = state.upper()
+        self.alerts = alerts
+        self.zones_per_alert = zones_per_alert
+        self.requests = 0
+        self.not_modified = 0
+        self.lock = threading.Lock()
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.set_alerts(alerts_geojson(self.url, self.state, alerts, zones_per_alert))
+        self.thread = None
+
+    # Replaces the /alerts/active response, as when the NWS issues or cancels alerts, or
+    # fails with another status
+    def set_alerts(self, body: bytes, status: int = 200):
+        with self.lock:
+            self.status = status
+            self.body = body
+            self.etag = f'"{hashlib.sha1(body).hexdigest()}"'
+            self.last_modified = email.utils.formatdate(usegmt=True)
+
+    def _handler(self):
+        nws = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_alerts(self):
+                with nws.lock:
+                    status, body, etag, lastModified = nws.status, nws.body, nws.etag, nws.last_modified
+                if status == 200 and self.headers.get('If-None-Match') == etag:
+                    with nws.lock:
+                        nws.not_modified += 1
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/geo+json' if status == 200 else 'application/problem+json')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', lastModified)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                with nws.lock:
+                    nws.requests += 1
+                path = self.path.split('?')[0]
+                if path == '/alerts/active':
+                    self._send_alerts()
+                    return
+                if path.startswith('/zones/'):
+                    zoneType, ugc = path.rsplit('/', 2)[-2:]
+                    body = zone_geojson(ugc, zoneType)
+                else:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/geo+json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+# A Cache on its own in-memory Redis
+def fake_cache(server: fakeredis.FakeServer = None):
+    return Cache(client=fakeredis.FakeStrictRedis(server=server or fakeredis.FakeServer()))
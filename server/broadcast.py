@@ -0,0 +1,211 @@
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+
+import msgpack
+
+from .cache import Cache
+from .metrics import FANOUT_SECONDS
+from .packing import COMPRESSIONS
+from .radar import get_sweep, sweep_cache_key, ENCODINGS, MOMENTS, PRODUCTS
+
+# Frames waiting for a slow client. A newer scan of a sweep replaces the pending one,
+# so this only fills up with many sweeps subscribed.
+MAX_PENDING_FRAMES = 32
+# Sweeps that weren't cached when a scan came in are fetched on these threads, so
+# processing them doesn't hold up events for every other station
+FANOUT_WORKERS = int(os.getenv("FANOUT_WORKERS", 4))
+
+# What a client wants pushed, parsed from its subscribe message:
+# {"type": "subscribe", "sweeps": [0, 1], "moment": "REF", "encoding": "packed", "compression": "zstd"}
+def parse_subscription(message: str):
+    try:
+        data = json.loads(message)
+    except ValueError:
+        raise ValueError("Invalid message")
+    if not isinstance(data, dict):
+        raise ValueError("Invalid message")
+    if data.get('type') == 'unsubscribe':
+        return None
+    if data.get('type') != 'subscribe':
+        raise ValueError("Invalid message type")
+    sweeps = data.get('sweeps', [0])
+    if not isinstance(sweeps, list) or not all(isinstance(sweep, int) and sweep >= 0 for sweep in sweeps):
+        raise ValueError("Invalid sweeps")
+    moment = str(data.get('moment', 'REF')).upper()
+    if moment not in MOMENTS and moment not in PRODUCTS:
+        raise ValueError("Invalid moment")
+    if moment in PRODUCTS and set(sweeps) != {0}:
+        raise ValueError("Invalid sweeps")
+    encoding = data.get('encoding', 'packed')
+    if encoding not in ENCODINGS:
+        raise ValueError("Invalid encoding")
+    compression = data.get('compression')
+    if compression not in COMPRESSIONS or (compression is not None and encoding == 'msgpack'):
+        raise ValueError("Invalid compression")
+    return {'sweeps': sorted(set(sweeps)), 'moment': moment, 'encoding': encoding, 'compression': compression}
+
+# One connected client. Frames are queued by whoever has them and sent by the connection's
+# own thread, so a slow client only holds up itself.
+class Subscriber:
+    # Streams where every frame matters pass resync, which returns a frame the client can
+    # start over from, or None to disconnect it. It replaces everything pending when the
+    # client falls too far behind. Otherwise the oldest frames are dropped.
+    def __init__(self, resync=None):
+        self.subscription = None
+        self.resync = resync
+        self.resyncing = False
+        self.pending = collections.OrderedDict()
+        # Timestamp of the newest scan pushed for each key
+        self.timestamps = {}
+        self.dropped = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    # Frames of a scan older than one already pushed under the same key are ignored
+    def push(self, key, frame, timestamp: int = None):
+        with self.condition:
+            if self.closed:
+                return
+            if timestamp is not None:
+                if self.timestamps.get(key, timestamp) > timestamp:
+                    return
+                self.timestamps[key] = timestamp
+            if key in self.pending:
+                del self.pending[key]
+                self.dropped += 1
+            self.pending[key] = frame
+            if len(self.pending) > MAX_PENDING_FRAMES and self.resync is not None:
+                self.dropped += len(self.pending)
+                self.pending.clear()
+                self.resyncing = True
+            while len(self.pending) > MAX_PENDING_FRAMES:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+            self.condition.notify()
+
+    # Blocks until there is a frame to send, returns None once closed
+    def next(self):
+        with self.condition:
+            while len(self.pending) == 0 and not self.closed and not self.resyncing:
+                self.condition.wait()
+            if self.closed:
+                return None
+            if not self.resyncing:
+                return self.pending.popitem(last=False)[1]
+            # Anything queued so far is older than the frame we're about to start over from
+            self.resyncing = False
+            self.pending.clear()
+        frame = self.resync()
+        if frame is None:
+            self.close()
+        return frame
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.pending.clear()
+            self.condition.notify_all()
+
+# Fans scans out to the clients watching each station. Subscribed clients get each
+# sweep as a binary frame, packed once per scan however many clients want it. Everyone
+# else gets the original {"station", "timestamp"} notification.
+class StationHub:
+    def __init__(self, cache: Cache, watcher):
+        self.cache = cache
+        self.watcher = watcher
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(FANOUT_WORKERS, thread_name_prefix='fanout')
+
+    # The station is watched while anyone is here, ValueError if it isn't a radar
+    def join(self, station: str, subscriber: Subscriber):
+        station = station.upper()
+        self.watcher.start(station)
+        with self.lock:
+            if station not in self.subscribers:
+                self.subscribers[station] = set()
+                self.watcher.add_event_listener(self._on_scan, station)
+            self.subscribers[station].add(subscriber)
+
+    def leave(self, station: str, subscriber: Subscriber):
+        subscriber.close()
+        with self.lock:
+            self.subscribers.get(station.upper(), set()).discard(subscriber)
+        self.watcher.stop(station.upper())
+        if subscriber.dropped > 0:
+            logging.info(f"Dropped {subscriber.dropped} frames for a slow client on {station}")
+
+    def subscribe(self, station: str, subscriber: Subscriber, subscription):
+        subscriber.subscription = subscription
+        # Start the client off with the newest scan rather than waiting for the next one
+        timestamp = self.watcher.latest(station.upper())
+        if subscription is not None and timestamp is not None:
+            for sweep in subscription['sweeps']:
+                frame = self._frame(station.upper(), sweep, subscription, timestamp)
+                if frame is not None:
+                    subscriber.push(('scan', sweep), frame, timestamp)
+
+    def _frame(self, station: str, sweep: int, subscription, timestamp: int):
+        packed = get_sweep(self.cache, station, sweep, subscription['moment'], timestamp, subscription['encoding'], subscription['compression'])
+        if packed is None:
+            return None
+        return self._pack_frame(station, sweep, subscription, timestamp, packed)
+
+    def _pack_frame(self, station: str, sweep: int, subscription, timestamp: int, packed):
+        return msgpack.packb({
+            'station': station,
+            'sweep': sweep,
+            'moment': subscription['moment'],
+            'timestamp': timestamp,
+            'encoding': subscription['encoding'],
+            'compression': subscription['compression'],
+            'payload': packed,
+        })
+
+    def _on_scan(self, station: str, timestamp: int):
+        with FANOUT_SECONDS.time():
+            self._fan_out(station, timestamp)
+
+    # Runs on the event thread, so only sweeps that are already cached are pushed from
+    # here. The rest are processed on the executor and pushed when they are ready.
+    def _fan_out(self, station: str, timestamp: int):
+        with self.lock:
+            subscribers = list(self.subscribers.get(station, ()))
+        notification = json.dumps({"station": station, "timestamp": timestamp})
+        wanted = {}
+        for subscriber in subscribers:
+            subscription = subscriber.subscription
+            if subscription is None:
+                subscriber.push(('notify',), notification)
+                continue
+            for sweep in subscription['sweeps']:
+                key = (sweep, subscription['moment'], subscription['encoding'], subscription['compression'])
+                wanted.setdefault(key, (sweep, subscription, []))[2].append(subscriber)
+        if len(wanted) == 0:
+            return
+
+        cached = self.cache.get_many([sweep_cache_key(station, sweep, subscription['moment'], timestamp, subscription['encoding'], subscription['compression'])
+                                      for sweep, subscription, _ in wanted.values()])
+        for (sweep, subscription, targets), packed in zip(wanted.values(), cached):
+            if packed is None:
+                self.executor.submit(self._fetch_and_push, station, sweep, subscription, timestamp, targets)
+                continue
+            frame = self._pack_frame(station, sweep, subscription, timestamp, packed)
+            for subscriber in targets:
+                subscriber.push(('scan', sweep), frame, timestamp)
+
+    def _fetch_and_push(self, station: str, sweep: int, subscription, timestamp: int, subscribers):
+        try:
+            frame = self._frame(station, sweep, subscription, timestamp)
+        except Exception as e:
+            logging.info(f"Error packing sweep for subscribers: {repr(e)}")
+            print(f"Error packing sweep for subscribers: {repr(e)}")
+            return
+        if frame is None:
+            return
+        for subscriber in subscribers:
+            subscriber.push(('scan', sweep), frame, timestamp)
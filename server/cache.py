@@ -1,22 +1,303 @@
+import collections
+import concurrent.futures
 import datetime
+import json
+import logging
+import os
+import threading
+import time
+import uuid
 
 import redis
 
+from .metrics import CACHE_REQUESTS, CACHE_L1_EVICTIONS
+
+DEFAULT_EXPIRATION = datetime.timedelta(hours=1)
+# Requests and the watcher share the pool, and block for a connection once it is used up
+MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 32))
+CONNECTION_TIMEOUT = 10
+# In-process copies of recently read values, in front of redis
+L1_MAX_BYTES = int(os.getenv("CACHE_L1_MAX_BYTES", 256 * 1024 ** 2))
+# Local copies follow the redis expiry, but are never trusted for longer than this in
+# case an invalidation message was missed
+L1_MAX_TTL = 300
+INVALIDATION_CHANNEL = "cache/invalidate"
+
+# Byte budgeted LRU of values read from redis
+class LocalCache:
+    def __init__(self, max_bytes: int = L1_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Bumped on every invalidation, so a read that raced a write isn't stored
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def has(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and entry[1] >= time.monotonic()
+
+    def put(self, key: str, value, ttl: int, generation: int):
+        # ttl is the redis PTTL in milliseconds, -1 for keys without an expiry
+        if value is None or len(value) > self.max_bytes // 4:
+            return
+        ttl = L1_MAX_TTL if ttl < 0 else min(ttl / 1000, L1_MAX_TTL)
+        with self.lock:
+            if generation != self.generation:
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+                CACHE_L1_EVICTIONS.inc()
+
+    def _remove(self, key: str):
+        value, _ = self.entries.pop(key)
+        self.size -= len(value)
+
+    def invalidate(self, keys):
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                if key in self.entries:
+                    self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.size,
+            }
+
 class Cache:
-    def __init__(self):
-        self.cache = redis.StrictRedis(host='localhost', port=6379, db=0)
+    def __init__(self, client=None, l1_max_bytes: int = L1_MAX_BYTES):
+        if client is None:
+            self.pool = redis.BlockingConnectionPool(host='localhost', port=6379, db=0, max_connections=MAX_CONNECTIONS, timeout=CONNECTION_TIMEOUT)
+            client = redis.StrictRedis(connection_pool=self.pool)
+        self.cache = client
+        self.local = LocalCache(l1_max_bytes)
+        self.id = uuid.uuid4().hex
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.subscriber = None
+        if l1_max_bytes > 0:
+            self._subscribe()
+
+    def _subscribe(self):
+        # Writes from other workers drop our local copies of the keys they wrote
+        pubsub = self.cache.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{INVALIDATION_CHANNEL: self._on_invalidate})
+        self.subscriber = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def _on_invalidate(self, message):
+        try:
+            data = json.loads(message['data'])
+        except ValueError:
+            logging.info(f"Invalid cache invalidation message: {message['data']}")
+            return
+        if data.get('sender') != self.id:
+            self.local.invalidate(data['keys'])
+
+    def _publish(self, pipe, keys):
+        pipe.publish(INVALIDATION_CHANNEL, json.dumps({'sender': self.id, 'keys': keys}))
+
+    def close(self):
+        if self.subscriber is not None:
+            self.subscriber.stop()
+            self.subscriber = None
+
+    def stats(self):
+        return self.local.stats()
+
+    def _fetch(self, keys):
+        # Values and their remaining time to live from redis, stored locally on the way through
+        generation = self.local.generation
+        pipe = self.cache.pipeline(transaction=False)
+        for key in keys:
+            pipe.get(key)
+            pipe.pttl(key)
+        results = pipe.execute()
+        values = results[0::2]
+        for key, value, ttl in zip(keys, values, results[1::2]):
+            self.local.put(key, value, ttl, generation)
+        return values
 
     def get(self, key: str):
-        return self.cache.get(key.upper())
+        return self.get_many([key])[0]
 
-    def set(self, key: str, value, expiration: datetime.timedelta = datetime.timedelta(hours=1)):
-        return self.cache.set(key.upper(), value, expiration)
+    def set(self, key: str, value, expiration: datetime.timedelta = DEFAULT_EXPIRATION):
+        return self.set_many({key: value}, expiration)[0]
 
     def delete(self, key: str):
-        return self.cache.delete(key.upper())
+        key = key.upper()
+        pipe = self.cache.pipeline(transaction=False)
+        pipe.delete(key)
+        self._publish(pipe, [key])
+        result = pipe.execute()[0]
+        self.local.invalidate([key])
+        return result
 
     def keys(self):
         return self.cache.keys()
-    
+
     def has(self, key: str):
-        return self.cache.exists(key.upper())
+        return self.has_many([key])[0]
+
+    # Values for every key in one round trip, None for the missing ones
+    def get_many(self, keys):
+        keys = [key.upper() for key in keys]
+        values = [self.local.get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        if self.local.max_bytes > 0:
+            CACHE_REQUESTS.labels('l1', 'hit').inc(len(keys) - len(missing))
+            CACHE_REQUESTS.labels('l1', 'miss').inc(len(missing))
+        if len(missing) > 0:
+            fetched = self._fetch([keys[i] for i in missing])
+            for i, value in zip(missing, fetched):
+                values[i] = value
+            hits = sum(value is not None for value in fetched)
+            CACHE_REQUESTS.labels('redis', 'hit').inc(hits)
+            CACHE_REQUESTS.labels('redis', 'miss').inc(len(fetched) - hits)
+        return values
+
+    def has_many(self, keys):
+        keys = [key.upper() for key in keys]
+        exists = [self.local.has(key) for key in keys]
+        missing = [i for i, value in enumerate(exists) if not value]
+        if len(missing) > 0:
+            pipe = self.cache.pipeline(transaction=False)
+            for i in missing:
+                pipe.exists(keys[i])
+            for i, value in zip(missing, pipe.execute()):
+                exists[i] = bool(value)
+        return exists
+
+    def set_many(self, mapping: dict, expiration: datetime.timedelta = DEFAULT_EXPIRATION):
+        if len(mapping) == 0:
+            return []
+        keys = [key.upper() for key in mapping]
+        pipe = self.cache.pipeline(transaction=False)
+        for key, value in zip(keys, mapping.values()):
+            pipe.set(key, value, expiration)
+        self._publish(pipe, keys)
+        results = pipe.execute()[:-1]
+        self.local.invalidate(keys)
+        return results
+
+    # Cached value for key, otherwise the result of compute(), which is cached unless it is None.
+    # Concurrent misses on the same key in this process wait on the one compute.
+    def get_or_compute(self, key: str, compute, expiration: datetime.timedelta = DEFAULT_EXPIRATION):
+        value = self.get(key)
+        if value is not None:
+            return value
+        key = key.upper()
+        with self.lock:
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self.inflight[key] = future
+        if not owner:
+            return future.result()
+
+        try:
+            # Another compute may have finished between the miss and taking its place
+            value = self.get(key)
+            if value is None:
+                value = compute()
+                if value is not None:
+                    self.set(key, value, expiration)
+        except BaseException as e:
+            with self.lock:
+                del self.inflight[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            del self.inflight[key]
+        future.set_result(value)
+        return value
+
+    def publish(self, channel: str, message):
+        return self.cache.publish(channel, message)
+
+    # Calls handler with every message on the channel from a background thread
+    def subscribe(self, channel: str, handler):
+        pubsub = self.cache.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{channel: handler})
+        return pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    # A lock held by owner until it expires, unless it is renewed first
+    def acquire_lock(self, key: str, owner: str, expiration: datetime.timedelta):
+        return bool(self.cache.set(key.upper(), owner, px=expiration, nx=True))
+
+    def renew_lock(self, key: str, owner: str, expiration: datetime.timedelta):
+        return self._if_lock_owner(key, owner, lambda pipe, key: pipe.pexpire(key, expiration))
+
+    def release_lock(self, key: str, owner: str):
+        return self._if_lock_owner(key, owner, lambda pipe, key: pipe.delete(key))
+
+    # Only the lock's owner may extend or release it, checked and applied in one transaction
+    def _if_lock_owner(self, key: str, owner: str, command):
+        key = key.upper()
+        with self.cache.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.get(key) != owner.encode():
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                command(pipe, key)
+                return bool(pipe.execute()[0])
+            except redis.WatchError:
+                return False
+
+    def zadd(self, key: str, mapping: dict, max_size: int = None):
+        key = key.upper()
+        pipe = self.cache.pipeline()
+        pipe.zadd(key, mapping)
+        # Keep only the max_size highest scoring members
+        if max_size is not None:
+            pipe.zremrangebyrank(key, 0, -(max_size + 1))
+        return pipe.execute()[0]
+
+    def zrevrange(self, key: str, start: int, end: int):
+        return self.cache.zrevrange(key.upper(), start, end)
+
+    def zrangebyscore(self, key: str, min, max):
+        return self.cache.zrangebyscore(key.upper(), min, max)
+
+    def zscore(self, key: str, member):
+        return self.cache.zscore(key.upper(), member)
+
+    def zremrangebyscore(self, key: str, min, max):
+        return self.cache.zremrangebyscore(key.upper(), min, max)
@@ -0,0 +1,183 @@
+import collections
+import json
+import logging
+import threading
+import time
+
+from .cache import Cache
+from .nws import ALERT_AREAS
+from .radar import RADAR_STATIONS
+from .scan_index import ScanIndex
+
+# The worker publishes what its watchers see on these channels for the web workers
+RADAR_CHANNEL = "events/radar"
+ALERT_CHANNEL = "events/alerts"
+# Stations and states clients need, scored by when a web worker last said so. The worker
+# watches everything seen within WATCH_EXPIRATION and prunes the rest.
+WATCHED_STATIONS = "watching/stations"
+WATCHED_STATES = "watching/states"
+WATCH_HEARTBEAT = 60
+WATCH_EXPIRATION = 3 * WATCH_HEARTBEAT
+
+def publish_event(cache: Cache, channel: str, key: str, *args):
+    cache.publish(channel, json.dumps({'key': key, 'args': args}))
+
+# Members of a watch set seen recently enough, dropping the others from it
+def watched(cache: Cache, key: str):
+    cache.zremrangebyscore(key, '-inf', time.time() - WATCH_EXPIRATION)
+    return {member.decode() for member in cache.zrangebyscore(key, '-inf', '+inf')}
+
+# What this process's clients need from a watch set. Codes are counted while clients are
+# connected and heartbeated for as long as any are, one-off requests refresh them once.
+class WatchList:
+    def __init__(self, cache: Cache, key: str, known):
+        self.cache = cache
+        self.key = key
+        self.known = known
+        self.counts = collections.Counter()
+        self.touched = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(WATCH_HEARTBEAT)
+            with self.lock:
+                codes = list(self.counts)
+            for code in codes:
+                self.touch(code, force=True)
+
+    def touch(self, code: str, force: bool = False):
+        code = code.upper()
+        if code not in self.known:
+            raise ValueError(f"Unknown code {code}")
+        now = time.time()
+        with self.lock:
+            if not force and now - self.touched.get(code, 0) < WATCH_HEARTBEAT:
+                return
+            self.touched[code] = now
+        self.cache.zadd(self.key, {code: now})
+
+    def acquire(self, code: str):
+        code = code.upper()
+        self.touch(code, force=True)
+        with self.lock:
+            self.counts[code] += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._heartbeat, daemon=True)
+                self.thread.start()
+
+    def release(self, code: str):
+        code = code.upper()
+        with self.lock:
+            self.counts[code] -= 1
+            if self.counts[code] <= 0:
+                del self.counts[code]
+
+    def is_watched(self, code: str):
+        score = self.cache.zscore(self.key, code.upper())
+        return score is not None and score >= time.time() - WATCH_EXPIRATION
+
+# Listeners for the events on a channel, registered per key like the watchers' own listeners
+class EventBus:
+    def __init__(self, cache: Cache, channel: str):
+        self.eventListeners = {}
+        self.lock = threading.Lock()
+        self.subscriber = cache.subscribe(channel, self._on_message)
+
+    def _on_message(self, message):
+        try:
+            data = json.loads(message['data'])
+        except ValueError:
+            logging.info(f"Invalid event: {message['data']}")
+            return
+        with self.lock:
+            listeners = self.eventListeners.get(data['key'], []) + self.eventListeners.get('*', [])
+        for listener in listeners:
+            try:
+                listener(data['key'], *data['args'])
+            except Exception as e:
+                logging.info(f"Error notifying listener: {repr(e)}")
+                print(f"Error notifying listener: {repr(e)}")
+
+    def add_event_listener(self, listener, key: str = '*'):
+        key = key.upper()
+        with self.lock:
+            if listener not in self.eventListeners.setdefault(key, []):
+                self.eventListeners[key].append(listener)
+
+    def remove_event_listener(self, listener, key: str = '*'):
+        key = key.upper()
+        with self.lock:
+            if listener in self.eventListeners.get(key, []):
+                self.eventListeners[key].remove(listener)
+
+    def close(self):
+        self.subscriber.stop()
+
+# The RadarWatcher as seen from a web worker. Starting a station asks the leader to watch it
+# until it is stopped as many times, stations that aren't radars raise ValueError.
+class RemoteRadarWatcher:
+    def __init__(self, cache: Cache):
+        self.cache = cache
+        self.scanIndex = ScanIndex(cache)
+        self.events = EventBus(cache, RADAR_CHANNEL)
+        self.watching = WatchList(cache, WATCHED_STATIONS, RADAR_STATIONS)
+        self.timestamps = dict()
+        self.events.add_event_listener(self._on_scan)
+
+    def _on_scan(self, station: str, timestamp: int):
+        self.timestamps[station] = max(timestamp, self.timestamps.get(station, 0))
+
+    def is_watching(self, station: str):
+        return self.watching.is_watched(station)
+
+    def start(self, station: str):
+        self.watching.acquire(station)
+
+    def stop(self, station: str):
+        self.watching.release(station)
+
+    def latest(self, station: str):
+        station = station.upper()
+        if station in self.timestamps:
+            return self.timestamps[station]
+        try:
+            return self.scanIndex.latest(station)
+        except ValueError:
+            return None
+
+    def add_event_listener(self, listener, station: str = '*'):
+        self.events.add_event_listener(listener, station)
+
+    def remove_event_listener(self, listener, station: str = '*'):
+        self.events.remove_event_listener(listener, station)
+
+# The AlertWatcher as seen from a web worker, reading the snapshots the leader keeps. Alert
+# sockets start and stop their state like RemoteRadarWatcher's stations.
+class RemoteAlertWatcher:
+    def __init__(self, cache: Cache):
+        self.cache = cache
+        self.events = EventBus(cache, ALERT_CHANNEL)
+        self.watching = WatchList(cache, WATCHED_STATES, ALERT_AREAS)
+
+    def is_watching(self, state: str):
+        return self.watching.is_watched(state)
+
+    def start(self, state: str):
+        self.watching.acquire(state)
+
+    def stop(self, state: str):
+        self.watching.release(state)
+
+    # Serialized list of active alerts, or None until the leader has polled the state. Either
+    # way the state stays watched for a while, ValueError if it isn't an alert area.
+    def snapshot(self, state: str):
+        self.watching.touch(state)
+        return self.cache.get(f"alerts/{state.upper()}")
+
+    def add_event_listener(self, listener, state: str = '*'):
+        self.events.add_event_listener(listener, state)
+
+    def remove_event_listener(self, listener, state: str = '*'):
+        self.events.remove_event_listener(listener, state)
@@ -0,0 +1,128 @@
+import hashlib
+
+import msgpack
+import numpy as np
+
+from .packing import pack_array, unpack_array
+
+# Spherical earth, the same model the frontend's great-circle-cursor uses
+EARTH_RADIUS = 6371008.8
+
+# Site geometry rarely changes, so vertex grids are kept until evicted
+GRID_EXPIRATION = None
+
+# Level of detail for a map zoom from a table of (highest zoom, level), closest in first.
+# Zooms past the table, or no zoom at all, get full detail.
+def detail_for_zoom(zoom: int, zoom_detail):
+    if zoom is None:
+        return 'full'
+    for maxZoom, detail in zoom_detail:
+        if zoom <= maxZoom:
+            return detail
+    return 'full'
+
+# Sweeps are normally evenly spaced around the circle. Snapping azimuth edges that are
+# within a quarter ray of that even spacing lets every scan of a tilt share one grid.
+def nominal_az_edges(az):
+    n = len(az) - 1
+    spacing = 360. / n
+    nominal = np.round(az[0] / spacing) * spacing + spacing * np.arange(n + 1)
+    if np.abs(az - nominal).max() <= spacing / 4:
+        return nominal
+    return np.round(az, 2)
+
+def grid_id(sweep):
+    az = np.ascontiguousarray(nominal_az_edges(sweep['az']), dtype='<f4')
+    rng = np.ascontiguousarray(sweep['ref_range'], dtype='<f4')
+    return hashlib.sha1(az.tobytes()).hexdigest()[:16], hashlib.sha1(rng.tobytes()).hexdigest()[:16]
+
+def grid_key(station: str, az_hash: str, range_hash: str):
+    return f"grid/{station.upper()}/{az_hash}/{range_hash}"
+
+# Great circle destination from the radar site for every azimuth and range pair
+def polar_to_lonlat(cent_lon, cent_lat, az, rng):
+    lat1 = np.deg2rad(cent_lat)
+    lon1 = np.deg2rad(cent_lon)
+    theta = np.deg2rad(az)[:, None]
+    delta = (np.asarray(rng) / EARTH_RADIUS)[None, :]
+    sin_lat2 = np.sin(lat1) * np.cos(delta) + np.cos(lat1) * np.sin(delta) * np.cos(theta)
+    lat2 = np.arcsin(sin_lat2)
+    lon2 = lon1 + np.arctan2(np.sin(theta) * np.sin(delta) * np.cos(lat1), np.cos(delta) - np.sin(lat1) * sin_lat2)
+    return np.rad2deg(lon2), np.rad2deg(lat2)
+
+# Inverse of polar_to_lonlat, the azimuth and great circle distance of each point from the radar site
+def lonlat_to_polar(cent_lon, cent_lat, lon, lat):
+    lat1 = np.deg2rad(cent_lat)
+    lat2 = np.deg2rad(lat)
+    dlon = np.deg2rad(lon - cent_lon)
+    az = np.rad2deg(np.arctan2(np.sin(dlon) * np.cos(lat2), np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon))) % 360.
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    rng = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+    return az, rng
+
+# Azimuth arc (start, width) and range interval of a west, south, east, north box seen from
+# the radar site, from points along its edges. The arc is the whole circle when the site is
+# inside the box.
+def polar_bounds(cent_lon, cent_lat, bbox, samples: int = 64):
+    west, south, east, north = bbox
+    t = np.linspace(0., 1., samples, endpoint=False)
+    lon = np.concatenate((west + (east - west) * t, np.full(samples, east), east - (east - west) * t, np.full(samples, west)))
+    lat = np.concatenate((np.full(samples, south), south + (north - south) * t, np.full(samples, north), north - (north - south) * t))
+    az, rng = lonlat_to_polar(cent_lon, cent_lat, lon, lat)
+    if west <= cent_lon <= east and south <= cent_lat <= north:
+        return 0., 360., 0., rng.max()
+    # The box covers everything but the widest gap between the azimuths of its edges
+    az = np.sort(az)
+    gaps = np.diff(np.concatenate((az, [az[0] + 360.])))
+    widest = np.argmax(gaps)
+    return az[(widest + 1) % len(az)], 360. - gaps[widest], rng.min(), rng.max()
+
+# Flat index into a sweep's (ray, gate) data for points at the given azimuths and ranges.
+# Points outside the sweep get num_rays * num_gates, one past the end of the data.
+def gate_index(az_edges, range_edges, az, rng):
+    # Azimuth edges run from about 0 to 360 degrees, so wrap points onto the first or last ray
+    az = np.where(az >= az_edges[-1], az - 360., az)
+    az = np.where(az < az_edges[0], az + 360., az)
+    ray = np.searchsorted(az_edges, az, side='right') - 1
+    gate = np.searchsorted(range_edges, rng, side='right') - 1
+    num_rays = len(az_edges) - 1
+    num_gates = len(range_edges) - 1
+    inside = (ray >= 0) & (ray < num_rays) & (gate >= 0) & (gate < num_gates)
+    return np.where(inside, ray * num_gates + gate, num_rays * num_gates).astype(np.int32)
+
+def make_grid(sweep, compression=None):
+    az_hash, range_hash = grid_id(sweep)
+    lon, lat = polar_to_lonlat(sweep['cent_lon'], sweep['cent_lat'], nominal_az_edges(sweep['az']), sweep['ref_range'])
+    return msgpack.packb(
+        {
+        'az_hash': az_hash,
+        'range_hash': range_hash,
+        'cent_lon': sweep['cent_lon'],
+        'cent_lat': sweep['cent_lat'],
+        'lon': pack_array(lon, '<f4', compression),
+        'lat': pack_array(lat, '<f4', compression),
+        }
+    )
+
+# Sweeps in a volume mostly share a few grids, so check them all in one round trip
+def store_grids(cache, station: str, sweeps):
+    grids = {grid_key(station, *grid_id(sweep)): sweep for sweep in sweeps}
+    stored = cache.has_many(list(grids.keys()))
+    cache.set_many({key: make_grid(sweep) for (key, sweep), exists in zip(grids.items(), stored) if not exists}, GRID_EXPIRATION)
+
+def get_grid(cache, station: str, az_hash: str, range_hash: str, compression=None):
+    key = grid_key(station, az_hash, range_hash)
+    if compression is None:
+        return cache.get(key)
+    packed = cache.get(f"{key}+{compression}")
+    if packed is None:
+        # Only grids that have been stored from a processed sweep exist
+        base = cache.get(key)
+        if base is None:
+            return None
+        grid = msgpack.unpackb(base)
+        for field in ('lon', 'lat'):
+            grid[field] = pack_array(unpack_array(grid[field]), '<f4', compression)
+        packed = msgpack.packb(grid)
+        cache.set(f"{key}+{compression}", packed, GRID_EXPIRATION)
+    return packed
@@ -0,0 +1,15 @@
+import multiprocessing
+import os
+
+# Web workers hold no watcher state, so they scale with the cores. gevent keeps the
+# long lived WebSocket connections cheap.
+bind = os.getenv("BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gevent"
+worker_connections = 1000
+timeout = 120
+
+# With PROMETHEUS_MULTIPROC_DIR set, every worker's metrics are added up at /metrics
+def child_exit(server, worker):
+    from server.metrics import mark_process_dead
+    mark_process_dead(worker.pid)
@@ -0,0 +1,237 @@
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from .cache import Cache
+from .metrics import mark_process_dead, JOB_SECONDS, JOB_WAIT_SECONDS
+
+# Lower runs first. Clients waiting on a cache miss go ahead of the watcher's prefetching.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_PREFETCH = 1
+# A claimed job that isn't acknowledged in this long is assumed lost with its worker and
+# handed out again, up to MAX_ATTEMPTS times
+JOB_VISIBILITY = 120
+MAX_ATTEMPTS = 3
+# How long a requester waits on a job
+JOB_TIMEOUT = 300
+# How long an idle worker blocks for new jobs before checking whether it should stop
+IDLE_POLL = 1
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", os.cpu_count() or 1))
+
+_queues = {}
+_queuesLock = threading.Lock()
+
+# A Redis backed work queue shared by every process. Jobs are JSON objects, identical jobs
+# are only queued or run once at a time, and everyone waiting on one is told when it is done.
+#
+# Keys, uppercased like the Cache's own:
+#   jobs/{name}/queue       sorted set of queued jobs, scored by priority then age
+#   jobs/{name}/processing  sorted set of claimed jobs, scored by when they expire
+#   jobs/{name}/attempts    hash of how often each job was claimed
+#   jobs/{name}/ready       list the idle workers block on
+#   jobs/{name}/done        channel completions are published on
+class JobQueue:
+    def __init__(self, cache: Cache, name: str):
+        self.cache = cache
+        self.name = name
+        # The queue needs transactions over several keys, so it talks to redis directly
+        self.redis = cache.cache
+        self.queueKey = f"jobs/{name}/queue".upper()
+        self.processingKey = f"jobs/{name}/processing".upper()
+        self.attemptsKey = f"jobs/{name}/attempts".upper()
+        self.readyKey = f"jobs/{name}/ready".upper()
+        self.doneChannel = f"jobs/{name}/done"
+        self.waiters = {}
+        self.lock = threading.Lock()
+        self.subscriber = None
+
+    def _on_done(self, message):
+        try:
+            data = json.loads(message['data'])
+        except ValueError:
+            logging.info(f"Invalid job completion: {message['data']}")
+            return
+        with self.lock:
+            futures = self.waiters.pop(data['job'], [])
+        for future in futures:
+            if data['error'] is None:
+                future.set_result(None)
+            elif data['kind'] == 'ValueError':
+                future.set_exception(ValueError(data['error']))
+            else:
+                future.set_exception(RuntimeError(data['error']))
+
+    def _enqueue(self, member: str, priority: int):
+        def enqueue(pipe):
+            # Already running, whoever asked again is told when that finishes
+            if pipe.zscore(self.processingKey, member) is not None:
+                return False
+            pipe.multi()
+            # A job queued again keeps its place, or moves up if it is wanted sooner
+            pipe.zadd(self.queueKey, {member: priority * 1e10 + time.time()}, lt=True)
+            pipe.rpush(self.readyKey, 1)
+            pipe.ltrim(self.readyKey, -JOB_WORKERS * 4, -1)
+            return True
+        return self.redis.transaction(enqueue, self.processingKey, value_from_callable=True)
+
+    # Queues job and returns a Future that is resolved once a worker has run it
+    def submit(self, job, priority: int = PRIORITY_PREFETCH):
+        member = json.dumps(job, sort_keys=True, separators=(',', ':'))
+        future = concurrent.futures.Future()
+        with self.lock:
+            # Listening before queueing, so the completion can't be missed
+            if self.subscriber is None:
+                self.subscriber = self.cache.subscribe(self.doneChannel, self._on_done)
+            self.waiters.setdefault(member, []).append(future)
+        try:
+            self._enqueue(member, priority)
+        except BaseException:
+            self._forget(member, future)
+            raise
+        future.member = member
+        return future
+
+    def _forget(self, member: str, future):
+        with self.lock:
+            if future in self.waiters.get(member, []):
+                self.waiters[member].remove(future)
+                if len(self.waiters[member]) == 0:
+                    del self.waiters[member]
+
+    # Runs job on the workers and blocks until it is done. Errors raised by the job are
+    # raised here, ValueErrors as ValueErrors.
+    def wait(self, job, priority: int = PRIORITY_PREFETCH, timeout: float = JOB_TIMEOUT):
+        future = self.submit(job, priority)
+        try:
+            with JOB_WAIT_SECONDS.labels(self.name).time():
+                return future.result(timeout)
+        finally:
+            self._forget(future.member, future)
+
+    def _claim(self):
+        def claim(pipe):
+            members = pipe.zrange(self.queueKey, 0, 0)
+            if len(members) == 0:
+                return None
+            attempts = int(pipe.hget(self.attemptsKey, members[0]) or 0) + 1
+            pipe.multi()
+            pipe.zrem(self.queueKey, members[0])
+            pipe.zadd(self.processingKey, {members[0]: time.time() + JOB_VISIBILITY})
+            pipe.hset(self.attemptsKey, members[0], attempts)
+            return members[0].decode(), attempts
+        return self.redis.transaction(claim, self.queueKey, value_from_callable=True)
+
+    def _requeue_expired(self):
+        def requeue(pipe):
+            expired = pipe.zrangebyscore(self.processingKey, 0, time.time())
+            if len(expired) == 0:
+                return 0
+            pipe.multi()
+            pipe.zrem(self.processingKey, *expired)
+            # Ahead of everything else, someone has been waiting on these a while
+            pipe.zadd(self.queueKey, {member: 0 for member in expired})
+            return len(expired)
+        requeued = self.redis.transaction(requeue, self.processingKey, value_from_callable=True)
+        if requeued > 0:
+            logging.info(f"Requeued {requeued} expired jobs from {self.queueKey}")
+
+    def _ack(self, member: str, error: Exception = None):
+        pipe = self.redis.pipeline()
+        pipe.zrem(self.processingKey, member)
+        pipe.hdel(self.attemptsKey, member)
+        pipe.publish(self.doneChannel, json.dumps({
+            'job': member,
+            'error': None if error is None else str(error),
+            'kind': None if error is None else type(error).__name__,
+        }))
+        pipe.execute()
+
+    # Runs handler(cache, job) for each job until stopping is set
+    def work(self, handler, stopping):
+        while not stopping.is_set():
+            try:
+                self._requeue_expired()
+                claimed = self._claim()
+                if claimed is None:
+                    self.redis.blpop([self.readyKey], IDLE_POLL)
+                    continue
+            except Exception as e:
+                logging.info(f"Error claiming job: {repr(e)}")
+                print(f"Error claiming job: {repr(e)}")
+                stopping.wait(IDLE_POLL)
+                continue
+
+            member, attempts = claimed
+            if attempts > MAX_ATTEMPTS:
+                self._ack(member, RuntimeError(f"Job failed after {MAX_ATTEMPTS} attempts"))
+                continue
+            timeStart = time.monotonic()
+            error = None
+            try:
+                handler(self.cache, json.loads(member))
+            except Exception as e:
+                logging.info(f"Error running job {member}: {repr(e)}")
+                print(f"Error running job {member}: {repr(e)}")
+                error = e
+            JOB_SECONDS.labels(self.name, 'ok' if error is None else 'error').observe(time.monotonic() - timeStart)
+            try:
+                self._ack(member, error)
+            except Exception as e:
+                # Unacknowledged, so it runs again once it expires
+                logging.info(f"Error acknowledging job {member}: {repr(e)}")
+                print(f"Error acknowledging job {member}: {repr(e)}")
+            logging.info(f"Job {member} took {time.monotonic() - timeStart:.2f}s")
+
+# The queue for name on this cache, shared by everything in the process using it
+def get_queue(cache: Cache, name: str):
+    with _queuesLock:
+        if (id(cache), name) not in _queues:
+            _queues[(id(cache), name)] = JobQueue(cache, name)
+        return _queues[(id(cache), name)]
+
+def _run_worker(name: str, handler, stopping):
+    logging.basicConfig(level=logging.INFO)
+    cache = Cache()
+    try:
+        get_queue(cache, name).work(handler, stopping)
+    finally:
+        cache.close()
+
+# Worker processes running the jobs on a queue, so CPU bound jobs run in parallel
+# across cores instead of taking turns on the GIL
+class JobPool:
+    def __init__(self, name: str, handler, workers: int = JOB_WORKERS):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.context = multiprocessing.get_context('spawn')
+        self.stopping = None
+        self.processes = []
+
+    def start(self):
+        self.stopping = self.context.Event()
+        self.processes = [
+            self.context.Process(target=_run_worker, args=(self.name, self.handler, self.stopping), daemon=True)
+            for _ in range(self.workers)
+        ]
+        for process in self.processes:
+            process.start()
+        logging.info(f"Started {self.workers} workers for the {self.name} jobs")
+
+    def stop(self):
+        if self.stopping is None:
+            return
+        self.stopping.set()
+        # Workers finish the job they are on, anything longer is picked up again elsewhere
+        deadline = time.monotonic() + JOB_VISIBILITY
+        for process in self.processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                process.terminate()
+            mark_process_dead(process.pid)
+        self.processes = []
+        self.stopping = None
@@ -0,0 +1,108 @@
+import contextlib
+import contextvars
+import logging
+import os
+import time
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, start_http_server, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+
+# Under gunicorn and the job pool every process records its own metrics. With
+# PROMETHEUS_MULTIPROC_DIR set they are written there and added up when scraped.
+MULTIPROCESS = 'PROMETHEUS_MULTIPROC_DIR' in os.environ
+# Trace every request, not only the ones sent with an X-Trace header
+TRACE_ALL = os.getenv("TRACE_REQUESTS", "") == "1"
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+LAG_BUCKETS = (30, 60, 120, 180, 240, 300, 450, 600, 900, 1800)
+
+S3_REQUEST_SECONDS = Histogram('s3_request_seconds', 'Latency of S3 requests', ['operation'], buckets=LATENCY_BUCKETS)
+S3_DOWNLOAD_BYTES = Counter('s3_download_bytes', 'Bytes of radar volumes downloaded from S3')
+LEVEL2_PARSE_SECONDS = Histogram('level2_parse_seconds', 'Time to parse a Level2 volume', buckets=LATENCY_BUCKETS)
+EXTRACT_SECONDS = Histogram('radar_extract_seconds', 'Time to extract every sweep of a moment from a volume', ['moment'], buckets=LATENCY_BUCKETS)
+PRODUCT_SECONDS = Histogram('radar_product_seconds', 'Time to compute the volume products of a volume', buckets=LATENCY_BUCKETS)
+SWEEP_ENCODE_SECONDS = Histogram('radar_sweep_encode_seconds', 'Time to encode one sweep', ['moment', 'encoding'], buckets=LATENCY_BUCKETS)
+SWEEP_PAYLOAD_BYTES = Histogram('radar_sweep_payload_bytes', 'Size of encoded sweeps', ['moment', 'encoding'], buckets=SIZE_BUCKETS)
+JOB_SECONDS = Histogram('job_seconds', 'Time to run a job on a worker', ['queue', 'result'], buckets=LATENCY_BUCKETS)
+JOB_WAIT_SECONDS = Histogram('job_wait_seconds', 'Time a requester waited on a job', ['queue'], buckets=LATENCY_BUCKETS)
+CACHE_REQUESTS = Counter('cache_requests', 'Cache reads by tier and outcome', ['tier', 'result'])
+CACHE_L1_EVICTIONS = Counter('cache_l1_evictions', 'Values evicted from the in process cache')
+CACHE_L1_ENTRIES = Gauge('cache_l1_entries', 'Values in the in process cache', multiprocess_mode='livesum')
+CACHE_L1_BYTES = Gauge('cache_l1_bytes', 'Bytes in the in process cache', multiprocess_mode='livesum')
+WATCHER_LAG_SECONDS = Histogram('radar_watcher_lag_seconds', 'Time from the start of a scan to its listeners being notified', ['station'], buckets=LAG_BUCKETS)
+FANOUT_SECONDS = Histogram('websocket_fanout_seconds', 'Time to queue a new scan for every client watching the station', buckets=LATENCY_BUCKETS)
+NWS_REQUEST_SECONDS = Histogram('nws_request_seconds', 'Latency of NWS API requests', ['endpoint'], buckets=LATENCY_BUCKETS)
+HTTP_REQUEST_SECONDS = Histogram('http_request_seconds', 'Latency of HTTP requests', ['endpoint', 'method', 'status'], buckets=LATENCY_BUCKETS)
+
+# Spans of the request being traced on this thread, None when it isn't traced
+_spans = contextvars.ContextVar('spans', default=None)
+
+def start_trace(enabled: bool):
+    return _spans.set([] if enabled or TRACE_ALL else None)
+
+# The spans recorded since start_trace, as (name, seconds, attributes)
+def finish_trace(token):
+    spans = _spans.get()
+    _spans.reset(token)
+    return spans
+
+# Times a block of work as part of the traced request, if there is one
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    spans = _spans.get()
+    if spans is None:
+        yield
+        return
+    timeStart = time.monotonic()
+    try:
+        yield
+    finally:
+        spans.append((name, time.monotonic() - timeStart, attributes))
+
+# Server-Timing header listing the spans, so they show up in the browser's dev tools
+def server_timing(spans):
+    entries = []
+    for name, seconds, attributes in spans:
+        description = " ".join(f"{key}={value}" for key, value in attributes.items())
+        entry = f"{name};dur={seconds * 1000:.1f}"
+        if description:
+            entry += f';desc="{description}"'
+        entries.append(entry)
+    return ", ".join(entries)
+
+def log_trace(method: str, path: str, spans):
+    logging.info(f"Trace {method} {path}: " + ", ".join(
+        f"{name} {seconds * 1000:.1f}ms" + "".join(f" {key}={value}" for key, value in attributes.items())
+        for name, seconds, attributes in spans))
+
+def _registry():
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return None
+
+# Metrics in the Prometheus text format, for every process when running multiprocess
+def render():
+    registry = _registry()
+    return (generate_latest() if registry is None else generate_latest(registry)), CONTENT_TYPE_LATEST
+
+# For processes without the web app, serves the metrics on their own port
+def serve(port: int):
+    registry = _registry()
+    if registry is None:
+        start_http_server(port)
+    else:
+        start_http_server(port, registry=registry)
+    logging.info(f"Serving metrics on port {port}")
+
+# Drops the live gauges of a process that exited
+def mark_process_dead(pid: int):
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid)
+
+def record_cache_stats(cache):
+    stats = cache.stats()
+    CACHE_L1_ENTRIES.set(stats['entries'])
+    CACHE_L1_BYTES.set(stats['bytes'])
@@ -0,0 +1,229 @@
+import collections
+import concurrent.futures
+import datetime
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+import msgpack
+import numpy as np
+
+from .cache import Cache
+from .geometry import gate_index, lonlat_to_polar, nominal_az_edges
+from .packing import pack_array, unpack_array
+from .radar import get_sweep
+
+# Each region is a regular lat/lon grid covered by a set of radars
+REGIONS = {
+    'OK': {
+        'bbox': (-103.1, 33.6, -94.3, 37.1),
+        'resolution': 0.01,
+        'stations': ['KTLX', 'KINX', 'KVNX', 'KFDR', 'KAMA', 'KSRX'],
+        'rule': 'max',
+    },
+}
+MOSAIC_RULES = ('max', 'nearest')
+# Mosaics are made from the lowest tilt
+MOSAIC_SWEEP = 0
+# A station's scan is left out of a mosaic once it is this much older than the mosaic
+MOSAIC_WINDOW = 600
+# Mosaics the worker made are kept this long for animation loops
+MOSAIC_EXPIRATION = datetime.timedelta(hours=3)
+# Enough history to cover MOSAIC_EXPIRATION with a scan from every station every few minutes
+MOSAIC_HISTORY_SIZE = 1000
+MOSAIC_WORKERS = int(os.getenv("MOSAIC_WORKERS", min(4, os.cpu_count() or 1)))
+# Per worker process, each map is one int32 per region cell
+INDEX_MAP_CACHE_SIZE = 32
+
+# Only touched inside the worker processes
+_indexMaps = collections.OrderedDict()
+
+def _region_lonlat(region: str):
+    west, south, east, north = REGIONS[region]['bbox']
+    resolution = REGIONS[region]['resolution']
+    lon = west + resolution * (np.arange(round((east - west) / resolution)) + 0.5)
+    # Rows run north to south like an image
+    lat = north - resolution * (np.arange(round((north - south) / resolution)) + 0.5)
+    return np.meshgrid(lon, lat)
+
+# Flat gate index for every region cell. Like the tile lookup tables this depends only on
+# the site and sweep geometry, so a new scan from a station is a single gather.
+def _index_map(region: str, station: str, sweep):
+    key = (region, station, sweep['grid']['az'], sweep['grid']['range'])
+    if key in _indexMaps:
+        _indexMaps.move_to_end(key)
+        return _indexMaps[key]
+
+    az = nominal_az_edges(unpack_array(sweep['az']).astype(np.float64))
+    rng = unpack_array(sweep['ref_range'])
+    lon, lat = _region_lonlat(region)
+    cell_az, cell_rng = lonlat_to_polar(sweep['cent_lon'], sweep['cent_lat'], lon, lat)
+    index = gate_index(az, rng, cell_az, cell_rng)
+
+    _indexMaps[key] = index
+    while len(_indexMaps) > INDEX_MAP_CACHE_SIZE:
+        _indexMaps.popitem(last=False)
+    return index
+
+# Runs in the process pool, resampling a packed sweep onto the region grid.
+# Cells outside the sweep get code 0, below threshold.
+def _resample(region: str, station: str, packed):
+    sweep = msgpack.unpackb(packed)
+    gates = unpack_array(sweep['data']).ravel()
+    index = _index_map(region, station, sweep)
+    outside = index == gates.size
+    layer = gates[np.where(outside, 0, index)]
+    layer[outside] = 0
+    return layer
+
+class Mosaic:
+    def __init__(self, region: str, rule: str = None):
+        self.region = region
+        self.rule = rule or REGIONS[region]['rule']
+        if self.rule not in MOSAIC_RULES:
+            raise ValueError("Invalid mosaic rule")
+        lon, lat = _region_lonlat(region)
+        self.lon = lon
+        self.lat = lat
+        self.layers = {}
+        self.footprints = {}
+        self.data = None
+        self.scale = None
+        self.offset = None
+        self.lock = threading.Lock()
+
+    @property
+    def timestamp(self):
+        return max([ts for ts, _ in self.layers.values()], default=0)
+
+    def _footprint(self, station: str, sweep):
+        # Distance to every cell, and the rows and columns the radar can reach
+        _, distance = lonlat_to_polar(sweep['cent_lon'], sweep['cent_lat'], self.lon, self.lat)
+        reach = distance <= unpack_array(sweep['ref_range'])[-1]
+        distance = np.where(reach, distance, np.inf).astype(np.float32)
+        rows = np.flatnonzero(reach.any(axis=1))
+        cols = np.flatnonzero(reach.any(axis=0))
+        if len(rows) == 0:
+            return distance, (slice(0, 0), slice(0, 0))
+        return distance, (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+
+    def update(self, station: str, timestamp: int, sweep, layer):
+        # sweep is the unpacked sweep without its data, layer is the resampled codes
+        with self.lock:
+            if station in self.layers and self.layers[station][0] >= timestamp:
+                return False
+            if self.data is None:
+                # Level2 reflectivity is always 8 bit codes with the same scale and offset
+                self.data = np.zeros(self.lon.shape, dtype=layer.dtype)
+                self.scale = sweep['data']['scale']
+                self.offset = sweep['data']['offset']
+            if station not in self.footprints:
+                self.footprints[station] = self._footprint(station, sweep)
+            self.layers[station] = (timestamp, layer.reshape(self.lon.shape))
+            # Stations that stopped sending scans drop out once they fall outside the window
+            changed = [station] + [other for other, (ts, _) in self.layers.items() if ts < self.timestamp - MOSAIC_WINDOW]
+            for other in changed[1:]:
+                del self.layers[other]
+            # Only the parts of the grid these stations cover can change
+            for other in changed:
+                self._composite(self.footprints[other][1])
+        return True
+
+    def _composite(self, window):
+        stations = [station for station in self.layers if self.footprints[station][1] != (slice(0, 0), slice(0, 0))]
+        if len(stations) == 0:
+            self.data[window] = 0
+            return
+        stack = np.stack([self.layers[station][1][window] for station in stations])
+        if self.rule == 'max':
+            self.data[window] = stack.max(axis=0)
+        else:
+            distance = np.stack([self.footprints[station][0][window] for station in stations])
+            nearest = distance.argmin(axis=0)
+            self.data[window] = np.take_along_axis(stack, nearest[np.newaxis], axis=0)[0]
+
+    def encode(self, compression=None):
+        with self.lock:
+            if self.data is None:
+                return None
+            return msgpack.packb({
+                'encoding': 'packed',
+                'region': self.region,
+                'bbox': list(REGIONS[self.region]['bbox']),
+                'resolution': REGIONS[self.region]['resolution'],
+                'rule': self.rule,
+                'stations': {station: ts for station, (ts, _) in self.layers.items()},
+                'timestamp': self.timestamp,
+                'data': {**pack_array(self.data, self.data.dtype, compression), 'scale': self.scale, 'offset': self.offset},
+            })
+
+# Keeps a live mosaic per region in the worker, updated as the watcher sees new scans.
+# Every mosaic it makes is cached and listed in the region's history for the web workers.
+class MosaicEngine:
+    def __init__(self, cache: Cache):
+        self.cache = cache
+        self.mosaics = {region: Mosaic(region) for region in REGIONS}
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def _pool(self):
+        # Spawned workers don't inherit the redis connections or the watcher thread
+        with self.lock:
+            if self.pool is None:
+                self.pool = concurrent.futures.ProcessPoolExecutor(MOSAIC_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+            return self.pool
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+    def stations(self):
+        return sorted({station for region in REGIONS.values() for station in region['stations']})
+
+    def attach(self, watcher):
+        for station in self.stations():
+            watcher.add_event_listener(self.on_scan, station)
+            if not watcher.is_watching(station):
+                watcher.start(station)
+
+    def _layers(self, regions, station: str, timestamp: int):
+        # Submit the resampling of a station's scan for each region, returns the futures
+        packed = get_sweep(self.cache, station, MOSAIC_SWEEP, 'REF', timestamp, 'packed')
+        if packed is None:
+            return None, {}
+        sweep = msgpack.unpackb(packed)
+        del sweep['data']['data']
+        return sweep, {region: self._pool().submit(_resample, region, station, packed) for region in regions}
+
+    def on_scan(self, station: str, timestamp: int):
+        timeStart = time.monotonic()
+        regions = [region for region, config in REGIONS.items() if station in config['stations']]
+        sweep, futures = self._layers(regions, station, timestamp)
+        for region, future in futures.items():
+            mosaic = self.mosaics[region]
+            if not mosaic.update(station, timestamp, sweep, future.result()):
+                continue
+            self.cache.set_many({
+                f"mosaic/{region}/{mosaic.timestamp}": mosaic.encode(),
+                f"mosaic/{region}/latest": mosaic.timestamp,
+            }, MOSAIC_EXPIRATION)
+            self.cache.zadd(f"mosaics/{region}", {str(mosaic.timestamp): mosaic.timestamp}, MOSAIC_HISTORY_SIZE)
+        logging.info(f"Mosaic update for {station} took {datetime.timedelta(seconds=time.monotonic() - timeStart)}")
+
+def latest_mosaic(cache: Cache, region: str):
+    timestamp = cache.get(f"mosaic/{region}/latest")
+    if timestamp is None:
+        return None
+    return cache.get(f"mosaic/{region}/{int(timestamp)}")
+
+# The newest mosaic the worker made no more than MOSAIC_WINDOW before timestamp, None if
+# there isn't one
+def mosaic_at(cache: Cache, region: str, timestamp: int):
+    timestamps = cache.zrangebyscore(f"mosaics/{region}", timestamp - MOSAIC_WINDOW, timestamp)
+    if len(timestamps) == 0:
+        return None
+    return cache.get(f"mosaic/{region}/{int(timestamps[-1])}")
@@ -0,0 +1,44 @@
+import concurrent.futures
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import NWS_REQUEST_SECONDS
+
+NWS_API = os.getenv("NWS_API", "https://api.weather.gov")
+NWS_HEADERS = {
+    'Accept': 'application/geo+json',
+    'User-Agent': 'weather-dashboard',
+}
+# Areas /alerts/active takes, states and territories and then marine areas
+ALERT_AREAS = frozenset("""
+AL AK AS AR AZ CA CO CT DE DC FL GA GU HI ID IL IN IA KS KY LA ME MD MA MI MN MS MO MT NE NV
+NH NJ NM NY NC ND OH OK OR PA PR RI SC SD TN TX UT VT VI VA WA WV WI WY MP PW FM MH
+AM AN GM LC LE LH LM LO LS PH PK PM PS PZ SL
+""".split())
+# At most this many requests to the NWS API at once, across every alert request
+MAX_CONCURRENT_FETCHES = int(os.getenv("NWS_MAX_CONCURRENT_FETCHES", 16))
+
+# One pool of keep-alive connections for every call to the API
+session = requests.Session()
+session.headers.update(NWS_HEADERS)
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CONCURRENT_FETCHES))
+session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CONCURRENT_FETCHES))
+fetchExecutor = concurrent.futures.ThreadPoolExecutor(MAX_CONCURRENT_FETCHES, thread_name_prefix='nws')
+
+# Raw GeoJSON of a zone
+def get_zone_geojson(url):
+    with NWS_REQUEST_SECONDS.labels('zone').time():
+        response = session.get(url)
+    if response.status_code != 200:
+        raise ValueError('Failed to get polygon')
+    res = response.json()
+    if 'geometry' not in res or res['geometry'] is None:
+        raise ValueError('Invalid polygon')
+    if ('coordinates' not in res['geometry'] and (res['geometry']['type'] != "Polygon" or res['geometry']['type'] != "MultiPolygon")) \
+            and (res['geometry']['type'] != "GeometryCollection"):
+        print(res)
+        print(url)
+        raise ValueError('Invalid polygon')
+    return response.content
@@ -0,0 +1,26 @@
+import numpy as np
+import zstandard
+
+COMPRESSIONS = (None, 'zstd')
+ZSTD_LEVEL = 3
+
+# Typed arrays are sent as msgpack bin fields along with the dtype and shape needed to rebuild them
+def pack_array(arr, dtype, compression=None):
+    arr = np.ascontiguousarray(arr, dtype=dtype)
+    data = arr.tobytes()
+    if compression == 'zstd':
+        data = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    elif compression is not None:
+        raise ValueError(f"Unsupported compression: {compression}")
+    return {
+        'dtype': arr.dtype.str,
+        'shape': list(arr.shape),
+        'compression': compression,
+        'data': data,
+    }
+
+def unpack_array(field):
+    data = field['data']
+    if field.get('compression') == 'zstd':
+        data = zstandard.ZstdDecompressor().decompress(data)
+    return np.frombuffer(data, dtype=field['dtype']).reshape(field['shape'])
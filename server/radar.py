@@ -1,16 +1,101 @@
+import calendar
+import collections
 import datetime
+import logging
+import os
+import time
 import re
+import tempfile
 
 import boto3
 import botocore
 from botocore.client import Config
+from metpy.io import Level2File
 from metpy.units import units
 import msgpack
 import numpy as np
+from scipy.ndimage import uniform_filter1d
+
+from .geometry import gate_index, grid_id, polar_bounds, store_grids
+from .jobs import get_queue, PRIORITY_INTERACTIVE
+from .metrics import span, S3_REQUEST_SECONDS, LEVEL2_PARSE_SECONDS, EXTRACT_SECONDS, PRODUCT_SECONDS, SWEEP_ENCODE_SECONDS, SWEEP_PAYLOAD_BYTES
+from .packing import pack_array, unpack_array
+from .volume_store import S3Source, VolumeStore
 
 s3Resource = boto3.resource('s3', config=Config(signature_version=botocore.UNSIGNED, user_agent_extra='Resource'))
 s3Client = boto3.client('s3', config=Config(signature_version=botocore.UNSIGNED, user_agent_extra='Client'))
 bucket = s3Resource.Bucket('noaa-nexrad-level2')
+volumeStore = VolumeStore(
+    os.environ.get('VOLUME_STORE_DIR', os.path.join(tempfile.gettempdir(), 'weather-dashboard', 'volumes')),
+    S3Source(s3Client, 'noaa-nexrad-level2'),
+    int(os.environ.get('VOLUME_STORE_MAX_BYTES', 2 * 1024 ** 3)),
+)
+
+ENCODINGS = ('msgpack', 'packed')
+# Every WSR-88D site in the Level2 archive
+RADAR_STATIONS = frozenset("""
+KABR KABX KAKQ KAMA KAMX KAPX KARX KATX KBBX KBGM KBHX KBIS KBLX KBMX KBOX KBRO KBUF KBYX
+KCAE KCBW KCBX KCCX KCLE KCLX KCRP KCXX KCYS KDAX KDDC KDFX KDGX KDIX KDLH KDMX KDOX KDTX
+KDVN KDYX KEAX KEMX KENX KEOX KEPZ KESX KEVX KEWX KEYX KFCX KFDR KFDX KFFC KFSD KFSX KFTG
+KFWS KGGW KGJX KGLD KGRB KGRK KGRR KGSP KGWX KGYX KHDX KHGX KHNX KHPX KHTX KICT KICX KILN
+KILX KIND KINX KIWA KIWX KJAX KJGX KJKL KLBB KLCH KLGX KLIX KLNX KLOT KLRX KLSX KLTX KLVX
+KLWX KLZK KMAF KMAX KMBX KMHX KMKX KMLB KMOB KMPX KMQT KMRX KMSX KMTX KMUX KMVX KMXX KNKX
+KNQA KOAX KOHX KOKX KOTX KPAH KPBZ KPDT KPOE KPUX KRAX KRGX KRIW KRLX KRTX KSFX KSGF KSHV
+KSJT KSOX KSRX KTBW KTFX KTLH KTLX KTWX KTYX KUDX KUEX KVAX KVBX KVNX KVTX KVWX KYUX
+PABC PACG PAEC PAHG PAIH PAKC PAPD PGUA PHKI PHKM PHMO PHWA TJUA LPLA RKJK RKSG RODN
+""".split())
+
+# Moments served by the API, mapped to the Level2 data block they are read from.
+# KDP isn't part of Level2, so it is derived from PHI.
+MOMENTS = {
+    'REF': b'REF',
+    'VEL': b'VEL',
+    'SW': b'SW',
+    'ZDR': b'ZDR',
+    'CC': b'RHO',
+    'PHI': b'PHI',
+    'KDP': b'PHI',
+}
+KDP_WINDOW = 9
+KDP_SCALE = 100.
+KDP_OFFSET = 1000.
+# Deltas are mostly zeros, so they are always compressed
+DELTA_COMPRESSION = 'zstd'
+# Queue the volume processing jobs run on
+SCAN_JOBS = "scans"
+# Longest range list_scans_between will walk, an S3 LIST per hour
+MAX_SCAN_LIST_SPAN = 24 * 3600
+# Viewports are snapped outward to blocks of this many decimated rays and gates, and
+# decimation to powers of two, so nearby viewports share cached variants
+VIEW_BLOCK = 16
+MAX_DECIMATION = 16
+# Velocity keeps the strongest inbound or outbound value of each cell so couplets survive
+# decimation, every other moment keeps the highest
+MAGNITUDE_POOLED = ('VEL',)
+
+# Volume products served alongside the moments as sweep 0, computed from every reflectivity
+# sweep of a volume, and their (scale, offset, bits) codes
+PRODUCTS = {
+    # Composite reflectivity, the highest dBZ in the column
+    'CREF': (2., 66., 8),
+    # Echo tops, the height in km above sea level of the highest beam with ECHO_TOP_DBZ
+    'ET': (10., 2., 16),
+    # Vertically integrated liquid, kg/m^2
+    'VIL': (10., 2., 16),
+}
+ECHO_TOP_DBZ = 18.
+# Reflectivity above this is probably hail, so it is capped when integrating liquid
+VIL_MAX_DBZ = 56.
+# Effective earth radius for beam heights under standard refraction
+EFFECTIVE_EARTH_RADIUS = 4. / 3. * 6371008.8
+
+# Code scaling of sweeps that aren't a Level2 moment as transmitted
+_Header = collections.namedtuple('_Header', ['scale', 'offset', 'data_size'])
+
+# Every object under prefix except the _MDM metadata files
+def _list_objects(prefix: str):
+    with S3_REQUEST_SECONDS.labels('list').time():
+        return [obj for obj in bucket.objects.filter(Prefix=prefix) if not obj.key.endswith('_MDM')]
 
 def get_radar_scan_time(station, last: int):
     # last is the offset from the most recent scan
@@ -19,18 +104,18 @@ def get_radar_scan_time(station, last: int):
     utcdate = datetime.datetime.now(datetime.UTC)
     prefix = f"{utcdate.strftime('%Y/%m/%d')}/{station}/{station}{utcdate.strftime('%Y%m%d_%H')}"
     # Strip out any objects whose key ends in _MDM
-    objs = [obj for obj in list(bucket.objects.filter(Prefix=prefix)) if not obj.key.endswith('_MDM')]
+    objs = _list_objects(prefix)
     if len(objs) == 0:
         # This could be a new hour, so try the previous hour
         utcdate -= datetime.timedelta(hours=1)
         prefix = f"{utcdate.strftime('%Y/%m/%d')}/{station}/{station}{utcdate.strftime('%Y%m%d_%H')}"
-        objs = [obj for obj in list(bucket.objects.filter(Prefix=prefix)) if not obj.key.endswith('_MDM')]
+        objs = _list_objects(prefix)
         if len(objs) == 0:
             # Is this a new day?
             utcdate += datetime.timedelta(hours=1)
             utcdate -= datetime.timedelta(days=1)
             prefix = f"{utcdate.strftime('%Y/%m/%d')}/{station}/{station}{utcdate.strftime('%Y%m%d_%H')}"
-            objs = [obj for obj in list(bucket.objects.filter(Prefix=prefix)) if not obj.key.endswith('_MDM')]
+            objs = _list_objects(prefix)
             if len(objs) == 0:
                 raise ValueError("No radar scans found")
     objs.sort(key=lambda x: x.key)
@@ -38,32 +123,86 @@ def get_radar_scan_time(station, last: int):
         raise ValueError("Invalid last value")
     return objs[-(last+1)]
 
+def list_scans_between(station: str, start: int, end: int):
+    # Lists the scan timestamps between start and end, one hour prefix at a time
+    station = station.upper()
+    if end - start > MAX_SCAN_LIST_SPAN:
+        raise ValueError("Range too long")
+    # Hours that haven't happened yet can't hold any scans
+    end = min(end, int(time.time()))
+    utcdate = datetime.datetime.fromtimestamp(start, tz=datetime.timezone.utc).replace(minute=0, second=0)
+    timestamps = []
+    while utcdate.timestamp() <= end:
+        prefix = f"{utcdate.strftime('%Y/%m/%d')}/{station}/{station}{utcdate.strftime('%Y%m%d_%H')}"
+        for obj in _list_objects(prefix):
+            ts = calendar.timegm(extract_timestamp(obj, station).utctimetuple())
+            if start <= ts <= end:
+                timestamps.append(ts)
+        utcdate += datetime.timedelta(hours=1)
+    return sorted(timestamps)
+
+def list_scans_after(station: str, last_key: str = None):
+    # Lists the volumes newer than last_key, using StartAfter so each LIST only returns keys we haven't seen.
+    # Without a last_key it lists yesterday and today.
+    station = station.upper()
+    utcdate = datetime.datetime.now(datetime.UTC)
+    prefixes = [f"{utcdate.strftime('%Y/%m/%d')}/{station}/"]
+    if last_key is None:
+        prefixes.insert(0, f"{(utcdate - datetime.timedelta(days=1)).strftime('%Y/%m/%d')}/{station}/")
+    elif not last_key.startswith(prefixes[0]):
+        # The day rolled over since the last scan, so finish off that day first
+        prefixes.insert(0, last_key[:last_key.rindex('/') + 1])
+    keys = []
+    paginator = s3Client.get_paginator('list_objects_v2')
+    for prefix in prefixes:
+        kwargs = {'Bucket': 'noaa-nexrad-level2', 'Prefix': prefix}
+        if last_key is not None and last_key.startswith(prefix):
+            kwargs['StartAfter'] = last_key
+        with S3_REQUEST_SECONDS.labels('list').time():
+            for page in paginator.paginate(**kwargs):
+                keys.extend(obj['Key'] for obj in page.get('Contents', []) if not obj['Key'].endswith('_MDM'))
+    return sorted(keys)
+
 def extract_timestamp(obj, station):
+    return parse_scan_key(obj.key, station)
+
+def parse_scan_key(key: str, station: str):
     station = station.upper()
     # Strip out the "yyyy/mm/dd/{station}/{station}" prefix and _V06 suffix to get the timestamp
     regex = re.compile(r'\d{4}/\d{2}/\d{2}/' + station + '/' + station + r'(\d{8}_\d{6})_V06')
-    match = regex.match(obj.key)
+    match = regex.match(key)
     if match is None:
         raise ValueError("Error parsing timestamp from key")
     return datetime.datetime.strptime(match.group(1), '%Y%m%d_%H%M%S')
 
-def get_specific_radar_scan(station: str, timestamp: int):
+def scan_key(station: str, timestamp: int):
     station = station.upper()
     # key is yyyy/mm/dd/{station}/{station}YYYYMMDD_HHMMSS_V06
     time = datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
-    key = f"{time.strftime('%Y/%m/%d')}/{station}/{station}{time.strftime('%Y%m%d_%H%M%S')}_V06"
-    try:
-        obj = s3Client.get_object(Bucket='noaa-nexrad-level2', Key=key)
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] == 'NoSuchKey':
-            raise ValueError("Radar scan not found")
-        else:
-            raise
-    return obj
+    return f"{time.strftime('%Y/%m/%d')}/{station}/{station}{time.strftime('%Y%m%d_%H%M%S')}_V06"
 
-def process(f, sweep, timestamp):
-    # First item in ray is header, which has azimuth angle
-    az = np.array([ray[0].az_angle for ray in f.sweeps[sweep]])
+# Volumes are downloaded once into the local store and memory mapped from there, so
+# every sweep and moment of a scan shares a single S3 fetch
+def get_volume(station: str, timestamp: int):
+    return volumeStore.open(scan_key(station, timestamp))
+
+# Level2 moments are transmitted as unsigned integer codes where 0 is below
+# threshold and 1 is range folded. MetPy turns both into NaN when it scales them.
+# Values outside the codes' range are clipped to it rather than wrapping around.
+def _encode_codes(values, hdr):
+    codes = np.clip(np.rint(values * hdr.scale + hdr.offset), 2, 2 ** hdr.data_size - 1)
+    codes[np.isnan(codes)] = 0
+    return codes.astype(f'<u{hdr.data_size // 8}')
+
+# PHI along each ray with its folds at 360 degrees undone. Gaps take the last valid value
+# so the phase carries across them.
+def _unwrap_phi(phi, valid):
+    gates = np.where(valid, np.arange(phi.shape[1]), 0)
+    np.maximum.accumulate(gates, axis=1, out=gates)
+    filled = np.nan_to_num(np.take_along_axis(phi, gates, axis=1))
+    return np.unwrap(filled, period=360., axis=1)
+
+def _az_edges(az):
     diff = np.diff(az)
     crossed = diff < -180
     diff[crossed] += 360.
@@ -74,25 +213,415 @@ def process(f, sweep, timestamp):
     az[crossed] += 180.
 
     # Concatenate with overall start and end of data we calculate using the average spacing
-    az = np.concatenate(([az[0] - avg_spacing], az, [az[-1] + avg_spacing]))
-    az = units.Quantity(az, 'degrees')
+    return np.concatenate(([az[0] - avg_spacing], az, [az[-1] + avg_spacing]))
+
+def _gate_edges(hdr):
+    gate_range = (np.arange(hdr.num_gates + 1) - 0.5) * hdr.gate_width + hdr.first_gate
+    return units.Quantity(gate_range, 'kilometers').m_as('meters')
 
-    ref_hdr = f.sweeps[sweep][0][4][b'REF'][0]
-    ref_range = (np.arange(ref_hdr.num_gates + 1) - 0.5) * ref_hdr.gate_width + ref_hdr.first_gate
-    ref_range = units.Quantity(ref_range, 'kilometers')
-    ref = np.array([ray[4][b'REF'][1] for ray in f.sweeps[sweep]])
+# Specific differential phase is half the range derivative of PHI. The derivative is
+# taken over a running mean of the unwrapped phase so gate to gate phase noise doesn't
+# dominate.
+def _kdp(phi, hdr):
+    valid = ~np.isnan(phi)
+    count = uniform_filter1d(valid.astype(float), KDP_WINDOW, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        smoothed = uniform_filter1d(np.where(valid, _unwrap_phi(phi, valid), 0.), KDP_WINDOW, axis=1) / count
+    kdp = 0.5 * np.gradient(smoothed, hdr.gate_width, axis=1)
+    kdp[~valid] = np.nan
+    return kdp, hdr._replace(name=b'KDP', scale=KDP_SCALE, offset=KDP_OFFSET, data_size=16)
+
+def extract_sweeps(f, sweeps=None, moment='REF'):
+    block = MOMENTS[moment]
+    if sweeps is None:
+        sweeps = range(len(f.sweeps))
+    sweeps = [sweep for sweep in sweeps if 0 <= sweep < len(f.sweeps) and len(f.sweeps[sweep]) > 0]
 
     # Extract central longitude and latitude from file
     cent_lon = f.sweeps[0][0][1].lon
     cent_lat = f.sweeps[0][0][1].lat
 
-    return msgpack.packb(
-        {
-        'cent_lon': cent_lon,
-        'cent_lat': cent_lat,
-        'az': az.m_as('degrees').tolist(),
-        'ref_range': ref_range.m_as('meters').tolist(),
-        'data': ref.tolist(),
-        'timestamp': timestamp,
+    volume = {}
+    for sweep in sweeps:
+        rays = f.sweeps[sweep]
+        # Split cuts have sweeps without reflectivity or without the Doppler moments
+        if block not in rays[0][4]:
+            continue
+        hdr = rays[0][4][block][0]
+        # Pull every ray's azimuth and moment data into arrays preallocated for this sweep
+        # in a single pass
+        az = np.empty(len(rays))
+        values = np.full((len(rays), hdr.num_gates), np.nan)
+        for i, ray in enumerate(rays):
+            # First item in ray is header, which has azimuth angle
+            az[i] = ray[0].az_angle
+            data = ray[4].get(block)
+            if data is not None:
+                gates = min(len(data[1]), hdr.num_gates)
+                values[i, :gates] = data[1][:gates]
+        # Start every sweep at its northernmost ray so scans of a tilt line up ray for ray
+        first = np.argmin(az)
+        sweep_az = np.roll(az, -first)
+        data = np.roll(values, -first, axis=0)
+        if moment == 'KDP':
+            data, hdr = _kdp(data, hdr)
+        volume[sweep] = {
+            'cent_lon': cent_lon,
+            'cent_lat': cent_lat,
+            'az': _az_edges(sweep_az),
+            # Range edges of this moment's gates, named ref_range for existing clients
+            'ref_range': _gate_edges(hdr),
+            'data': data,
+            'hdr': hdr,
+            'moment': moment,
         }
-    ) 
\ No newline at end of file
+    return volume
+
+# Height above the radar of the beam's center at each elevation and range
+def _beam_height(elevation, rng):
+    return np.sqrt(rng ** 2 + EFFECTIVE_EARTH_RADIUS ** 2 + 2 * rng * EFFECTIVE_EARTH_RADIUS * np.sin(np.deg2rad(elevation))) - EFFECTIVE_EARTH_RADIUS
+
+# Composite reflectivity, echo tops and VIL of a volume. Every reflectivity sweep is
+# resampled onto the rays of the lowest tilt and the gates of the longest, nearest ray
+# and gate, then the products are reduced over the stack of sweeps. sweeps is every
+# reflectivity sweep of the volume if they have already been extracted.
+def extract_products(f, sweeps=None):
+    if sweeps is None:
+        sweeps = extract_sweeps(f, moment='REF')
+    if len(sweeps) == 0:
+        raise ValueError("Volume has no reflectivity")
+    elevations = {i: f.sweeps[i][0][0].el_angle for i in sweeps}
+    order = sorted(sweeps, key=lambda i: elevations[i])
+    az = sweeps[order[0]]['az']
+    rng = max((sweeps[i]['ref_range'] for i in order), key=len)
+    azCenters = ((az[:-1] + az[1:]) / 2)[:, None]
+    rngCenters = ((rng[:-1] + rng[1:]) / 2)[None, :]
+
+    # One gather from every sweep's data, with a NaN past the end of each for points it doesn't cover
+    offsets = np.cumsum([0] + [sweeps[i]['data'].size + 1 for i in order])
+    flat = np.concatenate([np.append(sweeps[i]['data'].ravel(), np.nan) for i in order]).astype(np.float32)
+    index = np.stack([offset + gate_index(sweeps[i]['az'], sweeps[i]['ref_range'], azCenters, rngCenters)
+                      for i, offset in zip(order, offsets[:-1])])
+    dbz = flat[index]
+    height = _beam_height(np.array([elevations[i] for i in order])[:, None, None], rngCenters[None]).astype(np.float32)
+    site = f.sweeps[0][0][1]
+
+    products = {}
+    products['CREF'] = np.fmax.reduce(dbz, axis=0)
+    tops = np.max(np.where(dbz >= ECHO_TOP_DBZ, height, -np.inf), axis=0)
+    products['ET'] = np.where(np.isfinite(tops), (tops + site.site_amsl + site.feedhorn_agl) / 1000., np.nan)
+    # Liquid water content from Z = 10^(dBZ/10), integrated over the layers between tilts
+    z = np.where(np.isnan(dbz), 0., 10. ** (np.minimum(dbz, VIL_MAX_DBZ) / 10.))
+    vil = (3.44e-6 * ((z[:-1] + z[1:]) / 2) ** (4. / 7.) * np.diff(height, axis=0)).sum(axis=0)
+    products['VIL'] = np.where(vil > 0, vil, np.nan)
+
+    volume = {}
+    for product, values in products.items():
+        scale, offset, bits = PRODUCTS[product]
+        volume[product] = {
+            'cent_lon': sweeps[order[0]]['cent_lon'],
+            'cent_lat': sweeps[order[0]]['cent_lat'],
+            'az': az,
+            'ref_range': rng,
+            # Kept within the codes, the lowest two are below threshold and range folded
+            'data': np.minimum(values, (2 ** bits - 1 - offset) / scale),
+            'hdr': _Header(scale, offset, bits),
+            'moment': product,
+        }
+    return volume
+
+# Clients can fetch the vertex grid for these ids once instead of projecting every scan
+def _grid(sweep):
+    az_hash, range_hash = grid_id(sweep)
+    return {'az': az_hash, 'range': range_hash}
+
+def encode(sweep, timestamp, encoding='msgpack', compression=None):
+    if encoding == 'msgpack':
+        if compression is not None:
+            raise ValueError("Compression requires the packed encoding")
+        payload = {
+            'cent_lon': sweep['cent_lon'],
+            'cent_lat': sweep['cent_lat'],
+            'az': sweep['az'].tolist(),
+            'ref_range': sweep['ref_range'].tolist(),
+            'data': sweep['data'].tolist(),
+            'moment': sweep['moment'],
+            'grid': _grid(sweep),
+            'timestamp': timestamp,
+        }
+    elif encoding == 'packed':
+        # Moment data is sent as the raw Level2 codes, value = (code - offset) / scale
+        data = pack_array(_encode_codes(sweep['data'], sweep['hdr']), f'<u{sweep["hdr"].data_size // 8}', compression)
+        data['scale'] = sweep['hdr'].scale
+        data['offset'] = sweep['hdr'].offset
+        payload = {
+            'encoding': 'packed',
+            'cent_lon': sweep['cent_lon'],
+            'cent_lat': sweep['cent_lat'],
+            'az': pack_array(sweep['az'], '<f4', compression),
+            'ref_range': pack_array(sweep['ref_range'], '<f4', compression),
+            'data': data,
+            'moment': sweep['moment'],
+            'grid': _grid(sweep),
+            'timestamp': timestamp,
+        }
+    else:
+        raise ValueError(f"Unsupported encoding: {encoding}")
+    # Sweeps cropped or decimated for a viewport say which part of the full sweep they are
+    if 'view' in sweep:
+        payload['view'] = sweep['view']
+    return msgpack.packb(payload)
+
+def process(f, sweep, timestamp, encoding='msgpack', compression=None, moment='REF'):
+    volume = extract_sweeps(f, [sweep], moment)
+    if sweep not in volume:
+        raise ValueError("Invalid sweep")
+    return encode(volume[sweep], timestamp, encoding, compression)
+
+def process_volume(f, timestamp, encoding='msgpack', compression=None, moment='REF'):
+    return {sweep: encode(data, timestamp, encoding, compression) for sweep, data in extract_sweeps(f, moment=moment).items()}
+
+def sweep_cache_key(station: str, sweep: int, moment: str, timestamp: int, encoding='msgpack', compression=None):
+    # Reflectivity keeps the original key so the sweeps cached by the watcher serve both routes
+    if moment == "REF":
+        key = f"{station}/{sweep}/{timestamp}"
+    else:
+        key = f"{station}/{sweep}/{moment}/{timestamp}"
+    if encoding != "msgpack":
+        key += f"/{encoding}"
+    if compression is not None:
+        key += f"+{compression}"
+    return key
+
+# A job processing the given moments of a scan into each (encoding, compression) format,
+# for every sweep unless sweeps is given
+def scan_job(station: str, timestamp: int, moments, formats, sweeps=None):
+    return {
+        'station': station.upper(),
+        'timestamp': timestamp,
+        'sweeps': None if sweeps is None else sorted(sweeps),
+        'moments': list(moments),
+        'formats': [list(f) for f in formats],
+    }
+
+# Runs a scan_job in a job worker, caching each sweep that isn't already
+def process_scan(cache, job):
+    station = job['station']
+    timestamp = job['timestamp']
+    timeStart = time.monotonic()
+    volume = get_volume(station, timestamp)
+    downloadTime = time.monotonic() - timeStart
+    with LEVEL2_PARSE_SECONDS.time():
+        f = Level2File(volume)
+    timeStart = time.monotonic()
+    products = None
+    reflectivity = None
+    for moment in job['moments']:
+        if moment in PRODUCTS:
+            # Computed together the first time any of them is asked for
+            if products is None:
+                with PRODUCT_SECONDS.time():
+                    products = extract_products(f, reflectivity)
+            sweeps = {0: products[moment]}
+        else:
+            with EXTRACT_SECONDS.labels(moment).time():
+                sweeps = extract_sweeps(f, job['sweeps'], moment)
+            if moment == 'REF' and job['sweeps'] is None:
+                reflectivity = sweeps
+        keys = {(i, encoding, compression): sweep_cache_key(station, i, moment, timestamp, encoding, compression)
+                for i in sweeps for encoding, compression in job['formats']}
+        cached = dict(zip(keys.values(), cache.has_many(list(keys.values()))))
+        encoded = {}
+        for (i, encoding, compression), key in keys.items():
+            if cached[key]:
+                continue
+            with SWEEP_ENCODE_SECONDS.labels(moment, encoding).time():
+                encoded[key] = encode(sweeps[i], timestamp, encoding, compression)
+            SWEEP_PAYLOAD_BYTES.labels(moment, encoding).observe(len(encoded[key]))
+        cache.set_many(encoded)
+        store_grids(cache, station, sweeps.values())
+    logging.info(f"Processed {station} {timestamp} {','.join(job['moments'])}: volume took {downloadTime:.2f}s, processing took {time.monotonic() - timeStart:.2f}s")
+
+# Cached sweep if there is one, otherwise every sweep of the moment is processed from the
+# volume on the job workers. Returns None if the volume has no such sweep.
+def get_sweep(cache, station: str, sweep: int, moment: str, timestamp: int, encoding='msgpack', compression=None):
+    key = sweep_cache_key(station, sweep, moment, timestamp, encoding, compression)
+    with span('cache', key=key):
+        packed = cache.get(key)
+    if packed is not None:
+        return packed
+
+    timeStart = time.monotonic()
+    # Only the requested moment is processed, but parsing the volume dominates,
+    # so every sweep of it is cached while we have it, and every product
+    moments = list(PRODUCTS) if moment in PRODUCTS else [moment]
+    with span('process', station=station, sweep=sweep, moment=moment):
+        get_queue(cache, SCAN_JOBS).wait(scan_job(station, timestamp, moments, [(encoding, compression)]), PRIORITY_INTERACTIVE)
+    packed = cache.get(key)
+    logging.info(f"get_radar {station} sweep {sweep} {moment} {timestamp} missed the cache, processing took {time.monotonic() - timeStart:.2f}s")
+    return packed
+
+# Difference of a packed sweep from an earlier scan of the same sweep. The geometry is only
+# sent when it changed, and the data is the XOR of the codes against the base scan, which
+# is mostly zeros. Falls back to the full codes when the scans don't line up.
+def encode_delta(packed, base_packed, base: int):
+    current = msgpack.unpackb(packed)
+    previous = msgpack.unpackb(base_packed)
+    delta = {
+        'encoding': 'delta',
+        'base': base,
+        'cent_lon': current['cent_lon'],
+        'cent_lat': current['cent_lat'],
+        'moment': current['moment'],
+        'grid': current['grid'],
+        'timestamp': current['timestamp'],
+    }
+    if current['grid'] != previous['grid']:
+        delta['az'] = pack_array(unpack_array(current['az']), '<f4', DELTA_COMPRESSION)
+        delta['ref_range'] = pack_array(unpack_array(current['ref_range']), '<f4', DELTA_COMPRESSION)
+
+    codes = unpack_array(current['data'])
+    base_codes = unpack_array(previous['data'])
+    same = base_codes.shape == codes.shape and base_codes.dtype == codes.dtype \
+        and (previous['data']['scale'], previous['data']['offset']) == (current['data']['scale'], current['data']['offset'])
+    data = pack_array(codes ^ base_codes if same else codes, codes.dtype, DELTA_COMPRESSION)
+    data['delta'] = same
+    data['scale'] = current['data']['scale']
+    data['offset'] = current['data']['offset']
+    delta['data'] = data
+    return msgpack.packb(delta)
+
+# Delta of a sweep against the same sweep of the base scan, from the cached packed sweeps.
+# Returns None if the scan has no such sweep.
+def get_sweep_delta(cache, station: str, sweep: int, moment: str, timestamp: int, base: int):
+    def compute():
+        packed = get_sweep(cache, station, sweep, moment, timestamp, 'packed')
+        if packed is None:
+            return None
+        try:
+            base_packed = get_sweep(cache, station, sweep, moment, base, 'packed')
+        except ValueError:
+            base_packed = None
+        if base_packed is None:
+            # Nothing to diff against, the client gets the whole sweep
+            return get_sweep(cache, station, sweep, moment, timestamp, 'packed', DELTA_COMPRESSION)
+        return encode_delta(packed, base_packed, base)
+
+    return cache.get_or_compute(f"{sweep_cache_key(station, sweep, moment, timestamp, 'delta')}/{base}", compute)
+
+def _decimation(factor, round_up=False):
+    if factor <= 1:
+        return 1
+    exponent = np.ceil(np.log2(factor)) if round_up else np.floor(np.log2(factor))
+    return int(min(2 ** exponent, MAX_DECIMATION))
+
+# The part of a sweep to send for a viewport and resolution, as (first ray, rays, first gate,
+# end gate, ray decimation, gate decimation). Rays count on from the first, wrapping past the
+# last ray. max_gates caps the gates per ray, resolution is the coarsest cell size in meters.
+def view_window(az, ref_range, cent_lon, cent_lat, bbox=None, max_gates=None, resolution=None):
+    num_rays = len(az) - 1
+    num_gates = len(ref_range) - 1
+    rayStart, rayCount, gateStart, gateEnd = 0, num_rays, 0, num_gates
+    if bbox is not None:
+        azStart, azWidth, rngMin, rngMax = polar_bounds(cent_lon, cent_lat, bbox)
+        gateStart = min(max(int(np.searchsorted(ref_range, rngMin, side='right')) - 1, 0), num_gates)
+        gateEnd = max(min(int(np.searchsorted(ref_range, rngMax, side='left')), num_gates), gateStart)
+        if azWidth < 360.:
+            # Azimuth edges run from about 0 to 360 degrees, so wrap onto them
+            rayStart = min(int(np.searchsorted(az, (azStart - az[0]) % 360. + az[0], side='right')) - 1, num_rays - 1)
+            rayEnd = min(int(np.searchsorted(az, (azStart + azWidth - az[0]) % 360. + az[0], side='right')) - 1, num_rays - 1)
+            rayCount = (rayEnd - rayStart) % num_rays + 1
+
+    rayFactor = gateFactor = 1
+    if max_gates is not None:
+        gateFactor = _decimation((gateEnd - gateStart) / max_gates, round_up=True)
+    if resolution is not None:
+        gateWidth = (ref_range[-1] - ref_range[0]) / num_gates
+        gateFactor = max(gateFactor, _decimation(resolution / gateWidth))
+        # Rays are widest at the far edge of the view
+        rayWidth = np.deg2rad(360. / num_rays) * max(ref_range[gateEnd], gateWidth)
+        rayFactor = _decimation(resolution / rayWidth)
+
+    step = gateFactor * VIEW_BLOCK
+    gateStart = gateStart // step * step
+    gateEnd = min(-(-gateEnd // step) * step, num_gates)
+    if rayCount < num_rays:
+        step = rayFactor * VIEW_BLOCK
+        rayEnd = rayStart + rayCount
+        rayStart = rayStart // step * step
+        rayCount = -(-rayEnd // step) * step - rayStart
+        if rayCount >= num_rays:
+            rayStart, rayCount = 0, num_rays
+    return rayStart, rayCount, gateStart, gateEnd, rayFactor, gateFactor
+
+# Reduces each rayFactor by gateFactor block of codes to one. Cells past the end of the data
+# count as below threshold.
+def _pool(codes, rayFactor, gateFactor, offset, magnitude=False):
+    rays, gates = codes.shape
+    padded = np.zeros((-(-rays // rayFactor) * rayFactor, -(-gates // gateFactor) * gateFactor), dtype=codes.dtype)
+    padded[:rays, :gates] = codes
+    blocks = padded.reshape(padded.shape[0] // rayFactor, rayFactor, padded.shape[1] // gateFactor, gateFactor).swapaxes(1, 2)
+    blocks = blocks.reshape(blocks.shape[0], blocks.shape[1], rayFactor * gateFactor)
+    if not magnitude:
+        return blocks.max(axis=2)
+    # Below threshold and range folded codes rank under every measured value
+    values = blocks.astype(np.float32)
+    strength = np.where(blocks >= 2, np.abs(values - offset), values - 2)
+    return np.take_along_axis(blocks, strength.argmax(axis=2)[..., None], axis=2)[..., 0]
+
+# Edges of every factor-th cell from start, and the end of the last one
+def _view_edges(edges, start: int, count: int, factor: int):
+    cells = -(-count // factor)
+    return edges[start + np.minimum(np.arange(cells + 1) * factor, count)]
+
+# The window of an unpacked packed sweep, as a sweep that can be encoded
+def _view_sweep(full, window):
+    rayStart, rayCount, gateStart, gateEnd, rayFactor, gateFactor = window
+    az = unpack_array(full['az']).astype(np.float64)
+    codes = unpack_array(full['data'])
+    num_rays = len(az) - 1
+    if rayStart + rayCount <= num_rays:
+        codes = codes[rayStart:rayStart + rayCount, gateStart:gateEnd]
+    else:
+        codes = np.take(codes, np.arange(rayStart, rayStart + rayCount), axis=0, mode='wrap')[:, gateStart:gateEnd]
+    scale, offset = full['data']['scale'], full['data']['offset']
+    if rayFactor > 1 or gateFactor > 1:
+        codes = _pool(codes, rayFactor, gateFactor, offset, full['moment'] in MAGNITUDE_POOLED)
+    with np.errstate(invalid='ignore'):
+        data = np.where(codes >= 2, (codes - offset) / scale, np.nan)
+    return {
+        'cent_lon': full['cent_lon'],
+        'cent_lat': full['cent_lat'],
+        # Rays past the last one carry on around the circle
+        'az': _view_edges(np.concatenate((az, az[1:] + 360.)), rayStart, rayCount, rayFactor),
+        'ref_range': _view_edges(unpack_array(full['ref_range']).astype(np.float64), gateStart, gateEnd - gateStart, gateFactor),
+        'data': data,
+        'hdr': _Header(scale, offset, codes.dtype.itemsize * 8),
+        'moment': full['moment'],
+        'view': {'rays': [rayStart, rayCount], 'gates': [gateStart, gateEnd], 'decimation': [rayFactor, gateFactor]},
+    }
+
+# A sweep cropped to bbox (west, south, east, north) and max-pooled down to max_gates or
+# resolution, cut from the cached full resolution packed sweep. Returns None if the scan
+# has no such sweep.
+def get_sweep_view(cache, station: str, sweep: int, moment: str, timestamp: int, encoding='msgpack', compression=None,
+                   bbox=None, max_gates=None, resolution=None):
+    packed = get_sweep(cache, station, sweep, moment, timestamp, 'packed')
+    if packed is None:
+        return None
+    full = msgpack.unpackb(packed)
+    window = view_window(unpack_array(full['az']), unpack_array(full['ref_range']), full['cent_lon'], full['cent_lat'],
+                         bbox, max_gates, resolution)
+    rayStart, rayCount, gateStart, gateEnd, rayFactor, gateFactor = window
+    # The whole sweep at full resolution is the cached sweep itself
+    if (rayCount, gateStart, gateEnd, rayFactor, gateFactor) == (*full['data']['shape'][:1], 0, full['data']['shape'][1], 1, 1):
+        return get_sweep(cache, station, sweep, moment, timestamp, encoding, compression)
+
+    def compute():
+        with span('view', rays=rayCount // rayFactor, gates=-(-(gateEnd - gateStart) // gateFactor)):
+            view = _view_sweep(full, window)
+            store_grids(cache, station, [view])
+            return encode(view, full['timestamp'], encoding, compression)
+
+    key = sweep_cache_key(station, sweep, moment, timestamp, encoding, compression)
+    return cache.get_or_compute(f"{key}/view/{rayStart},{rayCount}/{gateStart},{gateEnd}/{rayFactor},{gateFactor}", compute)
@@ -1,56 +1,110 @@
+import asyncio
 import calendar
 import datetime
 import logging
-import threading
 import time
 
-from metpy.io import Level2File
-
 from .cache import Cache
-from .radar import get_radar_scan_time, extract_timestamp, get_specific_radar_scan, process
+from .jobs import get_queue, PRIORITY_PREFETCH
+from .metrics import WATCHER_LAG_SECONDS
+from .radar import list_scans_after, parse_scan_key, scan_job, ENCODINGS, PRODUCTS, SCAN_JOBS
+from .scan_index import ScanIndex
+from .watch_loop import WatchLoop
+
+# Volume coverage patterns take about 4-6 minutes, so a new volume is expected one
+# scan interval after the last one showed up. Polls start a little before that and
+# back off when the radar stays quiet.
+DEFAULT_SCAN_INTERVAL = 300
+MIN_SCAN_INTERVAL = 120
+MAX_SCAN_INTERVAL = 600
+POLL_LEAD = 20
+MIN_POLL = 5
+MAX_POLL = 300
 
-class RadarWatcher:
+class RadarWatcher(WatchLoop):
     def __init__(self, cache: Cache):
+        super().__init__()
         self.timestamps = dict()
-        self.threads = dict()
+        self.lastKeys = dict()
+        self.intervals = dict()
         self.cache = cache
+        self.scanIndex = ScanIndex(cache)
         self.eventListeners = {}
 
-    def _watch(self, station: str):
+    def _poll(self, station: str):
+        # Returns the newest scan's timestamp if a new volume showed up
+        keys = []
+        seeding = station not in self.lastKeys
+        for key in list_scans_after(station, self.lastKeys.get(station)):
+            try:
+                keys.append((calendar.timegm(parse_scan_key(key, station).utctimetuple()), key))
+            except ValueError:
+                continue
+        # The first poll lists yesterday and today, which seeds the scan index from
+        # yesterday's midnight on
+        since = None
+        if seeding:
+            since = calendar.timegm((datetime.datetime.now(datetime.UTC).date() - datetime.timedelta(days=1)).timetuple())
+        self.scanIndex.add(station, [ts for ts, _ in keys], since)
+        if len(keys) == 0:
+            return None
+        ts, self.lastKeys[station] = max(keys)
+        return ts
+
+    async def _watch(self, station: str):
+        loop = asyncio.get_running_loop()
+        expected = 0
+        misses = 0
         while True:
             try:
-                obj = get_radar_scan_time(station, 0)
-                timestamp = extract_timestamp(obj, station)
-                ts = calendar.timegm(timestamp.utctimetuple())
+                ts = await loop.run_in_executor(None, self._poll, station)
+            except Exception as e:
+                logging.info(f"Error watching radar: {repr(e)}")
+                print(f"Error watching radar: {repr(e)}")
+                ts = None
+
+            now = time.time()
+            if ts is not None:
                 if station not in self.timestamps:
                     self.timestamps[station] = ts
                 elif self.timestamps[station] < ts:
+                    interval = ts - self.timestamps[station]
+                    self.intervals[station] = min(max(interval, MIN_SCAN_INTERVAL), MAX_SCAN_INTERVAL)
                     self.timestamps[station] = ts
-                    self._notify(station, ts)
-            except Exception as e:
-                logging.info(f"Error watching radar: {repr(e)}")
-                print(f"Error watching radar: {repr(e)}")
-            time.sleep(1)
+                    try:
+                        await loop.run_in_executor(None, self._notify, station, ts)
+                    except Exception as e:
+                        logging.info(f"Error processing radar: {repr(e)}")
+                        print(f"Error processing radar: {repr(e)}")
+                expected = now + self.intervals.get(station, DEFAULT_SCAN_INTERVAL)
+                misses = 0
+
+            if now < expected - POLL_LEAD:
+                delay = expected - POLL_LEAD - now
+            else:
+                # Past the expected time, poll quickly at first then back off while the radar is idle
+                delay = min(MIN_POLL * 2 ** misses, MAX_POLL)
+                misses += 1
+            await asyncio.sleep(delay)
 
     def is_watching(self, station: str):
-        return station in self.threads
+        return station in self.tasks
+
+    def latest(self, station: str):
+        return self.timestamps.get(station)
 
     def start(self, station: str):
-        if station in self.threads:
-            raise ValueError("Already watching this station")
-        self.threads[station] = threading.Thread(target=self._watch, args=(station,), daemon=True)
-        self.threads[station].start()
+        self._schedule(station, self._watch)
 
     def stop(self, station: str):
-        if station not in self.threads:
-            raise ValueError("Not watching this station")
-        self.threads[station].join()
-        del self.threads[station]
+        self._cancel(station)
+        self.lastKeys.pop(station, None)
 
     def stop_all(self):
-        for station in list(self.threads.keys()):
+        for station in self.watching():
             self.stop(station)
         self.timestamps.clear()
+        self._close()
 
     def add_event_listener(self, listener, station: str = '*'):
         if self.eventListeners.get(station) is not None:
@@ -66,16 +120,14 @@ class RadarWatcher:
             self.eventListeners[station].remove(listener)
 
     def _notify(self, station: str, timestamp: int):
+        # Cache reflectivity for every sweep elevation in the volume, in the original format
+        # for existing clients and packed for tiles and mosaics, along with the volume
+        # products computed from it. Other moments are processed on request from the
+        # stored volume.
         timeStart = time.monotonic()
-        obj = get_specific_radar_scan(station, timestamp)
-        f = Level2File(obj['Body'])
-        logging.info(f"_notify download took {datetime.timedelta(seconds=time.monotonic() - timeStart)}")
-
-        # Cache the 7 radar sweep elevations
-        for i in range(7):
-            if not self.cache.has(f"{station}/{i}/{timestamp}"):
-                packed = process(f, i, timestamp)
-                self.cache.set(f"{station}/{i}/{timestamp}", packed)
+        get_queue(self.cache, SCAN_JOBS).wait(scan_job(station, timestamp, ['REF', *PRODUCTS], [(encoding, None) for encoding in ENCODINGS]), PRIORITY_PREFETCH)
+        logging.info(f"_notify processing {station} {timestamp} took {datetime.timedelta(seconds=time.monotonic() - timeStart)}")
+        WATCHER_LAG_SECONDS.labels(station).observe(time.time() - timestamp)
         # Then notify the listeners
         for listener in self.eventListeners.get(station, []) + self.eventListeners.get('*', []):
             try:
@@ -0,0 +1,57 @@
+import datetime
+
+from .cache import Cache
+from .radar import list_scans_between
+
+# Roughly three days of volumes at 4-6 minutes apart
+SCAN_INDEX_SIZE = 1000
+# The watcher refreshes this on every poll, so an index that outlives it isn't trusted
+SCAN_INDEX_FRESHNESS = datetime.timedelta(minutes=15)
+
+# Sorted set of recent scan timestamps per station, kept up to date by the RadarWatcher
+class ScanIndex:
+    def __init__(self, cache: Cache):
+        self.cache = cache
+
+    # since is given when the timestamps are every scan from then on, as when the watcher
+    # seeds the index
+    def add(self, station: str, timestamps, since: int = None):
+        station = station.upper()
+        if len(timestamps) > 0:
+            self.cache.zadd(f"scans/{station}", {str(ts): ts for ts in timestamps}, SCAN_INDEX_SIZE)
+        if since is not None:
+            self.cache.set(f"scans/{station}/since", since, None)
+        self.cache.set(f"scans/{station}/fresh", 1, SCAN_INDEX_FRESHNESS)
+
+    def is_indexed(self, station: str):
+        return self.cache.has(f"scans/{station.upper()}/fresh")
+
+    def latest(self, station: str, last: int = 0):
+        # last is the offset from the most recent scan
+        timestamps = self.cache.zrevrange(f"scans/{station.upper()}", last, last)
+        if len(timestamps) == 0:
+            raise ValueError("Invalid last value")
+        return int(timestamps[0])
+
+    # Time from which the index holds every scan of the station, None if it isn't indexed
+    def coverage(self, station: str):
+        station = station.upper()
+        fresh, since = self.cache.get_many([f"scans/{station}/fresh", f"scans/{station}/since"])
+        if fresh is None or since is None:
+            return None
+        # Once full, the oldest scans have been trimmed
+        oldest = self.cache.zrevrange(f"scans/{station}", SCAN_INDEX_SIZE - 1, SCAN_INDEX_SIZE - 1)
+        return max(int(since), int(oldest[0])) if len(oldest) > 0 else int(since)
+
+    def between(self, station: str, start: int, end: int):
+        return [int(ts) for ts in self.cache.zrangebyscore(f"scans/{station.upper()}", start, end)]
+
+# Scan timestamps between start and end, from the index for the part of the range it
+# covers and listed from S3 for the rest
+def scans_between(index: ScanIndex, station: str, start: int, end: int):
+    since = index.coverage(station)
+    if since is None or since > end:
+        return list_scans_between(station, start, end)
+    if since <= start:
+        return index.between(station, start, end)
+    return list_scans_between(station, start, since - 1) + index.between(station, since, end)
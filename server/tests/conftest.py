@@ -0,0 +1,15 @@
+import fakeredis
+import pytest
+
+from server.cache import Cache
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+# A Cache over an in-memory redis of its own for each test
+@pytest.fixture
+def cache(server):
+    cache = Cache(client=fakeredis.FakeStrictRedis(server=server))
+    yield cache
+    cache.close()
@@ -0,0 +1,102 @@
+import asyncio
+import json
+
+import pytest
+
+from server import alert
+from server.alert_watcher import AlertWatcher, ALERT_SNAPSHOT_EXPIRATION
+from server.bench.fixtures import alerts_geojson
+from server.bench.standins import NWSServer
+from server.zones import ZoneStore
+
+@pytest.fixture
+def nws(monkeypatch):
+    nws = NWSServer(alerts=3, zones_per_alert=2).start()
+    monkeypatch.setattr(alert, 'NWS_API', nws.url)
+    yield nws
+    nws.stop()
+
+@pytest.fixture
+def watcher(cache):
+    watcher = AlertWatcher(cache, ZoneStore(cache))
+    changes = []
+    watcher.add_event_listener(lambda state, change: changes.append(change), 'OK')
+    watcher.changes = changes
+    return watcher
+
+def _refresh(watcher: AlertWatcher):
+    asyncio.run(watcher._refresh('OK'))
+
+def _features(nws: NWSServer):
+    return json.loads(alerts_geojson(nws.url, nws.state, alerts=3, zones_per_alert=2, storms=0))['features']
+
+def _publish(nws: NWSServer, features):
+    nws.set_alerts(json.dumps({'type': 'FeatureCollection', 'features': features}).encode())
+
+def test_unchanged_alerts_are_not_downloaded_again(nws, cache, watcher):
+    _refresh(watcher)
+    snapshot = cache.get('alerts/OK')
+    # Three zone based alerts and the stand-in's five storm based ones
+    assert len(json.loads(snapshot)) == 8
+
+    cache.cache.expire('ALERTS/OK', 5)
+    _refresh(watcher)
+    assert nws.not_modified == 1
+    assert watcher.changes == []
+    # The snapshot is kept and its expiry pushed back
+    assert cache.get('alerts/OK') == snapshot
+    assert cache.cache.ttl('ALERTS/OK') > 5
+
+def test_changes_are_diffed_by_id(nws, watcher):
+    features = _features(nws)
+    _publish(nws, features)
+    _refresh(watcher)
+    assert watcher.changes == []
+
+    added = json.loads(json.dumps(features[0]))
+    added['id'] = added['properties']['id'] = 'urn:oid:added'
+    features[1]['properties']['headline'] = "Updated headline"
+    _publish(nws, [features[1], features[2], added])
+    _refresh(watcher)
+
+    assert len(watcher.changes) == 1
+    change = watcher.changes[0]
+    assert [a['id'] for a in change['added']] == ['urn:oid:added']
+    assert [a['headline'] for a in change['updated']] == ["Updated headline"]
+    assert change['expired'] == [features[0]['properties']['id']]
+
+def test_alerts_that_end_expire(nws, cache, watcher):
+    _publish(nws, _features(nws))
+    _refresh(watcher)
+    _publish(nws, [])
+    _refresh(watcher)
+    assert len(watcher.changes[0]['expired']) == 3
+    assert json.loads(cache.get('alerts/OK')) == []
+    assert cache.cache.ttl('ALERTS/OK') <= ALERT_SNAPSHOT_EXPIRATION.total_seconds()
+
+def test_api_errors_keep_the_last_alerts(nws, cache, watcher):
+    _publish(nws, _features(nws))
+    _refresh(watcher)
+    snapshot = cache.get('alerts/OK')
+    validators = watcher.validators['OK']
+
+    nws.set_alerts(json.dumps({'title': "Service Unavailable", 'status': 503}).encode(), status=503)
+    with pytest.raises(ValueError):
+        _refresh(watcher)
+    nws.set_alerts(json.dumps({'type': 'Feature'}).encode())
+    with pytest.raises(ValueError):
+        _refresh(watcher)
+    assert cache.get('alerts/OK') == snapshot
+    assert watcher.validators['OK'] == validators
+    assert watcher.changes == []
+
+def test_snapshot_is_served_once_polled(nws, cache):
+    watcher = AlertWatcher(cache, ZoneStore(cache))
+    try:
+        snapshot = watcher.snapshot('ok')
+    finally:
+        watcher.stop_all()
+    alerts = json.loads(snapshot)
+    assert len(alerts) == 8
+    # Zone based alerts got their zones' polygons, storm based ones keep their own
+    assert sorted(a['geometry']['type'] for a in alerts) == ['MultiPolygon'] * 3 + ['Polygon'] * 5
@@ -0,0 +1,43 @@
+import concurrent.futures
+import gzip
+import json
+
+from server.basemap import build_layer, negotiate_encoding, BASEMAP_ZOOM_DETAIL, ENCODINGS
+from server.geometry import detail_for_zoom
+
+def _source(tmp_path):
+    source = tmp_path / "states.json"
+    source.write_text(json.dumps({'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'properties': {}, 'geometry': {'type': 'Polygon', 'coordinates': [[[-100, 35], [-99, 35], [-99, 36], [-100, 35]]]}},
+    ]}))
+    return str(source)
+
+def _layer(tmp_path):
+    return build_layer(_source(tmp_path), str(tmp_path / "build"))
+
+def test_each_encoding_has_its_own_etag(tmp_path):
+    layer = _layer(tmp_path)
+    for variant in layer.values():
+        assert len(set(variant['etags'].values())) == len(ENCODINGS)
+        assert gzip.decompress(variant['encodings']['gzip']) == variant['encodings']['identity']
+
+def test_built_layers_are_reused(tmp_path):
+    assert _layer(tmp_path) == _layer(tmp_path)
+
+def test_encoding_follows_accept_encoding():
+    assert negotiate_encoding("gzip, deflate") == 'gzip'
+    assert negotiate_encoding("gzip;q=0") == 'identity'
+    assert negotiate_encoding(None) == 'identity'
+
+def test_concurrent_builds_do_not_clash(tmp_path):
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        source = _source(tmp_path)
+        layers = list(executor.map(lambda _: build_layer(source, str(tmp_path / "build")), range(8)))
+    assert all(layer == layers[0] for layer in layers)
+    assert not list((tmp_path / "build").glob("*.tmp"))
+
+def test_detail_follows_the_zoom():
+    assert detail_for_zoom(2, BASEMAP_ZOOM_DETAIL) == 'low'
+    assert detail_for_zoom(6, BASEMAP_ZOOM_DETAIL) == 'medium'
+    assert detail_for_zoom(7, BASEMAP_ZOOM_DETAIL) == 'full'
+    assert detail_for_zoom(None, BASEMAP_ZOOM_DETAIL) == 'full'
@@ -0,0 +1,97 @@
+import threading
+import time
+
+import msgpack
+import pytest
+
+from server import broadcast
+from server.broadcast import StationHub, Subscriber, MAX_PENDING_FRAMES
+from server.radar import sweep_cache_key
+
+class Watcher:
+    def __init__(self):
+        self.listeners = []
+
+    def add_event_listener(self, listener, station: str = '*'):
+        self.listeners.append(listener)
+
+    def is_watching(self, station: str):
+        return True
+
+    def start(self, station: str):
+        pass
+
+    def stop(self, station: str):
+        pass
+
+    def latest(self, station: str):
+        return None
+
+def _subscriber(hub: StationHub, sweeps):
+    subscriber = Subscriber()
+    hub.join('KTLX', subscriber)
+    hub.subscribe('KTLX', subscriber, {'sweeps': sweeps, 'moment': 'REF', 'encoding': 'packed', 'compression': None})
+    return subscriber
+
+def _next(subscriber: Subscriber, timeout: float = 5):
+    frames = []
+    thread = threading.Thread(target=lambda: frames.append(subscriber.next()), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return msgpack.unpackb(frames[0]) if frames else None
+
+def test_cached_sweeps_are_pushed_from_the_event(cache, monkeypatch):
+    monkeypatch.setattr(broadcast, 'get_sweep', lambda *args: pytest.fail("Cached sweeps shouldn't be fetched"))
+    hub = StationHub(cache, Watcher())
+    subscriber = _subscriber(hub, [0])
+    cache.set(sweep_cache_key('KTLX', 0, 'REF', 1000, 'packed'), b'sweep')
+    hub._fan_out('KTLX', 1000)
+    frame = _next(subscriber)
+    assert frame['payload'] == b'sweep' and frame['timestamp'] == 1000
+
+def test_missing_sweeps_do_not_hold_up_the_event(cache, monkeypatch):
+    release = threading.Event()
+    def get_sweep(cache, station, sweep, moment, timestamp, encoding, compression):
+        release.wait(5)
+        return b'processed'
+    monkeypatch.setattr(broadcast, 'get_sweep', get_sweep)
+    hub = StationHub(cache, Watcher())
+    subscriber = _subscriber(hub, [1])
+
+    timeStart = time.monotonic()
+    hub._fan_out('KTLX', 1000)
+    assert time.monotonic() - timeStart < 1
+    release.set()
+    assert _next(subscriber)['payload'] == b'processed'
+
+def test_late_frames_of_older_scans_are_dropped():
+    subscriber = Subscriber()
+    subscriber.push(('scan', 0), b'new', 2000)
+    subscriber.push(('scan', 0), b'old', 1000)
+    assert subscriber.next() == b'new'
+    assert len(subscriber.pending) == 0
+
+def test_overflowing_update_streams_start_over_from_a_snapshot():
+    subscriber = Subscriber(resync=lambda: 'snapshot 2')
+    subscriber.push(('snapshot',), 'snapshot 1')
+    for i in range(MAX_PENDING_FRAMES):
+        subscriber.push(('update', i), f'update {i}')
+    assert subscriber.next() == 'snapshot 2'
+    # Updates after the new snapshot still arrive, in order
+    subscriber.push(('update', 100), 'update 100')
+    subscriber.push(('update', 101), 'update 101')
+    assert [subscriber.next(), subscriber.next()] == ['update 100', 'update 101']
+
+def test_update_streams_without_a_snapshot_are_closed_on_overflow():
+    subscriber = Subscriber(resync=lambda: None)
+    for i in range(MAX_PENDING_FRAMES + 1):
+        subscriber.push(('update', i), f'update {i}')
+    assert subscriber.next() is None
+    assert subscriber.closed
+
+def test_other_streams_drop_their_oldest_frames():
+    subscriber = Subscriber()
+    for i in range(MAX_PENDING_FRAMES + 1):
+        subscriber.push(('scan', i), f'sweep {i}')
+    assert subscriber.next() == 'sweep 1'
+    assert subscriber.dropped == 1
@@ -0,0 +1,152 @@
+import datetime
+import threading
+import time
+
+import fakeredis
+import pytest
+
+from server.cache import Cache, LocalCache, L1_MAX_TTL
+
+def _wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+def test_local_cache_evicts_least_recently_used_by_bytes():
+    local = LocalCache(max_bytes=400)
+    for key in ('a', 'b', 'c', 'd'):
+        local.put(key, b'x' * 100, -1, local.generation)
+    local.get('a')
+    local.put('e', b'x' * 100, -1, local.generation)
+    assert local.get('b') is None
+    assert local.get('a') is not None
+    assert local.stats()['bytes'] == 400
+
+def test_local_cache_skips_values_read_before_an_invalidation():
+    local = LocalCache()
+    generation = local.generation
+    local.invalidate(['A'])
+    local.put('A', b'stale', -1, generation)
+    assert local.get('A') is None
+
+def test_fetch_racing_a_write_is_not_kept_locally(cache):
+    cache.set('key', b'old')
+    client = cache.cache
+
+    # Another write lands while the read is in flight
+    class Racing:
+        def __init__(self, pipe):
+            self.pipe = pipe
+
+        def __getattr__(self, name):
+            return getattr(self.pipe, name)
+
+        def execute(self):
+            results = self.pipe.execute()
+            cache.local.invalidate(['KEY'])
+            return results
+
+    cache.cache = type('Client', (), {'pipeline': lambda self, **kwargs: Racing(client.pipeline(**kwargs))})()
+    try:
+        assert cache.get('key') == b'old'
+    finally:
+        cache.cache = client
+    assert not cache.local.has('KEY')
+
+def test_local_copies_follow_the_redis_ttl(cache):
+    cache.set('short', b'value', datetime.timedelta(seconds=2))
+    cache.set('forever', b'value', None)
+    cache.get('short')
+    cache.get('forever')
+    assert cache.local.entries['SHORT'][1] - time.monotonic() <= 2
+    assert cache.local.entries['FOREVER'][1] - time.monotonic() == pytest.approx(L1_MAX_TTL, abs=1)
+
+def test_expired_local_copy_is_read_again(cache):
+    cache.set('key', b'first')
+    cache.get('key')
+    # Changed behind the cache's back, then the local copy expires
+    cache.cache.set('KEY', b'second')
+    value, _ = cache.local.entries['KEY']
+    cache.local.entries['KEY'] = (value, time.monotonic() - 1)
+    assert cache.get('key') == b'second'
+
+def test_writes_from_another_process_invalidate_local_copies(server, cache):
+    other = Cache(client=fakeredis.FakeStrictRedis(server=server))
+    try:
+        cache.set('key', b'first')
+        assert cache.get('key') == b'first'
+        other.set('key', b'second')
+        assert _wait_for(lambda: not cache.local.has('KEY'))
+        assert cache.get('key') == b'second'
+    finally:
+        other.close()
+
+def test_get_or_compute_runs_one_compute_for_concurrent_misses(cache):
+    calls = []
+    release = threading.Event()
+    def compute():
+        calls.append(1)
+        release.wait(5)
+        return b'value'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute('key', compute))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    _wait_for(lambda: len(cache.inflight) == 1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(calls) == 1
+    assert results == [b'value'] * 8
+    assert cache.get('key') == b'value'
+    assert cache.inflight == {}
+
+def test_get_or_compute_shares_errors_and_does_not_cache_none(cache):
+    release = threading.Event()
+    def failing():
+        release.wait(5)
+        raise ValueError("No such sweep")
+
+    errors = []
+    def request():
+        try:
+            cache.get_or_compute('key', failing)
+        except ValueError as e:
+            errors.append(e)
+    threads = [threading.Thread(target=request) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    _wait_for(lambda: len(cache.inflight) == 1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(errors) == 4
+    assert cache.inflight == {}
+
+    assert cache.get_or_compute('missing', lambda: None) is None
+    assert not cache.has('missing')
+
+def test_only_the_owner_renews_or_releases_a_lock(cache):
+    expiration = datetime.timedelta(seconds=10)
+    assert cache.acquire_lock('lock', 'a', expiration)
+    assert not cache.acquire_lock('lock', 'b', expiration)
+    assert not cache.renew_lock('lock', 'b', expiration)
+    assert not cache.release_lock('lock', 'b')
+    assert cache.renew_lock('lock', 'a', expiration)
+    assert cache.release_lock('lock', 'a')
+    assert cache.acquire_lock('lock', 'b', expiration)
+
+def test_lock_taken_over_mid_transaction_is_left_alone(server, cache):
+    other = fakeredis.FakeStrictRedis(server=server)
+    assert cache.acquire_lock('lock', 'a', datetime.timedelta(seconds=10))
+
+    # The lock expires and b takes it between the ownership check and the delete
+    def take_over(pipe, key):
+        other.set(key, 'b')
+        pipe.delete(key)
+    assert not cache._if_lock_owner('lock', 'a', take_over)
+    assert other.get('LOCK') == b'b'
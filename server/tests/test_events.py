@@ -0,0 +1,79 @@
+import time
+
+import pytest
+
+from server import events
+from server.events import watched, RemoteAlertWatcher, RemoteRadarWatcher, WatchList, WATCHED_STATES, WATCHED_STATIONS, WATCH_EXPIRATION
+
+def test_unknown_codes_are_not_watched(cache):
+    watcher = RemoteRadarWatcher(cache)
+    with pytest.raises(ValueError):
+        watcher.start('KXYZ')
+    with pytest.raises(ValueError):
+        RemoteAlertWatcher(cache).snapshot('XX')
+    assert watched(cache, WATCHED_STATIONS) == set()
+    assert watched(cache, WATCHED_STATES) == set()
+
+def test_entries_nobody_refreshes_expire(cache, monkeypatch):
+    watcher = RemoteRadarWatcher(cache)
+    watcher.start('ktlx')
+    assert watcher.is_watching('KTLX')
+    assert watched(cache, WATCHED_STATIONS) == {'KTLX'}
+    later = time.time() + WATCH_EXPIRATION + 1
+    monkeypatch.setattr(events.time, 'time', lambda: later)
+    assert not watcher.is_watching('KTLX')
+    assert watched(cache, WATCHED_STATIONS) == set()
+    assert cache.zrangebyscore(WATCHED_STATIONS, '-inf', '+inf') == []
+
+def test_connected_clients_keep_their_entries_alive(cache, monkeypatch):
+    watching = WatchList(cache, WATCHED_STATIONS, {'KTLX', 'KINX'})
+    watching.acquire('KTLX')
+    watching.acquire('KINX')
+    watching.release('KINX')
+    later = time.time() + WATCH_EXPIRATION + 1
+    monkeypatch.setattr(events.time, 'time', lambda: later)
+    # What the heartbeat thread does every WATCH_HEARTBEAT
+    for code in list(watching.counts):
+        watching.touch(code, force=True)
+    assert watched(cache, WATCHED_STATIONS) == {'KTLX'}
+
+def test_snapshot_does_not_wait_for_the_first_poll(cache):
+    watcher = RemoteAlertWatcher(cache)
+    timeStart = time.monotonic()
+    assert watcher.snapshot('ok') is None
+    assert time.monotonic() - timeStart < 1
+    # The leader picks the state up on its next sync
+    assert watched(cache, WATCHED_STATES) == {'OK'}
+    cache.set('alerts/OK', b'[]')
+    assert watcher.snapshot('OK') == b'[]'
+
+class Watcher:
+    def __init__(self, watching=()):
+        self.tasks = set(watching)
+
+    def watching(self):
+        return list(self.tasks)
+
+    def is_watching(self, code: str):
+        return code in self.tasks
+
+    def start(self, code: str):
+        self.tasks.add(code)
+
+    def stop(self, code: str):
+        self.tasks.remove(code)
+
+def test_worker_stops_watching_what_expired(cache, monkeypatch):
+    from server import worker
+    from server.worker import Worker
+    monkeypatch.setattr(worker, 'DEFAULT_STATIONS', ['KTLX'])
+    monkeypatch.setattr(worker, 'DEFAULT_STATES', ['KS'])
+    leader = Worker(cache)
+    leader.watcher = Watcher(['KTLX', 'KAMA', 'KFWS'])
+    leader.alertWatcher = Watcher(['OK', 'TX'])
+    leader.mosaics = type('Mosaics', (), {'stations': lambda self: ['KAMA']})()
+    RemoteRadarWatcher(cache).start('KINX')
+    RemoteAlertWatcher(cache).snapshot('OK')
+    leader._sync()
+    assert leader.watcher.tasks == {'KTLX', 'KAMA', 'KINX'}
+    assert leader.alertWatcher.tasks == {'OK', 'KS'}
@@ -0,0 +1,81 @@
+import threading
+
+import pytest
+
+from server.jobs import JobQueue, MAX_ATTEMPTS, PRIORITY_INTERACTIVE, PRIORITY_PREFETCH
+
+@pytest.fixture
+def queue(cache):
+    return JobQueue(cache, 'test')
+
+@pytest.fixture
+def work(queue):
+    stopping = threading.Event()
+    threads = []
+    def work(handler):
+        thread = threading.Thread(target=queue.work, args=(handler, stopping), daemon=True)
+        thread.start()
+        threads.append(thread)
+    yield work
+    stopping.set()
+    for thread in threads:
+        thread.join(5)
+
+def _queued(queue: JobQueue):
+    return [member.decode() for member in queue.redis.zrange(queue.queueKey, 0, -1)]
+
+# A job's queue entry has expired as if its worker died while running it
+def _expire(queue: JobQueue, member: str):
+    queue.redis.zadd(queue.processingKey, {member: 0})
+
+def test_identical_jobs_run_once(queue, work):
+    first = queue.submit({'station': 'KTLX', 'timestamp': 1000})
+    second = queue.submit({'timestamp': 1000, 'station': 'KTLX'}, PRIORITY_INTERACTIVE)
+    assert len(_queued(queue)) == 1
+
+    calls = []
+    work(lambda cache, job: calls.append(job))
+    first.result(5)
+    second.result(5)
+    assert calls == [{'station': 'KTLX', 'timestamp': 1000}]
+
+def test_interactive_jobs_move_ahead_of_prefetching(queue):
+    queue.submit({'job': 'a'})
+    queue.submit({'job': 'b'})
+    queue.submit({'job': 'b'}, PRIORITY_INTERACTIVE)
+    assert _queued(queue) == ['{"job":"b"}', '{"job":"a"}']
+    # Asking again at a lower priority doesn't move it back
+    queue.submit({'job': 'b'}, PRIORITY_PREFETCH)
+    assert _queued(queue) == ['{"job":"b"}', '{"job":"a"}']
+
+def test_lost_jobs_are_requeued_first(queue):
+    queue.submit({'job': 'a'})
+    queue.submit({'job': 'b'})
+    member, attempts = queue._claim()
+    assert (member, attempts) == ('{"job":"a"}', 1)
+
+    queue._requeue_expired()
+    assert _queued(queue) == ['{"job":"b"}']
+    _expire(queue, member)
+    queue._requeue_expired()
+    assert _queued(queue) == ['{"job":"a"}', '{"job":"b"}']
+    assert queue._claim() == ('{"job":"a"}', 2)
+
+def test_jobs_that_keep_getting_lost_fail(queue, work):
+    future = queue.submit({'job': 'a'})
+    for _ in range(MAX_ATTEMPTS):
+        member, _ = queue._claim()
+        _expire(queue, member)
+        queue._requeue_expired()
+
+    work(lambda cache, job: pytest.fail("Jobs past their attempts shouldn't run"))
+    with pytest.raises(RuntimeError, match=f"after {MAX_ATTEMPTS} attempts"):
+        future.result(5)
+
+def test_value_errors_reach_the_requester(queue, work):
+    def handler(cache, job):
+        raise ValueError("No such sweep")
+    work(handler)
+    with pytest.raises(ValueError, match="No such sweep"):
+        queue.wait({'job': 'a'}, timeout=5)
+    assert queue.waiters == {}
@@ -0,0 +1,53 @@
+import msgpack
+import numpy as np
+
+from server.mosaic import latest_mosaic, mosaic_at, Mosaic, MOSAIC_WINDOW
+from server.packing import pack_array
+
+STATIONS = {'KTLX': (-97.278, 35.333), 'KAMA': (-101.709, 35.233)}
+
+def _sweep(station: str):
+    lon, lat = STATIONS[station]
+    return {
+        'cent_lon': lon,
+        'cent_lat': lat,
+        'ref_range': pack_array(np.arange(0, 460001, 250.), '<f4'),
+        'data': {'scale': 2., 'offset': 66.},
+    }
+
+def _layer(mosaic: Mosaic, code: int):
+    return np.full(mosaic.lon.size, code, dtype=np.uint8)
+
+def test_composite_takes_the_highest_code():
+    mosaic = Mosaic('OK', 'max')
+    mosaic.update('KTLX', 1000, _sweep('KTLX'), _layer(mosaic, 100))
+    mosaic.update('KAMA', 1100, _sweep('KAMA'), _layer(mosaic, 120))
+    assert mosaic.data.max() == 120
+    assert set(msgpack.unpackb(mosaic.encode())['stations']) == {'KTLX', 'KAMA'}
+
+def test_older_scans_are_ignored():
+    mosaic = Mosaic('OK', 'max')
+    assert mosaic.update('KTLX', 1000, _sweep('KTLX'), _layer(mosaic, 100))
+    assert not mosaic.update('KTLX', 900, _sweep('KTLX'), _layer(mosaic, 150))
+    assert mosaic.data.max() == 100
+
+def test_stations_outside_the_window_drop_out():
+    mosaic = Mosaic('OK', 'max')
+    mosaic.update('KAMA', 1000, _sweep('KAMA'), _layer(mosaic, 150))
+    # Resampled layers are below threshold past the radar's range
+    far = (mosaic._footprint('KTLX', _sweep('KTLX'))[0] == np.inf).ravel()
+    assert far.any()
+    mosaic.update('KTLX', 1000 + MOSAIC_WINDOW + 1, _sweep('KTLX'), np.where(far, 0, _layer(mosaic, 100)).astype(np.uint8))
+    assert list(mosaic.layers) == ['KTLX']
+    # Nothing of KAMA is left, even where KTLX doesn't reach
+    assert mosaic.data.max() == 100
+    assert (mosaic.data.ravel()[far] == 0).all()
+
+def test_mosaics_are_looked_up_from_the_history(cache):
+    cache.set_many({'mosaic/OK/1000': b'first', 'mosaic/OK/1300': b'second', 'mosaic/OK/latest': 1300})
+    cache.zadd('mosaics/OK', {'1000': 1000, '1300': 1300})
+    assert latest_mosaic(cache, 'OK') == b'second'
+    assert mosaic_at(cache, 'OK', 1200) == b'first'
+    assert mosaic_at(cache, 'OK', 1300) == b'second'
+    assert mosaic_at(cache, 'OK', 999) is None
+    assert mosaic_at(cache, 'OK', 1300 + MOSAIC_WINDOW + 1) is None
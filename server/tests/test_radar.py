@@ -0,0 +1,132 @@
+import collections
+import types
+
+import msgpack
+import numpy as np
+import pytest
+
+from server.packing import unpack_array
+from server.radar import _beam_height, _encode_codes, _Header, _kdp, _pool, encode, encode_delta, extract_products, view_window, \
+    ECHO_TOP_DBZ, KDP_WINDOW, VIEW_BLOCK
+
+Header = collections.namedtuple('Header', ['name', 'scale', 'offset', 'data_size', 'gate_width'])
+PHI = Header(b'PHI', 2.8361, 2., 16, 0.25)
+
+def _decode(codes, hdr):
+    return (codes.astype(float) - hdr.offset) / hdr.scale
+
+def test_codes_are_clipped_instead_of_wrapping():
+    hdr = Header(b'KDP', 100., 1000., 16, 0.25)
+    codes = _encode_codes(np.array([np.nan, -20., 0., 1000.]), hdr)
+    assert codes.dtype == np.dtype('<u2')
+    assert codes.tolist() == [0, 2, 1000, 65535]
+
+def test_byte_codes_keep_below_threshold_apart():
+    hdr = Header(b'REF', 2., 66., 8, 0.25)
+    assert _encode_codes(np.array([np.nan, -40., 20., 200.]), hdr).tolist() == [0, 2, 106, 255]
+
+def test_kdp_is_half_the_phase_slope():
+    # 1 degree per gate of 0.25 km is 2 deg/km of KDP
+    phi = np.tile(np.arange(200.) + 20, (3, 1))
+    kdp, hdr = _kdp(phi, PHI)
+    inner = kdp[:, KDP_WINDOW:-KDP_WINDOW]
+    assert np.allclose(inner, 2.)
+    assert hdr.name == b'KDP' and hdr.data_size == 16
+
+def test_kdp_ignores_phase_folding():
+    phi = np.tile((np.arange(200.) * 0.5 + 300) % 360, (2, 1))
+    phi[:, 60:65] = np.nan
+    kdp, hdr = _kdp(phi, PHI)
+    assert np.isnan(kdp[:, 60:65]).all()
+    valid = kdp[~np.isnan(kdp)]
+    assert np.abs(valid).max() < 2.
+    decoded = _decode(_encode_codes(kdp, hdr), hdr)
+    assert decoded[~np.isnan(kdp)].max() < 2.
+
+def test_negative_kdp_does_not_wrap():
+    phi = np.tile(300. - np.arange(200.) * 10 % 360, (1, 1))
+    kdp, hdr = _kdp(phi, PHI)
+    decoded = _decode(_encode_codes(kdp, hdr), hdr)
+    assert decoded.max() < 1.
+
+AZ = np.arange(361.)
+RANGE = np.arange(0., 40001., 250.)
+ELEVATIONS = [0.5, 1.5, 2.5]
+SITE = types.SimpleNamespace(site_amsl=370., feedhorn_agl=20.)
+
+def _volume(*tilts):
+    # A stand-in Level2File with a sweep per elevation, on one grid
+    f = types.SimpleNamespace(sweeps=[[(types.SimpleNamespace(el_angle=el), SITE)] for el in ELEVATIONS])
+    sweeps = {i: {'cent_lon': -97.278, 'cent_lat': 35.333, 'az': AZ, 'ref_range': RANGE, 'data': data} for i, data in enumerate(tilts)}
+    return f, sweeps
+
+def test_volume_products():
+    shape = (len(AZ) - 1, len(RANGE) - 1)
+    low = np.full(shape, 30.)
+    middle = np.full(shape, 20.)
+    middle[:10] = 45.
+    high = np.full(shape, np.nan)
+    high[:, :20] = 10.
+    f, sweeps = _volume(low, middle, high)
+    products = extract_products(f, sweeps)
+
+    assert np.array_equal(products['CREF']['data'], np.fmax.reduce([low, middle, high]))
+    centers = (RANGE[:-1] + RANGE[1:]) / 2
+    heights = np.array([_beam_height(el, centers) for el in ELEVATIONS])
+    # The middle tilt is the highest at or above ECHO_TOP_DBZ everywhere
+    assert middle.min() >= ECHO_TOP_DBZ > np.nanmax(high)
+    assert products['ET']['data'] == pytest.approx(np.broadcast_to((heights[1] + 390.) / 1000., shape), rel=1e-4)
+
+    # Liquid from each layer between tilts, with no echo the same as Z = 0
+    z = np.nan_to_num(10. ** (np.array([low, middle, high]) / 10.))
+    layers = 3.44e-6 * ((z[:-1] + z[1:]) / 2) ** (4. / 7.) * np.diff(heights, axis=0)[:, None, :]
+    assert products['VIL']['data'] == pytest.approx(layers.sum(axis=0), rel=1e-3)
+    assert products['VIL']['data'][0, 0] > products['VIL']['data'][-1, 0]
+
+def test_whole_sweep_is_decimated_to_max_gates():
+    rng = np.arange(0., 1001.) * 250.
+    assert view_window(AZ, rng, -97.278, 35.333, max_gates=300) == (0, 360, 0, 1000, 1, 4)
+    assert view_window(AZ, rng, -97.278, 35.333) == (0, 360, 0, 1000, 1, 1)
+
+def test_viewport_north_of_the_radar_wraps_past_the_last_ray():
+    rng = np.arange(0., 1841.) * 250.
+    rayStart, rayCount, gateStart, gateEnd, rayFactor, gateFactor = view_window(AZ, rng, -97.278, 35.333, bbox=(-97.8, 35.6, -96.8, 36.2))
+    assert rayStart % VIEW_BLOCK == 0 and gateStart % VIEW_BLOCK == 0
+    assert rayStart > 270 and rayStart + rayCount > 360 and rayCount < 180
+    # The box is about 30 to 100 km away
+    assert 0 < rng[gateStart] < 30000 and 100000 < rng[gateEnd] < 120000
+
+def test_pooling_keeps_the_highest_code():
+    codes = np.array([[0, 5, 1, 0, 9], [3, 2, 0, 0, 0], [7, 0, 0, 1, 0]], dtype=np.uint8)
+    assert _pool(codes, 2, 2, 66.).tolist() == [[5, 1, 9], [7, 1, 0]]
+
+def test_magnitude_pooling_keeps_the_strongest_velocity():
+    # Codes either side of the offset are inbound and outbound, 0 and 1 aren't measurements
+    codes = np.array([[120, 135, 0, 1], [129, 129, 1, 0]], dtype=np.uint8)
+    assert _pool(codes, 2, 2, 129., magnitude=True).tolist() == [[120, 1]]
+
+def _packed(data, timestamp, scale=2., rng=RANGE):
+    sweep = {'cent_lon': -97.278, 'cent_lat': 35.333, 'az': AZ, 'ref_range': rng, 'data': data, 'hdr': _Header(scale, 66., 8), 'moment': 'REF'}
+    return encode(sweep, timestamp, 'packed')
+
+def test_delta_is_the_xor_of_the_codes():
+    rng = np.random.default_rng(0)
+    previous = rng.uniform(-30., 70., (360, 160))
+    current = previous.copy()
+    current[:20] = np.nan
+    base = _packed(previous, 1000)
+    delta = msgpack.unpackb(encode_delta(_packed(current, 1300), base, 1000))
+    assert delta['data']['delta'] and 'az' not in delta
+    codes = unpack_array(delta['data']) ^ unpack_array(msgpack.unpackb(base)['data'])
+    assert np.array_equal(codes, unpack_array(msgpack.unpackb(_packed(current, 1300))['data']))
+    assert (unpack_array(delta['data'])[20:] == 0).all()
+
+def test_delta_falls_back_when_scans_do_not_line_up():
+    data = np.full((360, 160), 20.)
+    delta = msgpack.unpackb(encode_delta(_packed(data, 1300, scale=4.), _packed(data, 1000), 1000))
+    assert not delta['data']['delta']
+    assert (unpack_array(delta['data']) == 146).all()
+    longer = np.arange(0., 40251., 250.)
+    delta = msgpack.unpackb(encode_delta(_packed(np.full((360, 161), 20.), 1300, rng=longer), _packed(data, 1000), 1000))
+    assert not delta['data']['delta']
+    assert np.array_equal(unpack_array(delta['ref_range']), longer.astype('<f4'))
@@ -0,0 +1,41 @@
+import pytest
+
+from server import scan_index
+from server.scan_index import scans_between, ScanIndex, SCAN_INDEX_SIZE
+
+@pytest.fixture
+def index(cache):
+    return ScanIndex(cache)
+
+@pytest.fixture
+def listed(monkeypatch):
+    calls = []
+    def list_scans_between(station, start, end):
+        calls.append((start, end))
+        return [ts for ts in range(0, 100000, 300) if start <= ts <= end]
+    monkeypatch.setattr(scan_index, 'list_scans_between', list_scans_between)
+    return calls
+
+def test_unindexed_station_is_listed(index, listed):
+    assert scans_between(index, "KTLX", 600, 1200) == [600, 900, 1200]
+    assert listed == [(600, 1200)]
+
+def test_covered_range_comes_from_the_index(index, listed):
+    index.add("KTLX", [3000, 3300, 3600], since=3000)
+    assert scans_between(index, "KTLX", 3000, 3600) == [3000, 3300, 3600]
+    assert listed == []
+
+def test_range_before_the_index_is_listed(index, listed):
+    index.add("KTLX", [3000, 3300, 3600], since=3000)
+    assert scans_between(index, "KTLX", 2400, 3600) == [2400, 2700, 3000, 3300, 3600]
+    assert listed == [(2400, 2999)]
+
+def test_index_without_seed_is_not_trusted(index, listed):
+    index.add("KTLX", [3000])
+    assert index.coverage("KTLX") is None
+    scans_between(index, "KTLX", 3000, 3600)
+    assert listed == [(3000, 3600)]
+
+def test_coverage_moves_up_once_the_index_is_trimmed(index):
+    index.add("KTLX", list(range(SCAN_INDEX_SIZE + 10)), since=0)
+    assert index.coverage("KTLX") == 10
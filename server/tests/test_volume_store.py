@@ -0,0 +1,112 @@
+# Run from the repository root with python -m pytest server/tests
+import os
+import threading
+import time
+
+import pytest
+
+from server.volume_store import LocalSource, VolumeStore, ABANDONED_DOWNLOAD_AGE
+
+VOLUME_BYTES = 1000
+
+@pytest.fixture
+def bucket(tmp_path):
+    root = tmp_path / "bucket"
+    for name in ("a", "b", "c"):
+        path = root / "2024/05/06/KTLX" / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(name.encode() * VOLUME_BYTES)
+    return str(root)
+
+# Counts fetches, optionally holding each one until released
+class CountingSource(LocalSource):
+    def __init__(self, root: str, release: threading.Event = None):
+        super().__init__(root)
+        self.fetches = 0
+        self.release = release
+
+    def fetch(self, key: str, fobj):
+        self.fetches += 1
+        if self.release is not None:
+            self.release.wait(5)
+        super().fetch(key, fobj)
+
+def _stored(directory):
+    return sorted(name for name in os.listdir(directory) if not name.endswith('.tmp'))
+
+def test_local_source_fetches_and_raises_for_missing(bucket, tmp_path):
+    store = VolumeStore(str(tmp_path / "volumes"), LocalSource(bucket))
+    with store.open("2024/05/06/KTLX/a") as volume:
+        assert volume[:] == b"a" * VOLUME_BYTES
+    with pytest.raises(ValueError):
+        store.open("2024/05/06/KTLX/missing")
+    # A failed fetch leaves nothing behind
+    assert len(os.listdir(tmp_path / "volumes")) == 1
+
+def test_downloads_each_volume_once(bucket, tmp_path):
+    source = CountingSource(bucket)
+    store = VolumeStore(str(tmp_path / "volumes"), source)
+    assert not store.has("2024/05/06/KTLX/a")
+    first = store.path("2024/05/06/KTLX/a")
+    assert store.path("2024/05/06/KTLX/a") == first
+    assert store.has("2024/05/06/KTLX/a")
+    assert source.fetches == 1
+
+def test_concurrent_requests_share_one_download(bucket, tmp_path):
+    release = threading.Event()
+    source = CountingSource(bucket, release)
+    store = VolumeStore(str(tmp_path / "volumes"), source)
+    paths = []
+    threads = [threading.Thread(target=lambda: paths.append(store.path("2024/05/06/KTLX/a"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert source.fetches == 1
+    assert len(paths) == 8 and len(set(paths)) == 1
+
+def test_evicts_least_recently_used(bucket, tmp_path):
+    directory = str(tmp_path / "volumes")
+    store = VolumeStore(directory, LocalSource(bucket), max_bytes=2 * VOLUME_BYTES)
+    a = store.path("2024/05/06/KTLX/a")
+    b = store.path("2024/05/06/KTLX/b")
+    # Using a makes b the least recently used
+    os.utime(b, (time.time() - 10, time.time() - 10))
+    store.path("2024/05/06/KTLX/a")
+    c = store.path("2024/05/06/KTLX/c")
+    assert os.path.exists(a) and os.path.exists(c)
+    assert not os.path.exists(b)
+
+def test_cap_holds_across_processes_sharing_the_directory(bucket, tmp_path):
+    directory = str(tmp_path / "volumes")
+    # Stores in separate processes only see each other through the directory
+    stores = [VolumeStore(directory, LocalSource(bucket), max_bytes=2 * VOLUME_BYTES) for _ in range(3)]
+    for store, name in zip(stores, ("a", "b", "c")):
+        store.path(f"2024/05/06/KTLX/{name}")
+        time.sleep(0.01)
+    assert len(_stored(directory)) == 2
+    assert stores[0].has("2024/05/06/KTLX/c")
+    assert not stores[2].has("2024/05/06/KTLX/a")
+
+def test_open_after_eviction_downloads_again(bucket, tmp_path):
+    source = CountingSource(bucket)
+    store = VolumeStore(str(tmp_path / "volumes"), source)
+    os.remove(store.path("2024/05/06/KTLX/a"))
+    with store.open("2024/05/06/KTLX/a") as volume:
+        assert volume[:1] == b"a"
+    assert source.fetches == 2
+
+def test_only_abandoned_downloads_are_removed(tmp_path):
+    directory = tmp_path / "volumes"
+    directory.mkdir()
+    abandoned = directory / "old.tmp"
+    abandoned.write_bytes(b"x")
+    old = time.time() - ABANDONED_DOWNLOAD_AGE - 60
+    os.utime(abandoned, (old, old))
+    inflight = directory / "new.tmp"
+    inflight.write_bytes(b"x")
+    VolumeStore(str(directory), LocalSource(str(tmp_path)))
+    assert not abandoned.exists()
+    assert inflight.exists()
@@ -0,0 +1,39 @@
+import asyncio
+import threading
+
+import pytest
+
+from server.watch_loop import WatchLoop
+
+def test_tasks_share_one_loop_until_closed():
+    watchLoop = WatchLoop()
+    loops = {}
+    started = threading.Event()
+    cancelled = threading.Event()
+
+    async def watch(key):
+        loops[key] = asyncio.get_running_loop()
+        if len(loops) == 2:
+            started.set()
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    watchLoop._schedule('A', watch)
+    watchLoop._schedule('B', watch)
+    with pytest.raises(ValueError):
+        watchLoop._schedule('A', watch)
+    assert started.wait(5)
+    assert loops['A'] is loops['B']
+
+    watchLoop._cancel('A')
+    with pytest.raises(ValueError):
+        watchLoop._cancel('A')
+    assert watchLoop.watching() == ['B']
+    thread = watchLoop.thread
+    watchLoop._close()
+    assert cancelled.is_set()
+    assert not thread.is_alive()
+    assert watchLoop.loop is None
@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+from shapely.geometry import Point
+
+from server import zones
+from server.bench.standins import NWSServer
+from server.zones import zone_id_from_url, ZoneStore
+
+@pytest.fixture
+def nws(monkeypatch):
+    nws = NWSServer(alerts=0).start()
+    monkeypatch.setattr(zones, 'NWS_API', nws.url)
+    yield nws
+    nws.stop()
+
+def test_zones_are_identified_by_type_and_ugc():
+    assert zone_id_from_url("https://api.weather.gov/zones/fire/okz004") == "fire/OKZ004"
+    assert zone_id_from_url("https://api.weather.gov/zones/forecast/OKZ004/") == "forecast/OKZ004"
+
+def test_zone_types_sharing_a_ugc_are_kept_apart(nws, cache):
+    store = ZoneStore(cache)
+    asyncio.run(store.load([f"{nws.url}/zones/forecast/OKZ004", f"{nws.url}/zones/fire/OKZ004"]))
+    assert set(store.zones) == {"forecast/OKZ004", "fire/OKZ004"}
+    assert cache.has("zones/fire/OKZ004") and cache.has("zones/forecast/OKZ004")
+    assert store.query(store.geometry("fire/OKZ004").centroid) == {"forecast/OKZ004", "fire/OKZ004"}
+
+def test_least_recently_used_zones_are_dropped(nws, cache):
+    store = ZoneStore(cache, max_zones=2)
+    for ugc in ("OKZ001", "OKZ002", "OKZ001", "OKZ003"):
+        store.load_sync([f"{nws.url}/zones/forecast/{ugc}"])
+    assert list(store.zones) == ["forecast/OKZ001", "forecast/OKZ003"]
+    # Dropped zones come back from the cache
+    requests = nws.requests
+    store.geometry("forecast/OKZ002")
+    assert nws.requests == requests
+    assert "forecast/OKZ002" in store.zones
+    assert store.query(Point(0, 0)) == set()
+
+def test_requests_load_zones_without_an_event_loop(nws, cache):
+    store = ZoneStore(cache)
+    # As in a gevent worker, where another request's loop may be running on the same thread
+    async def handler():
+        return store.geometry("forecast/OKZ007", 'low')
+    assert asyncio.run(handler()).geom_type == 'MultiPolygon'
@@ -0,0 +1,100 @@
+import collections
+import functools
+import io
+import threading
+
+import msgpack
+import numpy as np
+from PIL import Image
+
+from .geometry import gate_index, lonlat_to_polar, nominal_az_edges
+from .packing import unpack_array
+
+MIN_TILE_ZOOM = 4
+MAX_TILE_ZOOM = 10
+TILE_SIZE = 256
+TILE_FORMATS = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+}
+# Each lookup table is TILE_SIZE * TILE_SIZE int32s, 256 KiB
+TILE_LUT_CACHE_SIZE = 512
+
+# Reflectivity colors, matching the frontend colormap. Values up to each threshold get its color.
+REF_COLORS = [
+    (-30, 0x764fab), (-25, 0x7c689a), (-20, 0x86818e), (-15, 0xaeaea3), (-10, 0xcccc99),
+    (-5, 0x9ba1a6), (0, 0x77819d), (5, 0x5a6c9f), (10, 0x405aa0), (15, 0x419b96),
+    (20, 0x40d38d), (25, 0x20af45), (30, 0x018d01), (35, 0x83b100), (40, 0xeed000),
+    (45, 0xf6ad00), (50, 0xf70000), (55, 0xdf0000), (60, 0xffc9ff), (65, 0xffabfb),
+    (70, 0xad00ff), (75, 0xa200f9), (80, 0x00e1ec),
+]
+REF_COLOR_ABOVE = 0x3333cc
+# The frontend draws radar at 0.75 alpha
+TILE_ALPHA = 191
+
+_luts = collections.OrderedDict()
+_lutsLock = threading.Lock()
+
+# RGBA color for every possible Level2 code, plus a transparent entry at the end for
+# pixels outside the sweep
+@functools.lru_cache(maxsize=16)
+def _palette(scale: float, offset: float, size: int):
+    values = (np.arange(size) - offset) / scale
+    thresholds = np.array([threshold for threshold, _ in REF_COLORS])
+    colors = np.array([color for _, color in REF_COLORS] + [REF_COLOR_ABOVE])
+    rgb = colors[np.searchsorted(thresholds, values, side='left')]
+    palette = np.zeros((size + 1, 4), dtype=np.uint8)
+    palette[:size, 0] = rgb >> 16
+    palette[:size, 1] = (rgb >> 8) & 0xff
+    palette[:size, 2] = rgb & 0xff
+    palette[:size, 3] = TILE_ALPHA
+    # Codes 0 and 1 are below threshold and range folded
+    palette[:2] = 0
+    return palette
+
+# Web Mercator latitude and longitude of every pixel center in a tile
+def _tile_lonlat(z: int, x: int, y: int):
+    n = 2 ** z
+    offsets = (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE
+    lon = (x + offsets) / n * 360. - 180.
+    lat = np.rad2deg(np.arctan(np.sinh(np.pi * (1 - 2 * (y + offsets) / n))))
+    return np.meshgrid(lon, lat)
+
+# Flat gate index into the sweep data for every pixel in a tile. This depends only on the
+# site and sweep geometry, so each new scan is a gather through a cached table.
+def _lookup_table(station: str, sweep, z: int, x: int, y: int):
+    key = (station, sweep['grid']['az'], sweep['grid']['range'], z, x, y)
+    with _lutsLock:
+        if key in _luts:
+            _luts.move_to_end(key)
+            return _luts[key]
+
+    az = nominal_az_edges(unpack_array(sweep['az']).astype(np.float64))
+    rng = unpack_array(sweep['ref_range'])
+    lon, lat = _tile_lonlat(z, x, y)
+    pixel_az, pixel_rng = lonlat_to_polar(sweep['cent_lon'], sweep['cent_lat'], lon, lat)
+    lut = gate_index(az, rng, pixel_az, pixel_rng)
+
+    with _lutsLock:
+        _luts[key] = lut
+        while len(_luts) > TILE_LUT_CACHE_SIZE:
+            _luts.popitem(last=False)
+    return lut
+
+def render_tile(station: str, packed, z: int, x: int, y: int, ext: str = 'png'):
+    sweep = msgpack.unpackb(packed)
+    codes = unpack_array(sweep['data'])
+    lut = _lookup_table(station.upper(), sweep, z, x, y)
+    palette = _palette(sweep['data']['scale'], sweep['data']['offset'], 2 ** (8 * codes.itemsize))
+    gates = codes.ravel()
+    outside = lut == gates.size
+    pixels = gates[np.where(outside, 0, lut)].astype(np.intp)
+    pixels[outside] = len(palette) - 1
+    rgba = palette[pixels]
+
+    buf = io.BytesIO()
+    if ext == 'webp':
+        Image.fromarray(rgba).save(buf, 'WEBP', lossless=True)
+    else:
+        Image.fromarray(rgba).save(buf, 'PNG')
+    return buf.getvalue()
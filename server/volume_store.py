@@ -0,0 +1,153 @@
+import concurrent.futures
+import hashlib
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import botocore
+
+from .metrics import S3_REQUEST_SECONDS, S3_DOWNLOAD_BYTES
+
+# Partial downloads older than this were left behind by a process that died
+ABANDONED_DOWNLOAD_AGE = 3600
+
+class S3Source:
+    def __init__(self, client, bucket: str):
+        self.client = client
+        self.bucket = bucket
+
+    def fetch(self, key: str, fobj):
+        try:
+            with S3_REQUEST_SECONDS.labels('get').time():
+                self.client.download_fileobj(self.bucket, key, fobj)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise ValueError("Radar scan not found")
+            raise
+        S3_DOWNLOAD_BYTES.inc(fobj.tell())
+
+# Stands in for the bucket with a local directory laid out the same way
+class LocalSource:
+    def __init__(self, root: str):
+        self.root = root
+
+    def fetch(self, key: str, fobj):
+        try:
+            with open(os.path.join(self.root, key), 'rb') as src:
+                shutil.copyfileobj(src, fobj)
+        except FileNotFoundError:
+            raise ValueError("Radar scan not found")
+
+# Raw volumes on local disk, addressed by a hash of their S3 key. The least recently
+# used volumes are evicted once the store grows past max_bytes. The directory is shared
+# by every job process, so usage and recency come from the files themselves: a volume's
+# mtime is bumped whenever it is used.
+class VolumeStore:
+    def __init__(self, directory: str, source, max_bytes: int = 2 * 1024 ** 3):
+        self.directory = directory
+        self.source = source
+        self.max_bytes = max_bytes
+        self.inflight = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # Other processes share the directory, so only clear out downloads that were abandoned
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith('.tmp') and os.stat(path).st_mtime < time.time() - ABANDONED_DOWNLOAD_AGE:
+                os.remove(path)
+        self._evict()
+
+    def _digest(self, key: str):
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _path(self, digest: str):
+        return os.path.join(self.directory, digest)
+
+    # Stored volumes as (mtime, size, path), least recently used first
+    def _volumes(self):
+        volumes = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                volumes.append((stat.st_mtime, stat.st_size, entry.path))
+        return sorted(volumes)
+
+    # Removes the least recently used volumes until the directory is under max_bytes,
+    # always keeping the most recent one
+    def _evict(self):
+        volumes = self._volumes()
+        size = sum(volume[1] for volume in volumes)
+        for _, volumeSize, path in volumes[:-1]:
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another process evicted it first
+                pass
+            size -= volumeSize
+
+    def _download(self, key: str, digest: str):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fobj:
+                self.source.fetch(key, fobj)
+            os.replace(tmp, self._path(digest))
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return os.path.getsize(self._path(digest))
+
+    def has(self, key: str):
+        return os.path.exists(self._path(self._digest(key)))
+
+    def path(self, key: str):
+        digest = self._digest(key)
+        with self.lock:
+            # Stored by this or another process sharing the directory
+            try:
+                os.utime(self._path(digest))
+                return self._path(digest)
+            except FileNotFoundError:
+                pass
+            # Concurrent requests for the same key wait on the one download
+            future = self.inflight.get(digest)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self.inflight[digest] = future
+        if not owner:
+            return future.result()
+
+        try:
+            size = self._download(key, digest)
+        except BaseException as e:
+            with self.lock:
+                del self.inflight[digest]
+            future.set_exception(e)
+            raise
+        logging.info(f"Stored volume {key} ({size} bytes)")
+        with self.lock:
+            del self.inflight[digest]
+            self._evict()
+        future.set_result(self._path(digest))
+        return self._path(digest)
+
+    def open(self, key: str):
+        try:
+            fobj = open(self.path(key), 'rb')
+        except FileNotFoundError:
+            # Evicted between the lookup and the open
+            fobj = open(self.path(key), 'rb')
+        with fobj:
+            return mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
@@ -0,0 +1,53 @@
+import asyncio
+import threading
+
+# A watch task per key, all scheduled on one event loop in a background thread. The loop
+# starts with the first task, and closing it cancels what is left and drains its default
+# executor. Shared by the radar and alert watchers.
+class WatchLoop:
+    def __init__(self):
+        self.tasks = dict()
+        self.loop = None
+        self.thread = None
+        self.lock = threading.RLock()
+
+    async def _shutdown(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.get_running_loop().shutdown_default_executor()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def watching(self):
+        return list(self.tasks.keys())
+
+    # Runs watch(key) on the loop, ValueError if the key already has a task
+    def _schedule(self, key: str, watch):
+        with self.lock:
+            if key in self.tasks:
+                raise ValueError(f"Already watching {key}")
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.tasks[key] = asyncio.run_coroutine_threadsafe(watch(key), self.loop)
+
+    def _cancel(self, key: str):
+        with self.lock:
+            if key not in self.tasks:
+                raise ValueError(f"Not watching {key}")
+            self.tasks.pop(key).cancel()
+
+    def _close(self):
+        with self.lock:
+            if self.loop is not None:
+                asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.thread.join()
+                self.loop.close()
+                self.loop = None
+                self.thread = None
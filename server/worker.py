@@ -0,0 +1,121 @@
+import datetime
+import logging
+import os
+import threading
+import uuid
+
+from .alert_watcher import AlertWatcher
+from .cache import Cache
+from .events import publish_event, watched, RADAR_CHANNEL, ALERT_CHANNEL, WATCHED_STATIONS, WATCHED_STATES
+from .jobs import JobPool
+from .metrics import serve as serve_metrics
+from .mosaic import MosaicEngine
+from .radar import process_scan, SCAN_JOBS
+from .radar_watcher import RadarWatcher
+from .zones import ZoneStore
+
+# Only the worker holding this lock watches radars and alerts, the others stand by
+LEADER_KEY = "leader/watcher"
+LEADER_EXPIRATION = datetime.timedelta(seconds=30)
+# Renewed well within the expiration, and also how often stations and states are picked up
+# and dropped
+LEADER_RENEW = 5
+# Watched for as long as the worker leads, like the mosaics' stations, whether or not a client
+# has asked
+DEFAULT_STATIONS = [station for station in os.getenv("WATCH_STATIONS", "KTLX").upper().split(",") if station]
+# Alert states kept warm the same way, so the map's first request doesn't find them cold
+DEFAULT_STATES = [state for state in os.getenv("WATCH_STATES", "OK").upper().split(",") if state]
+# Port the worker serves its and its job processes' metrics on, off if unset
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+
+# Downloads and processes radar volumes and polls alerts into the cache, for any number of
+# stateless web workers to serve. Run as many as you like, one of them leads at a time and
+# every one of them runs a pool of processes for the scan processing jobs.
+class Worker:
+    def __init__(self, cache: Cache):
+        self.cache = cache
+        self.id = uuid.uuid4().hex
+        self.stopping = threading.Event()
+        self.watcher = None
+        self.alertWatcher = None
+        self.mosaics = None
+        self.jobs = JobPool(SCAN_JOBS, process_scan)
+
+    def _start(self):
+        self.watcher = RadarWatcher(self.cache)
+        self.alertWatcher = AlertWatcher(self.cache, ZoneStore(self.cache))
+        self.mosaics = MosaicEngine(self.cache)
+        self.watcher.add_event_listener(lambda station, ts: publish_event(self.cache, RADAR_CHANNEL, station, ts))
+        self.alertWatcher.add_event_listener(lambda state, changes: publish_event(self.cache, ALERT_CHANNEL, state, changes))
+        self.mosaics.attach(self.watcher)
+
+    # Watches what clients have needed lately and stops watching the rest
+    def _sync(self):
+        stations = set(DEFAULT_STATIONS) | set(self.mosaics.stations()) | watched(self.cache, WATCHED_STATIONS)
+        for station in stations:
+            if not self.watcher.is_watching(station):
+                self.watcher.start(station)
+        for station in set(self.watcher.watching()) - stations:
+            logging.info(f"No clients left for {station}")
+            self.watcher.stop(station)
+        states = set(DEFAULT_STATES) | watched(self.cache, WATCHED_STATES)
+        for state in states:
+            if not self.alertWatcher.is_watching(state):
+                self.alertWatcher.start(state)
+        for state in set(self.alertWatcher.watching()) - states:
+            logging.info(f"No clients left for {state} alerts")
+            self.alertWatcher.stop(state)
+
+    def _stop(self):
+        self.watcher.stop_all()
+        self.alertWatcher.stop_all()
+        self.mosaics.shutdown()
+        self.watcher = None
+        self.alertWatcher = None
+        self.mosaics = None
+
+    def run(self):
+        self.jobs.start()
+        try:
+            self._lead()
+        finally:
+            self.jobs.stop()
+
+    def _lead(self):
+        while not self.stopping.is_set():
+            if not self.cache.acquire_lock(LEADER_KEY, self.id, LEADER_EXPIRATION):
+                self.stopping.wait(LEADER_RENEW)
+                continue
+            logging.info(f"Worker {self.id} is leading")
+            self._start()
+            try:
+                while not self.stopping.is_set():
+                    self._sync()
+                    self.stopping.wait(LEADER_RENEW)
+                    if not self.cache.renew_lock(LEADER_KEY, self.id, LEADER_EXPIRATION):
+                        logging.info(f"Worker {self.id} lost the lead")
+                        break
+            except Exception as e:
+                logging.info(f"Error leading: {repr(e)}")
+                print(f"Error leading: {repr(e)}")
+            finally:
+                self._stop()
+                self.cache.release_lock(LEADER_KEY, self.id)
+
+    def start_thread(self):
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopping.set()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if METRICS_PORT:
+        serve_metrics(METRICS_PORT)
+    worker = Worker(Cache())
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        worker.stop()
@@ -0,0 +1,160 @@
+import asyncio
+import collections
+import datetime
+import functools
+import json
+import os
+import threading
+
+import msgpack
+from shapely import STRtree, from_wkb, to_geojson, to_wkb
+from shapely.geometry import shape, Polygon, MultiPolygon, GeometryCollection
+
+from .cache import Cache
+from .nws import NWS_API, fetchExecutor, get_zone_geojson
+
+# Zone boundaries rarely change
+ZONE_EXPIRATION = datetime.timedelta(days=365)
+# Simplification tolerance in degrees for each level of detail
+DETAIL_LEVELS = {
+    'low': 0.01,
+    'medium': 0.002,
+    'full': 0.,
+}
+# Zones are county sized and stay simplified until zoomed in much closer, see detail_for_zoom
+ZONE_ZOOM_DETAIL = [(6, 'low'), (9, 'medium')]
+UNION_CACHE_SIZE = 1024
+# Zones kept in memory by web processes, which only need the ones of the alerts being queried
+ZONE_STORE_SIZE = int(os.getenv("ZONE_STORE_SIZE", 2048))
+# Zone types the API serves under /zones/{type}/{ugc}
+ZONE_TYPES = ('land', 'marine', 'forecast', 'public', 'coastal', 'offshore', 'fire', 'county')
+
+# Zones are identified by their type and UGC code, the last two parts of their API URL, as
+# the same UGC can name both a forecast zone and a fire zone
+def zone_id_from_url(url: str):
+    zoneType, ugc = url.rstrip('/').rsplit('/', 2)[-2:]
+    return f"{zoneType.lower()}/{ugc.upper()}"
+
+def zone_url(zoneId: str):
+    return f"{NWS_API}/zones/{zoneId}"
+
+# The polygons making up a zone, whatever shape the API gave it in
+def _polygons(poly):
+    polygons = []
+    if type(poly) == Polygon:
+        polygons.append(poly)
+    elif type(poly) == MultiPolygon:
+        for geom in poly.geoms:
+            polygons.append(geom)
+    elif type(poly) == GeometryCollection:
+        for geom in poly.geoms:
+            if type(geom) == Polygon:
+                polygons.append(geom)
+            elif type(geom) == MultiPolygon:
+                for geom2 in geom.geoms:
+                    polygons.append(geom2)
+            else:
+                print(geom)
+                raise ValueError('Invalid polygon')
+    return polygons
+
+# Parsed once when the zone is first fetched and stored as WKB at every level of detail
+def _preprocess(url: str):
+    geometry = MultiPolygon(_polygons(shape(json.loads(get_zone_geojson(url))['geometry'])))
+    levels = {}
+    for detail, tolerance in DETAIL_LEVELS.items():
+        # Simplifying can turn a multipolygon of one part into a polygon
+        simplified = geometry if tolerance == 0 else MultiPolygon(_polygons(geometry.simplify(tolerance, preserve_topology=True)))
+        levels[detail] = to_wkb(simplified)
+    return msgpack.packb(levels)
+
+# Zone geometry by zone id, in memory in front of the cache, with a spatial index over every
+# zone loaded so far and memoized multipolygons for the sets of zones alerts cover. With
+# max_zones set the least recently used zones are dropped past that many.
+class ZoneStore:
+    def __init__(self, cache: Cache, max_zones: int = None):
+        self.cache = cache
+        self.maxZones = max_zones
+        self.zones = collections.OrderedDict()
+        self.tree = None
+        self.treeIds = []
+        self.unions = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _add(self, zoneId: str, packed):
+        levels = msgpack.unpackb(packed)
+        with self.lock:
+            self.zones[zoneId] = {detail: from_wkb(wkb) for detail, wkb in levels.items()}
+            if self.maxZones is not None:
+                while len(self.zones) > self.maxZones:
+                    self.zones.popitem(last=False)
+            self.tree = None
+
+    # Zones already in memory are skipped and stored ones come back in one round trip. Returns
+    # the URLs by id and the ids and stored zones of those that weren't in memory.
+    def _lookup(self, urls):
+        urls = {zone_id_from_url(url): url for url in urls}
+        missing = []
+        with self.lock:
+            for zoneId in urls:
+                if zoneId in self.zones:
+                    self.zones.move_to_end(zoneId)
+                else:
+                    missing.append(zoneId)
+        stored = self.cache.get_many([f"zones/{zoneId}" for zoneId in missing]) if len(missing) > 0 else []
+        return urls, missing, stored
+
+    # Fetches go through the cache's single-flight, so alerts being ingested at the same time
+    # that share zones only fetch each one once
+    def _fetch(self, zoneId: str, url: str):
+        return self.cache.get_or_compute(f"zones/{zoneId}", functools.partial(_preprocess, url), ZONE_EXPIRATION)
+
+    def _store(self, missing, stored, fetched):
+        for zoneId, packed in zip(missing, stored):
+            self._add(zoneId, packed if packed is not None else fetched[zoneId])
+
+    # The rest are fetched concurrently, for the worker's event loop
+    async def load(self, urls):
+        urls, missing, stored = self._lookup(urls)
+        fetch = [zoneId for zoneId, packed in zip(missing, stored) if packed is None]
+        loop = asyncio.get_running_loop()
+        fetched = await asyncio.gather(*[loop.run_in_executor(fetchExecutor, self._fetch, zoneId, urls[zoneId]) for zoneId in fetch])
+        self._store(missing, stored, dict(zip(fetch, fetched)))
+
+    # The same for request handlers, which mustn't start an event loop of their own
+    def load_sync(self, urls):
+        urls, missing, stored = self._lookup(urls)
+        fetch = [zoneId for zoneId, packed in zip(missing, stored) if packed is None]
+        fetched = fetchExecutor.map(self._fetch, fetch, [urls[zoneId] for zoneId in fetch])
+        self._store(missing, stored, dict(zip(fetch, fetched)))
+
+    def geometry(self, zoneId: str, detail: str = 'full'):
+        url = zone_url(zoneId)
+        zoneId = zone_id_from_url(url)
+        self.load_sync([url])
+        return self.zones[zoneId][detail]
+
+    # GeoJSON multipolygon of every polygon in the zones
+    def union(self, zoneIds, detail: str = 'full'):
+        key = (tuple(zoneIds), detail)
+        with self.lock:
+            if key in self.unions:
+                self.unions.move_to_end(key)
+                return self.unions[key]
+            polygons = [polygon for zoneId in zoneIds for polygon in self.zones[zoneId][detail].geoms]
+        geojson = json.loads(to_geojson(MultiPolygon(polygons)))
+        with self.lock:
+            self.unions[key] = geojson
+            while len(self.unions) > UNION_CACHE_SIZE:
+                self.unions.popitem(last=False)
+        return geojson
+
+    # Ids of the loaded zones that intersect the geometry
+    def query(self, geometry):
+        with self.lock:
+            if self.tree is None:
+                self.treeIds = list(self.zones.keys())
+                self.tree = STRtree([self.zones[zoneId]['full'] for zoneId in self.treeIds])
+            tree = self.tree
+            treeIds = self.treeIds
+        return {treeIds[i] for i in tree.query(geometry, predicate='intersects')}